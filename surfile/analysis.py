@@ -8,15 +8,17 @@
 """
 
 import copy
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 from dataclasses import dataclass
 
 from alive_progress import alive_bar
 from matplotlib import pyplot as plt, cm
-from scipy import signal, optimize, stats
+from scipy import signal, optimize, special, stats
 
-from surfile import geometry, profile, surface, funct, extractor
+from surfile import geometry, profile, surface, funct, extractor, texture, filter
 from surfile.funct import classOptions, options, rcs
 
 
@@ -66,26 +68,295 @@ def _findHfromHist(hist, edges):
     return binh - binl
 
 
-def _tolerant_mean(arrs: list):
+def _compact(a, mask):
     """
-    Calculates the average between multiple arrays of different length
+    Moves the masked values of each row to the left keeping their order,
+    the remaining positions are set to NaN
 
     Parameters
     ----------
-    arrs: list
-        The arrays to be processed
+    a: np.ndarray
+        (m, n) the values
+    mask: np.ndarray
+        (m, n) the values to be kept
 
     Returns
     -------
-    mean: np.array
-        The mean calculated
+    c: np.ndarray
+        (m, k) the compacted values, k is the maximum number of kept values in a row
     """
-    lens = [len(i) for i in arrs]
-    arr = np.ma.empty((np.max(lens), len(arrs)))
-    arr.mask = True
-    for idx, l in enumerate(arrs):
-        arr[:len(l), idx] = l
-    return arr.mean(axis=-1), arr.std(axis=-1)
+    order = np.argsort(~mask, axis=1, kind='stable')
+    c = np.take_along_axis(np.where(mask, a, np.nan), order, axis=1)
+    return c[:, :max(np.count_nonzero(mask, axis=1).max(initial=0), 1)]
+
+
+def _maskedMeanStd(a):
+    """
+    Mean and standard deviation of the rows of a NaN padded stack
+
+    Parameters
+    ----------
+    a: np.ndarray
+        (m, n) the values, NaNs are ignored
+
+    Returns
+    -------
+    mean, std: (np.array, ...)
+        (n,) the mean and std over the rows
+    """
+    cnt = np.count_nonzero(np.isfinite(a), axis=0)
+    a0 = np.where(np.isfinite(a), a, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = a0.sum(axis=0) / cnt
+        std = np.sqrt(np.where(np.isfinite(a), (a0 - mean) ** 2, 0).sum(axis=0) / cnt)
+    return mean, std
+
+
+def _arcRadiusStack(X, Z, skip=0.05):
+    """
+    Radius of the arcs versus depth for a stack of radial profiles,
+    see ProfileAnalysis.arcRadius()
+
+    Parameters
+    ----------
+    X: np.ndarray
+        (n,) or (m, n) the radial coordinates of the profiles
+    Z: np.ndarray
+        (m, n) the heights of the profiles, each profile is used up to its first NaN
+    skip: float
+        The first micrometers to skip
+
+    Returns
+    -------
+    r, z: (np.ndarray, ...)
+        (m, k) the radius and the respective depths, left aligned and NaN padded
+    """
+    X = np.broadcast_to(X, Z.shape)
+    valid = np.cumprod(np.isfinite(Z[:, :-1]), axis=1).astype(bool)  # up to the first nan
+
+    ri = X[:, :-1] - X[:, [0]]
+    zeh = np.abs(Z[:, [0]] - Z[:, :-1])
+    keep = valid & (zeh > skip)  # skip the first nanometers
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (ri ** 2 + zeh ** 2) / (2 * zeh)
+    return _compact(r, keep), _compact(zeh, keep)
+
+
+def _arcSlopeStack(X, Z, R):
+    """
+    Max measured slopes for a stack of radial profiles,
+    see ProfileAnalysis.arcSlope()
+
+    Parameters
+    ----------
+    X: np.ndarray
+        (n,) or (m, n) the radial coordinates of the profiles
+    Z: np.ndarray
+        (m, n) the heights of the profiles
+    R: float
+        The nominal radius of the arc
+
+    Returns
+    -------
+    phi_max1, phi_max2: (np.array, ...)
+        (m,) the slopes at breakpoints 1 and 2
+    """
+    X = np.broadcast_to(X, Z.shape)
+    m, n = Z.shape
+    rows = np.arange(m)
+    nan = np.isnan(Z)
+
+    i1 = np.where(nan.any(axis=1), nan.argmax(axis=1) - 2, -1) % n  # first nan value
+    i2 = np.argmin(np.where(nan, np.inf, Z), axis=1)  # the furthest max point
+
+    Rms_1 = X[rows, i1] - X[:, 0]
+    Rms_2 = np.where(nan.all(axis=1), np.nan, X[rows, i2] - X[:, 0])
+    with np.errstate(invalid='ignore'):
+        return np.arcsin(Rms_1 / R), np.arcsin(Rms_2 / R)
+
+
+def _cosModel(p, x):
+    return 0.5 * p[0] * np.cos(np.pi * (x - p[1]) / p[2]) + p[3] + p[4] * x
+
+
+def _cosJac(p, x):
+    """Analytic jacobian of _cosModel() with respect to p"""
+    u = np.pi * (x - p[1]) / p[2]
+    c, s = np.cos(u), np.sin(u)
+    return np.c_[0.5 * c,
+                 0.5 * p[0] * s * np.pi / p[2],
+                 0.5 * p[0] * s * u / p[2],
+                 np.ones_like(x),
+                 x]
+
+
+def _fs(p, s, xsw, x):
+    return special.expit((xsw - s * (p[1] - x)) / p[4])  # 1 / (1 + exp((s(p1 - x) - xsw) / p4))
+
+
+def _sigmModel(p, x):
+    return p[0] * (_fs(p, 1, 1 / 2 * p[2], x) * _fs(p, -1, 1 / 2 * p[2], x) -
+                   _fs(p, 1, 3 / 2 * p[2], x) * _fs(p, -1, 3 / 2 * p[2], x) +
+                   1 / 2) + p[3]
+
+
+def _sigmJac(p, x):
+    """Analytic jacobian of _sigmModel() with respect to p"""
+    def edges(k):
+        # product of the two sigmoids with half width k * p2 and its derivatives (p1, p2, p4)
+        fp, fm = _fs(p, 1, k * p[2], x), _fs(p, -1, k * p[2], x)
+        gp, gm = fp * (1 - fp), fm * (1 - fm)
+        vp, vm = (k * p[2] - (p[1] - x)) / p[4], (k * p[2] + (p[1] - x)) / p[4]
+        d1 = (-gp * fm + fp * gm) / p[4]
+        d2 = k * (gp * fm + fp * gm) / p[4]
+        d4 = -(gp * vp * fm + fp * gm * vm) / p[4]
+        return fp * fm, d1, d2, d4
+
+    a, a1, a2, a4 = edges(1 / 2)
+    b, b1, b2, b4 = edges(3 / 2)
+    return np.c_[a - b + 1 / 2,
+                 p[0] * (a1 - b1),
+                 p[0] * (a2 - b2),
+                 np.ones_like(x),
+                 p[0] * (a4 - b4)]
+
+
+def _grating1dFit(x, z, nom_pitch, warm=None, full_output=False):
+    """
+    Cosine and sigmoidal fits of a grating profile, see ProfileAnalysis.grating_1d()
+
+    Parameters
+    ----------
+    x: np.array
+        The profile coordinates
+    z: np.array
+        The profile heights
+    nom_pitch: float
+        The nominal pitch of the sample
+    warm: (np.array, np.array)
+        The converged cosine and first bar parameters of a neighbouring profile,
+        used as starting point of the fits
+    full_output: bool
+        If True returns also the fit statistics
+
+    Returns
+    -------
+    x_c: np.array
+        The center position of the features
+    h_c: np.array
+        The calculated heights of the features
+    popt: np.array
+        The parameters of the cosine fit
+    boxes: list
+        (xbox, popt_sigm) the points and the sigmoidal fit parameters of each bar
+    stats: dict
+        Only if full_output, 'nfev' number of function evaluations (cosine + bars),
+        'rms' residual rms of each bar, 'ier' leastsq flag of each bar,
+        'warm' the parameters to be used for the next profile
+    """
+    x_c = []  # center positions of features
+    h_c = []  # height of features
+    boxes = []
+    rms, ier = [], []
+
+    fin = np.isfinite(z)
+    xf, zf = x[fin], z[fin]
+    zmax = np.nanmax(z)
+    zmin = np.nanmin(z)
+    p_init = np.array([zmax - zmin, 0, 0.5 * nom_pitch, 0.5 * (zmax + zmin), 0])
+    if warm is not None and warm[0] is not None: p_init = warm[0]
+    popt, _, info, _, _ = optimize.leastsq(lambda p: _cosModel(p, xf) - zf, p_init,
+                                           Dfun=lambda p: _cosJac(p, xf), full_output=True)
+    nfev = info['nfev']
+
+    # first maximum is in p1, the following are in p1 + 2p2 * ip
+    period = 2 * popt[2]
+    first = None
+    p_prev = warm[1] if warm is not None else None  # warm start from the neighbouring bar
+    for ip in range(1, int(np.nanmax(x) / period)):
+        xip = popt[1] + period * ip
+        boolbox = (xip - 1.3 * popt[2] < x) & (x < xip + 1.3 * popt[2]) & fin
+        xbox = x[boolbox]  # x of the single box
+        zbox = z[boolbox]  # z of the single box
+        if zbox.size < 5:  # keep the bar index aligned between profiles
+            x_c.append(np.nan)
+            h_c.append(np.nan)
+            rms.append(np.nan)
+            ier.append(0)
+            continue
+
+        # now we can fit the sigmoid
+        if p_prev is None:
+            p_init_sigm = np.array([np.ptp(zbox), xip, period / 2, np.nanmin(zbox) + np.ptp(zbox) / 2, 0.2])
+        else:
+            p_init_sigm = np.array([p_prev[0], xip, p_prev[2], p_prev[3], p_prev[4]])
+        popt_sigm, _, info, _, flag = optimize.leastsq(lambda p: _sigmModel(p, xbox) - zbox, p_init_sigm,
+                                                       Dfun=lambda p: _sigmJac(p, xbox), full_output=True)
+        nfev += info['nfev']
+
+        h = _sigmModel(popt_sigm, popt_sigm[1]) - _sigmModel(popt_sigm, popt_sigm[1] + popt_sigm[2])
+        d_form = popt_sigm[0] / h
+        th = 1
+        ok = 1 - th < d_form < 1 + th  # check on std
+        h_c.append(h if ok else np.nan)
+        x_c.append(popt_sigm[1])
+        boxes.append((xbox, popt_sigm))
+        rms.append(np.sqrt(np.mean(info['fvec'] ** 2)))
+        ier.append(flag)
+
+        converged = ok and flag in [1, 2, 3, 4]
+        p_prev = popt_sigm if converged else None
+        if converged and first is None: first = popt_sigm
+
+    x_c, h_c = np.array(x_c), np.abs(np.array(h_c))
+    if full_output:
+        stats = {'nfev': nfev, 'rms': np.array(rms), 'ier': np.array(ier), 'warm': (popt, first)}
+        return x_c, h_c, popt, boxes, stats
+    return x_c, h_c, popt, boxes
+
+
+def _grating1dRows(x, Z, nom_pitch, warm=True):
+    """
+    Worker of SurfaceAnalysis.grating_1d(), fits a block of profiles
+
+    Parameters
+    ----------
+    x: np.array
+        The profiles coordinates
+    Z: np.ndarray
+        (rows, samples) the block of profiles
+    nom_pitch: float
+        The nominal pitch of the sample
+    warm: bool
+        If True each profile starts from the solution of the previous one
+
+    Returns
+    -------
+    xs, hs, rms: (np.ndarray, ...)
+        (rows, bars) center positions, heights of the features and residuals
+        of the bar fits, NaN padded
+    nfev: int
+        Total number of function evaluations
+    """
+    res = []
+    nfev = 0
+    start = None
+    for z in Z:
+        if np.count_nonzero(np.isfinite(z)) < 5:
+            res.append((np.array([]), np.array([]), np.array([])))
+            continue
+        x_c, h_c, _, _, stats = _grating1dFit(x, z, nom_pitch, warm=start, full_output=True)
+        res.append((x_c, h_c, stats['rms']))
+        nfev += stats['nfev']
+        if warm: start = stats['warm']
+
+    n = max([r[0].size for r in res] + [1])
+    xs, hs, rms = (np.full((len(res), n), np.nan) for _ in range(3))
+    for i, (x_c, h_c, r) in enumerate(res):
+        xs[i, :x_c.size] = x_c
+        hs[i, :h_c.size] = h_c
+        rms[i, :r.size] = r
+    return xs, hs, rms, nfev
 
 
 @classOptions(decorator=options(
@@ -204,7 +475,7 @@ class ProfileAnalysis:
         return steps, definedPeaks
 
     @staticmethod
-    def histHeight(obj: profile.Profile, bins=None, bplt=False):
+    def histHeight(obj: profile.Profile, bins=None, sketch=None, bplt=False):
         """
         Calculates the height of the sample using the histogram 
         method.
@@ -215,6 +486,8 @@ class ProfileAnalysis:
             The profile object on wich the height is calculated
         bins: int
             The number of bins of the histogram
+        sketch: funct.HeightSketch
+            The precomputed sketch of the heights, if None the exact histogram of obj.Z is used
         bplt: bool
             Plots the histogram of the profile
 
@@ -232,24 +505,29 @@ class ProfileAnalysis:
         height sample the histogram presents two peaks, the program calculates
         the difference between the two peaks and returns the height.
         """
+        z = obj.Z[np.isfinite(obj.Z)]
         b = bins
         if bins is None:
-            b = 2 * stats.iqr(obj.Z) / (obj.Z.size ** (1 / 3))  # Freedman-Diaconis
+            if sketch is None:
+                bw = 2 * stats.iqr(z) / (z.size ** (1 / 3))  # Freedman-Diaconis
+                b = max(int(np.ceil(np.ptp(z) / bw)), 1) if bw > 0 else int(np.sqrt(z.size))
+            else:
+                b = sketch.binsFD()
             print(f'Using {b} bins in hist')
 
-        hist, edges = np.histogram(obj.Z, b)
+        if sketch is None:
+            hist, edges = np.histogram(z, b)
+        else:  # interpolated from the fine bins of the sketch
+            hist, edges = sketch.histogram(b)
         height = _findHfromHist(hist=hist, edges=edges)
 
         perc_hist = hist / np.size(obj.Z) * 100
-        af_curve = np.zeros(bins)  # abbott firestone curve
-        af_curve[0] = perc_hist[0]
-        for i, ele in enumerate(np.flip(perc_hist[1:])):
-            af_curve[i + 1] = af_curve[i] + ele
 
         if bplt:
+            mr, af_curve = texture.MaterialRatio.curve(z)  # abbott firestone curve
             fig, (ax_ht, bx_af) = plt.subplots(nrows=1, ncols=2)
             ax_ht.hist(edges[:-1], bins=edges, weights=perc_hist, color='red')
-            bx_af.plot(af_curve, np.flip(edges[:-1]))
+            bx_af.plot(mr, af_curve)
             funct.persFig(
                 [ax_ht],
                 gridcol='grey',
@@ -292,16 +570,8 @@ class ProfileAnalysis:
         $\\Phi_{MS1}=asin(\\frac{b_1}{R})$
         $\\Phi_{MS2}=asin(\\frac{b_2}{R})$
         """
-        try:
-            bound_nan = np.argwhere(np.isnan(obj.Z))[0][-1] - 1
-        except IndexError:
-            bound_nan = 0
-
-        Rms_1 = obj.X[bound_nan - 1] - obj.X[0]
-        Rms_2 = obj.X[np.nanargmin(obj.Z)] - obj.X[0]  # find the furthest max point
-        phi_max_1 = np.arcsin(Rms_1 / R)
-        phi_max_2 = np.arcsin(Rms_2 / R)
-        return phi_max_1, phi_max_2
+        phi_max_1, phi_max_2 = _arcSlopeStack(obj.X, obj.Z[None, :], R)
+        return phi_max_1[0], phi_max_2[0]
 
     @staticmethod
     def arcRadius(obj: profile.Profile, skip=0.05, bplt=False):
@@ -330,16 +600,8 @@ class ProfileAnalysis:
         is the distance between the maximum value of the profile and the $z$ 
         coordinate of point $i$; $R_i$ represent the radius calculated at point $i$.
         """
-        r = []
-        z = []
-        for i, p in enumerate(obj.Z[0:-1]):
-            if np.isnan(p): break
-            ri = obj.X[i] - obj.X[0]
-            zeh = np.abs(obj.Z[0] - p)
-            if zeh > skip:  # skip the first nanometers
-                z.append(zeh)
-                radius = (ri ** 2 + zeh ** 2) / (2 * zeh)
-                r.append(radius)
+        r, z = _arcRadiusStack(obj.X, obj.Z[None, :], skip=skip)
+        r, z = r[0][np.isfinite(r[0])], z[0][np.isfinite(z[0])]
 
         if bplt:
             fig, ax = plt.subplots()
@@ -354,7 +616,7 @@ class ProfileAnalysis:
         return r, z
 
     @staticmethod
-    def grating_1d(obj: profile.Profile, nom_pitch, bplt=False):
+    def grating_1d(obj: profile.Profile, nom_pitch, full_output=False, bplt=False):
         """
         Determines height and pitch of 1D gratings
         of line bars of rectangular cross-section, where the trench width
@@ -368,6 +630,8 @@ class ProfileAnalysis:
             The profile on which the steps are evaluated
         nom_pitch: float
             the nominal pitch of the sample
+        full_output: bool
+            if true returns also the fit statistics
         bplt: Bool
             if true plots the sine and the sigmoid fit
 
@@ -377,6 +641,9 @@ class ProfileAnalysis:
             The center position of the features
         h_c: np.array
             The calculated heights of the features
+        stats: dict
+            Only if full_output, 'nfev' number of function evaluations,
+            'rms' residual rms and 'ier' leastsq flag of each bar fit
             
         Notes
         -----
@@ -386,56 +653,25 @@ class ProfileAnalysis:
         The sigmoidal funtion fit is in the form:\n
         $f_s(x_{SW})=\\frac{1}{1+e^{\\frac{s(p_1-x)-x_{SW}}{p_4}}}$\n
         $z_M(\\mathbf{p},x)=p_0(f_{+1}(\\frac{1}{2}p_2)f_{-1}(\\frac{1}{2}p_2)-f_{+1}
-        (\\frac{3}{2}p_2)f_{-1}(\\frac{3}{2}p_2))$
+        (\\frac{3}{2}p_2)f_{-1}(\\frac{3}{2}p_2))$\n
+        Both fits use analytic jacobians, each bar fit starts from the solution
+        of the previous bar.
         """
-        x_c = []  # center positions of features
-        h_c = []  # height of features
-
-        # cosine fit for the whole profile
-        _cos = lambda p: 0.5 * p[0] * np.cos(np.pi * (obj.X - p[1]) / p[2]) + p[3] + p[4] * obj.X
-        _fs = lambda p, s, xsw, x: 1 / (1 + np.exp((s * (p[1] - x) - xsw) / p[4]))
-        _sigm = lambda p, x: p[0] * (_fs(p, 1, 1 / 2 * p[2], x) * _fs(p, -1, 1 / 2 * p[2], x) -
-                                     _fs(p, 1, 3 / 2 * p[2], x) * _fs(p, -1, 3 / 2 * p[2], x) + 
-                                     1 / 2) + p[3]
-        
-        zmax = np.nanmax(obj.Z)
-        zmin = np.nanmin(obj.Z)
-        p_init = np.array([zmax - zmin, 0, 0.5 * nom_pitch, 0.5 * (zmax + zmin), 0])
-        popt = optimize.leastsq(lambda p: _cos(p) - obj.Z, p_init)[0]
+        x_c, h_c, popt, boxes, stats = _grating1dFit(obj.X, obj.Z, nom_pitch, full_output=True)
         # print(f'Cosine period (sample pitch approx): {2 * popt[2]}')
 
         if bplt:
             fig, ax = plt.subplots()
-            ax.plot(obj.X, obj.Z, obj.X, _cos(popt))
+            ax.plot(obj.X, obj.Z, obj.X, _cosModel(popt, obj.X))
+            for xbox, popt_sigm in boxes:
+                ax.plot(xbox, _sigmModel(popt_sigm, xbox))
             ax.set_title(obj.name)
-            
-            funct.persFig([ax], xlab='x [um]', ylab='z [um]')
 
-        # first maximum is in p1, the following are in p1 + 2p2 * ip
-        period = 2 * popt[2]
-        for ip in range(1, int(np.nanmax(obj.X) / period)):
-            xip = popt[1] + period * ip
-            boolbox = (xip - 1.3 * popt[2] < obj.X) & (obj.X < xip + 1.3 * popt[2])
-            xbox = obj.X[boolbox]  # x of the single box
-            zbox = obj.Z[boolbox]  # z of the single box
-
-            # now we can fit the sigmoid
-            p_init_sigm = np.array([np.ptp(zbox), xip,  period / 2, np.nanmin(zbox) + np.ptp(zbox) / 2, 0.2])
-            popt_sigm = optimize.leastsq(lambda p: _sigm(p, xbox) - zbox, p_init_sigm)[0]
-
-            h = _sigm(popt_sigm, popt_sigm[1]) - _sigm(popt_sigm, popt_sigm[1] + popt_sigm[2])
-            d_form = popt_sigm[0] / h
-            th = 1
-            h_c.append(h if 1 - th < d_form < 1 + th else np.nan)  # check on std
-            x_c.append(popt_sigm[1])
-
-            if bplt: ax.plot(xbox, _sigm(popt_sigm, xbox))
-            # fig2, bx = plt.subplots()
-            # bx.plot(xbox, _sigm(popt_sigm, xbox), 'b', 
-            #         xbox, _sigm(p_init_sigm, xbox), 'r',
-            #         xbox, zbox, 'g')
+            funct.persFig([ax], xlab='x [um]', ylab='z [um]')
 
-        return np.array(x_c), np.abs(np.array(h_c))
+        if full_output:
+            return x_c, h_c, {k: stats[k] for k in ['nfev', 'rms', 'ier']}
+        return x_c, h_c
 
 
 @classOptions(decorator=options(
@@ -455,7 +691,7 @@ class SurfaceAnalysis:
     relative to surface analysis.
     """
     @staticmethod
-    def histHeight(obj: surface.Surface, bins=None, bplt=False):
+    def histHeight(obj: surface.Surface, bins=None, sketch=None, bplt=False):
         """
         Calculates the height of the sample using the histogram 
         method.
@@ -466,6 +702,8 @@ class SurfaceAnalysis:
             The profile object on wich the height is calculated
         bins: int
             The number of bins of the histogram
+        sketch: funct.HeightSketch
+            The precomputed sketch of the heights, if None the exact histogram of obj.Z is used
         bplt: bool
             Plots the histogram of the profile
 
@@ -489,7 +727,10 @@ class SurfaceAnalysis:
             b = int(np.sqrt(obj.Z.size))
             print(f'Using {b} bins in hist')
 
-        hist, edges = np.histogram(obj.Z[np.isfinite(obj.Z)], bins=b)
+        if sketch is None:
+            hist, edges = np.histogram(obj.Z[np.isfinite(obj.Z)], bins=b)
+        else:  # interpolated from the fine bins of the sketch
+            hist, edges = sketch.histogram(b)
         height = _findHfromHist(hist=hist, edges=edges)
         if bplt:
             fig = plt.figure()
@@ -518,7 +759,7 @@ class SurfaceAnalysis:
         R : float
             The nominal radius of the sphere
         angleStep : int
-            The angle used to rotate the image after every iteration
+            The angular step between the radial profiles
         start : str
             Method used to find the start (x, y) point on the topography
                 'max': the start point is the maximum Z of the topography
@@ -534,17 +775,9 @@ class SurfaceAnalysis:
         phi_max2 : np.array
             The 2 slopes calculated at breackpoints 1 and 2 respectively
         """
-        meas_slope1, meas_slope2 = [], []
-        with alive_bar(int(360 / angleStep), force_tty=True,
-                       title='Slope', theme='smooth',
-                       elapsed_end=True, stats_end=True, length=30) as bar:
-            for a in range(0, 360, angleStep):
-                obj.rotate(a)
-                slopeprofile = copy.copy(extractor.SphereExtractor.sphereProfile(obj, startP=start, bplt=False))
-                ms1, ms2 = ProfileAnalysis.arcSlope(slopeprofile, R)  # 350 um radius
-                meas_slope1.append(np.rad2deg(ms1))
-                meas_slope2.append(np.rad2deg(ms2))
-                bar()
+        X, Z = extractor.SphereExtractor.radialProfiles(obj, np.arange(0, 360, angleStep), startP=start)
+        ms1, ms2 = _arcSlopeStack(X, Z, R)  # all the angles at once
+        meas_slope1, meas_slope2 = np.rad2deg(ms1), np.rad2deg(ms2)
 
         if bplt:
             fig, ax = plt.subplots()
@@ -575,7 +808,7 @@ class SurfaceAnalysis:
         obj : surface.Surface
             The surface object on wich the radius is calculated
         angleStepSize : int
-            The angle used to rotate the image after every iteration
+            The angular step between the radial profiles
         start : str
             Method used to find the start (x, y) point on the topography
                 'max': the start point is the maximum Z of the topography
@@ -590,27 +823,15 @@ class SurfaceAnalysis:
         (yr, yz): (np.array(), ...)
             The mean of the radius and the mean of the different heights where the radius is calculated
         """
-        rs = []
-        zs = []
-        fig, ax = plt.subplots()
-
-        with alive_bar(int(360 / angleStepSize), force_tty=True,
-                       title='Radius', theme='smooth',
-                       elapsed_end=True, stats_end=True, length=30) as bar:
-            for a in range(0, 360, angleStepSize):
-                obj.rotate(a)
-                radiusprofile = copy.copy(extractor.SphereExtractor.sphereProfile(obj, startP=start, bplt=False))
-                r, z = ProfileAnalysis.arcRadius(radiusprofile, bplt=False)  # 350 um radius
-                rs.append(r)
-                zs.append(z)
-                if bplt: ax.plot(z, r, alpha=0.2)
-                bar()
-
-        yr, error = _tolerant_mean(rs)
-        yz, error = _tolerant_mean(zs)
+        X, Z = extractor.SphereExtractor.radialProfiles(obj, np.arange(0, 360, angleStepSize), startP=start)
+        rs, zs = _arcRadiusStack(X, Z)  # (angles, depths) for all the angles at once
+        yr, error = _maskedMeanStd(rs)
+        yz, error = _maskedMeanStd(zs)
         if bplt:
+            fig, ax = plt.subplots()
+            ax.plot(zs.T, rs.T, alpha=0.2)
             ax.plot(yz, yr, color='red')
-            ax.set_ylim(0, max(yr))
+            ax.set_ylim(0, np.nanmax(yr))
             funct.persFig([ax], xlab='Z_eh [um]', ylab='R [um]')
             ax.set_title(obj.name)
 
@@ -635,9 +856,9 @@ class SurfaceAnalysis:
         concavity : str
             Can be either 'convex' or 'concave'
         base : bool
-            If true removes the points at the base of the cylinder
+            If true excludes the points at the base of the cylinder
         bplt : bool
-            Plots the sphere fitted to the data points
+            Plots the cylinder fitted to the data points
 
         Returns
         -------
@@ -658,89 +879,78 @@ class SurfaceAnalysis:
         Based on the results obtained, the measured points are eliminated where the following inequality 
         is satisfied, in order to cut out any outlier point far from the cylinder axis:
 
-        $|y-(\\frac{m}{l})x-y_0|>\\frac{2Rsin \\cdot (\\phi)}{cos(\\alpha_z)}$
+        $\\frac{|m(x-x_0)-l(y-y_0)|}{\\sqrt{l^2+m^2}}>2Rsin(\\phi)$
         where $m$ and $l$ are the components of the versor that represent the cylinder axis direction,
-        R is the estimated radius of the circular base of the cylinder, $\\alpha_z$ is the rotation of the 
-        cylinder axis around the Z-axis, $\\phi$ is the cone angle of the objective specified by the instrument
-        manufacturer, $y_0$  the intercept of the axis.
-        A second cylinder fit is then applied to all remaining points and $R_{all}$ and $FD_{all}$ parameters are 
-        calculated, a third cylinder fit is done on the points that in the initial fit had a radial residue 
+        R is the estimated radius of the circular base of the cylinder, $\\phi$ is the cone angle of the
+        objective specified by the instrument manufacturer, $(x_0, y_0)$ a point of the axis: the left
+        side is the distance of the point from the axis projected on the xy plane.
+        A second cylinder fit is then applied to all remaining points and $R_{all}$ and $FD_{all}$ parameters are
+        calculated, a third cylinder fit is done on the points that in the initial fit had a radial residue
         below $2\\sigma$ and $R_{2\\sigma}$ and $FD_{2\\sigma}$ can be finally calculated.
-        """
-        # TODO: if alphaZ = 90 deg the method is really slow (whyyy??)
-        def fitCyl():
-            _p = geometry.Cylinder.formFit(obj, radius, alphaZ=alphaZ, concavity=concavity,
-                                         base=base, finalize=False, bplt=bplt)
-            _r = np.abs(_p[0])
-
-            _l = np.cos(_p[3]) * np.cos(_p[4])
-            _m = np.sin(_p[3])
-            _n = np.cos(_p[3]) * np.sin(_p[4])
-
-            return _r, _p, _l, _m, _n
-
-        def calcResid():
-            # calculation of radial distance from fitted cylinder axis
-            d = -(l * obj.X + m * obj.Y + n * obj.Z)
-            t = -(d + m * est_p[1] + n * est_p[2])
-
-            H = np.array([l * t, est_p[1] + m * t, est_p[2] + n * t])
-            P = np.array([obj.X, obj.Y, obj.Z])
-
-            dist = np.linalg.norm(P - H, axis=0)
-
-            # calculation of radial residues as dist - fitR
-            _resid = dist - R
 
-            return _resid, np.mean(_resid[~np.isnan(_resid)]), np.std(_resid[~np.isnan(_resid)])
-
-        def findPhiCone():
-            masknan = np.isfinite(obj.Z)
-            a = m / l
-            b = -1
-            c = est_p[1]
-
-            dists = np.abs(a * obj.X[masknan] + b * obj.Y[masknan] + c) / (a ** 2 + b ** 2)
-            maxd = np.max(dists)
-            return np.rad2deg(np.arcsin(maxd / R))
+        The analysis works on the compact array of the valid points and on boolean masks,
+        the surface passed is not modified.
+        """
+        if concavity not in ['convex', 'concave']: raise Exception('Concavity is not valid')
+        valid = np.isfinite(obj.Z)
+        P = np.array([obj.X[valid], obj.Y[valid], obj.Z[valid]])  # compact valid points
+        keep = np.ones(P.shape[1], dtype=bool)
+        if base: keep &= ~geometry._cylBaseMask(P[2], radius, concavity)
+
+        def fitCyl(mask):
+            _p = geometry._fitCylinderPoints(P[:, mask], radius, alphaZ=alphaZ, concavity=concavity)
+            if bplt: plotMask(mask, _p)
+            return _p[0], _p
+
+        def calcResid(mask):
+            # radial distance from fitted cylinder axis minus the fitted radius
+            _resid = geometry._cylResiduals(P[:, mask], est_p)
+            return _resid, np.mean(_resid), np.std(_resid)
+
+        def axisDist():
+            # distance of the points from the axis projected on the xy plane
+            l = np.cos(est_p[3]) * np.cos(est_p[4])
+            m = np.sin(est_p[3])
+            return np.abs(m * (P[0] - est_p[5]) - l * (P[1] - est_p[1])) / np.hypot(l, m)
+
+        def plotMask(mask, _p):  # plots a copy of the surface with only the masked points
+            Z = np.full(obj.Z.shape, np.nan)
+            Z[valid] = np.where(mask, P[2], np.nan)
+            geometry._plotCyl(obj.X, obj.Y, Z, geometry._evalCyl(obj, _p, concavity))
 
         # fit the first approx cyl
-        R, est_p, l, m, n = fitCyl()
-        resid, avg, std = calcResid()
+        R, est_p = fitCyl(keep)
+        resid = np.full(P.shape[1], np.nan)
+        resid[keep], avg, std = calcResid(keep)
 
-        below_i = (np.abs(resid) < 2 * std)  # points with residues below 2sigma
-        outliers_i = (np.abs(resid) > 10 * std)
-        obj.Z[outliers_i] = np.nan  # remove the evident outliers
+        below_i = np.abs(resid) < 2 * std  # points with residues below 2sigma
+        keep &= ~(np.abs(resid) > 10 * std)  # remove the evident outliers
 
         if phiCone is not None:  # remove points outside cone from topo
+            dist = axisDist()
             if phiCone is True:
-                phiCone = findPhiCone()
+                phiCone = np.rad2deg(np.arcsin(min(np.max(dist[keep]) / R, 1)))
                 print(f'Using {phiCone=}')
 
-            base = R * np.sin(np.deg2rad(phiCone))
-            base = base if -np.pi/2 < est_p[3] < np.pi/2 else -base  # invert polarity for alphaZ >< +-90°
             # keep only values inside the range +- base centered on the cylinder axis
-            discard_i = np.abs(obj.Y - (m / l) * obj.X - est_p[1]) > (2 * base) / np.cos(est_p[3])
-            obj.Z[discard_i] = np.nan
-
-            if bplt: obj.pltC()
+            keep &= dist <= 2 * R * np.sin(np.deg2rad(phiCone))
 
         # fit the all cyl
-        R_all, est_p, l, m, n = fitCyl()
-        resid_all, avg_all, std_all = calcResid()
-        FD_all = np.ptp(resid_all[~np.isnan(resid_all)])
+        R_all, est_p = fitCyl(keep)
+        resid_all, avg_all, std_all = calcResid(keep)
+        FD_all = np.ptp(resid_all)
 
         # fit the 2sigma cyl
-        obj.Z[~below_i] = np.nan
-        if bplt: obj.pltC()
-        R_2s, est_p, l, m, n = fitCyl()
-        resid_2s, avg_2s, std_2s = calcResid()
-        FD_2s = np.ptp(resid_2s[~np.isnan(resid_2s)])
+        keep &= below_i
+        R_2s, est_p = fitCyl(keep)
+        resid_2s, avg_2s, std_2s = calcResid(keep)
+        FD_2s = np.ptp(resid_2s)
 
         return R_all, FD_all, R_2s, FD_2s, avg_all, std_all, avg_2s, std_2s
 
     @staticmethod
-    def grating_1d(obj: surface.Surface, nom_pitch, direction='x', bplt=False):
+    def grating_1d(obj: surface.Surface, nom_pitch, direction='x', workers=None, block=16, warm=True,
+                   full_output=False, bplt=False):
         """
         Determines height and pitch of 1D gratings
         of line bars of rectangular cross-section, where the trench width
@@ -757,6 +967,16 @@ class SurfaceAnalysis:
             The nominal pitch of the grating
         direction: str
             Orientation of the features (perpendicular to the grating bars)
+        workers: int
+            Number of processes used for the profile fits, if None uses all the cpus,
+            if 1 the fits are executed in the current process
+        block: int
+            Number of profiles fitted by each task
+        warm: bool
+            If true the fits of each profile start from the solution of the previous
+            profile of the same block
+        full_output: bool
+            If true returns also the fit statistics
         bplt: bool
             If true plots the calculated heights and regression lines
             
@@ -768,58 +988,106 @@ class SurfaceAnalysis:
             Calculated mean pitch
         s_pitch: float
             standard error of the pitch
+        stats: dict
+            Only if full_output, 'nfev' total number of function evaluations,
+            'rms' (profiles, bars) residual rms of the bar fits,
+            'x_c' and 'h_c' (profiles, bars) centres and heights of the bars,
+            'bars' the index of each column (bars found in less than 2 profiles are dropped)
+
+        Notes
+        -----
+        The profiles are fitted in parallel with a process pool, on platforms that
+        spawn the processes (Windows, macOS) the calling script must be protected
+        by if __name__ == '__main__'. Profiles with a different number of bars
+        are NaN padded.
         """
-        xs = None
-        hs = None
-        ys = obj.y
-        profiles = obj.toProfiles(axis=direction).tolist()
-        with alive_bar(len(profiles), force_tty=True,
+        if direction not in ['x', 'y']: raise Exception(f'{direction} is not a valid direction')
+        x = obj.x if direction == 'x' else obj.y
+        ys = obj.y if direction == 'x' else obj.x
+        Z = obj.Z if direction == 'x' else obj.Z.T
+
+        if bplt:  # fit of the first profile
+            ProfileAnalysis.grating_1d(obj.toProfiles(axis=direction)[0], nom_pitch=nom_pitch, bplt=True)
+
+        nrows = Z.shape[0]
+        nbars = max(int(np.nanmax(x) / nom_pitch), 1)
+        xs = np.full((nrows, nbars), np.nan)
+        hs = np.full((nrows, nbars), np.nan)
+        rms = np.full((nrows, nbars), np.nan)
+        nfev = 0
+
+        def store(i, res):
+            nonlocal xs, hs, rms, nfev
+            x_b, h_b, r_b, n_b = res
+            if x_b.shape[1] > xs.shape[1]:  # more bars than expected
+                pad = ((0, 0), (0, x_b.shape[1] - xs.shape[1]))
+                xs, hs, rms = (np.pad(a, pad, constant_values=np.nan) for a in (xs, hs, rms))
+            xs[i:i + x_b.shape[0], :x_b.shape[1]] = x_b
+            hs[i:i + h_b.shape[0], :h_b.shape[1]] = h_b
+            rms[i:i + r_b.shape[0], :r_b.shape[1]] = r_b
+            nfev += n_b
+
+        init = time.time()
+        starts = range(0, nrows, block)
+        with alive_bar(nrows, force_tty=True,
                        title='lateral', theme='smooth',
                        elapsed_end=True, stats_end=True, length=30) as bar:
-            for i, p in enumerate(profiles):
-                if i == 0:
-                    xs, hs = ProfileAnalysis.grating_1d(p, nom_pitch=nom_pitch, bplt=bplt)
-                else:
-                    x_p, h_p = ProfileAnalysis.grating_1d(p, nom_pitch=nom_pitch, bplt=False)
-                    xs = np.vstack((xs, x_p))
-                    hs = np.vstack((hs, h_p))
-                bar()
-        ms = []
-        qs = []
-        for c in xs.T:  # fit the regression lines
-            yx = np.vstack([obj.y, c.T]).T
-            (rows, cols) = yx.shape
-            G = np.ones((rows, 2))
-            G[:, 0] = yx[:, 0]  # X
-            Z = yx[:, 1]
-            (m, q), _, _, _ = np.linalg.lstsq(G, Z, rcond=None)
-            ms = np.append(ms, m)
-            qs = np.append(qs, q)
+            if workers == 1:
+                for i in starts:
+                    store(i, _grating1dRows(x, Z[i:i + block], nom_pitch, warm))
+                    bar(min(block, nrows - i))
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = {executor.submit(_grating1dRows, x, np.array(Z[i:i + block]), nom_pitch, warm): i
+                               for i in starts}
+                    for fut in as_completed(futures):
+                        i = futures[fut]
+                        store(i, fut.result())
+                        bar(min(block, nrows - i))
+        print(funct.Bcol.OKCYAN + f'Grating fit: {nrows / (time.time() - init):.1f} profiles/s, '
+                                  f'{nfev / nrows:.0f} evaluations/profile' + funct.Bcol.ENDC)
+
+        valid = np.isfinite(xs).sum(axis=0) >= 2  # bars found in at least 2 profiles
+        bars = np.flatnonzero(valid)  # the bar indexes survive the gaps
+        xs, hs, rms = xs[:, bars], hs[:, bars], rms[:, bars]
+
+        ms = np.full(xs.shape[1], np.nan)
+        qs = np.full(xs.shape[1], np.nan)
+        for j, c in enumerate(xs.T):  # fit the regression lines
+            fin = np.isfinite(c)
+            G = np.ones((np.count_nonzero(fin), 2))
+            G[:, 0] = ys[fin]  # X
+            (ms[j], qs[j]), _, _, _ = np.linalg.lstsq(G, c[fin], rcond=None)
         gamma = np.mean(np.arctan(ms))
-        x_posnom = np.arange(0, len(qs)) * nom_pitch / np.cos(gamma)
-        p_line, cov_p = np.polyfit(x_posnom, qs, 1)
+        x_posnom = bars * nom_pitch / np.cos(gamma)
+        p_line, cov_p = np.polyfit(x_posnom, qs, 1, cov=True)
         pitch = p_line[0] * nom_pitch
         s_pitch = np.sqrt(cov_p[0][0] * nom_pitch**2 + cov_p[1][1])
 
         if bplt:
-            Xs, Ys = np.meshgrid(xs[0], ys)
+            Ys = np.broadcast_to(ys[:, None], xs.shape)
+            Xs = np.where(np.isnan(xs), ms * Ys + qs, xs)  # missing bars on the regression lines
             fig, (ax, bx) = plt.subplots(nrows=1, ncols=2)
             mcm = copy.copy(cm.Greys)
             mcm.set_bad(color='r', alpha=1.)
             mask_h = np.ma.array(hs, mask=np.isnan(hs))
             Min = np.mean(mask_h) - 2 * np.std(mask_h)
             Max = np.mean(mask_h) + 2 * np.std(mask_h)
-            p = ax.pcolormesh(xs.T, Ys.T, hs.T, vmin=Min, vmax=Max, cmap=mcm)
+            p = ax.pcolormesh(Xs.T, Ys.T, hs.T, vmin=Min, vmax=Max, cmap=mcm)
             fig.colorbar(p, ax=ax)
             for i, c in enumerate(xs.T):
-                bx.plot(c, obj.y, 'r')
-                bx.plot(ms[i] * obj.y + qs[i], obj.y, alpha=0.5)
-                bx.pcolormesh(obj.X, obj.Y, obj.Z, alpha=0.2)
+                bx.plot(c, ys, 'r')
+                bx.plot(ms[i] * ys + qs[i], ys, alpha=0.5)
+                bx.annotate(str(bars[i]), (qs[i], ys[0]), ha='center', va='top')
+            bx.pcolormesh(obj.X, obj.Y, obj.Z, alpha=0.2)
             
             funct.persFig([ax, bx], xlab='x [um]', ylab='y [um]')
             ax.set_title(obj.name)
         
-        return np.mean(hs), np.mean(pitch), s_pitch
+        if full_output:
+            return np.nanmean(hs), np.mean(pitch), s_pitch, {'nfev': nfev, 'rms': rms, 'x_c': xs, 'h_c': hs,
+                                                                'bars': bars}
+        return np.nanmean(hs), np.mean(pitch), s_pitch
     
 
 class TipCorrection():
@@ -845,60 +1113,29 @@ class TipCorrection():
             The radius of the sphere of the contact instrument
         bplt: bool
             Plots the envelope of the filter if true
-        """
-        def morph(profile_x, profile_y, radius):
-            spacing = profile_x[1] - profile_x[0]
-            n_radius = int(radius / spacing)
-            n_samples = len(profile_x)
-
-            filler_L = np.ones(n_radius) * profile_y[0]
-            filler_R = np.ones(n_radius) * profile_y[-1]
-
-            profile_x_filled = np.arange(start=profile_x[0] - radius, stop=profile_x[-2] + radius, step=spacing)
-            profile_y_filled = np.concatenate([filler_L, profile_y, filler_R])
-
-            profile_out = profile_y_filled - radius
-
-            with alive_bar(n_samples, force_tty=True,
-                           title='Morph', theme='smooth',
-                           elapsed_end=True, stats_end=True, length=30) as bar:
-                for i in range(n_radius, n_samples + n_radius):
-                    loc_x = np.linspace(profile_x_filled[i - n_radius], profile_x_filled[i + n_radius], 1000)
-                    loc_p = np.interp(loc_x, profile_x_filled[i - n_radius:i + n_radius],
-                                      profile_y_filled[i - n_radius:i + n_radius])
-
-                    alpha = profile_x_filled[i]
-                    beta = profile_out[i]
-
-                    cerchio = np.sqrt(-(alpha ** 2 - radius ** 2) + 2 * alpha * loc_x - loc_x ** 2) + beta
-
-                    dbeta = -10 * radius
-                    disp = 0
 
-                    bar()
-                    up = len(np.argwhere((cerchio - loc_p) > 0))
-                    if up > 1:
-                        while np.abs(dbeta) > radius / 1000:
-                            cerchio += dbeta
-                            disp -= dbeta
-                            up = len(np.argwhere((cerchio - loc_p) > 0))
-
-                            if (dbeta < 0 and up == 0) or (dbeta > 0 and up != 0):
-                                dbeta = -dbeta / 2
-
-                        profile_out[i] -= disp
-
-            profile_out = profile_out[n_radius: -n_radius]
+        Notes
+        -----
+        The profile is replaced by the height of the disk centre, the envelope is
+        computed with filter.ProfileMorphological.morph() in O(n log n).
+        """
+        spacing = obj.X[1] - obj.X[0]
+        n_radius = int(radius / spacing)
+        n_samples = len(obj.X)
 
-            if bplt:
-                fig, ax = plt.subplots()
-                ax.axis('equal')
-                ax.plot(profile_x, profile_y, profile_x, profile_out)
-                plt.show()
+        # the profile is extended with its end values, the result is the disk centre
+        profile_x = obj.X[0] + spacing * np.arange(-n_radius, n_samples + n_radius)
+        profile_y = np.pad(obj.Z, n_radius, mode='edge')
+        profile_out = filter.ProfileMorphological.morph(profile_x, profile_y, radius, 'erosion', 'disk')
+        profile_out = profile_out[n_radius: n_radius + n_samples] - radius
 
-            return profile_out
+        if bplt:
+            fig, ax = plt.subplots()
+            ax.axis('equal')
+            ax.plot(obj.X, obj.Z, obj.X, profile_out)
+            plt.show()
 
-        obj.Z = morph(obj.X, obj.Z, radius)
+        obj.Z = profile_out
 
     @staticmethod
     def naive(obj: profile.Profile, radius, bplt=False):
@@ -917,28 +1154,29 @@ class TipCorrection():
             The radius of the sphere of the contact instrument
         bplt: bool
             Plots the envelope of the filter if true
+
+        Returns
+        -------
+        filtered: profile.Profile
+            The disk centre heights, the profile is cut of the disk radius at both ends
         """
         spacing = obj.X[1] - obj.X[0]
-        n_radius = int(radius // spacing)
-        
-        x = np.linspace(-radius, radius, n_radius * 2)
-        struct = -np.sqrt(radius ** 2 - x ** 2)
-        
-        l = struct.size // 2  # half lenght for cut
-        
-        def findMax(i):
-            max = np.min(obj.Z[i-l : i+l] + struct)
-            return max        
+        l = int(radius // spacing)  # half lenght for cut
+
+        t = spacing * np.arange(-l, l + 1)
+        struct = -np.sqrt(radius ** 2 - t ** 2)
+
+        win = np.lib.stride_tricks.sliding_window_view(obj.Z, struct.size)
+        env = np.concatenate([np.min(win[i: i + 4096] + struct, axis=1)  # blocks limit the memory
+                              for i in range(0, win.shape[0], 4096)])
 
         filtered = profile.Profile()
-        filtered.setValues(
-            obj.X[l: -l],
-            np.array([findMax(i) for i in range(l, obj.Z.size - l, 1)]),
-            bplt=False
-        )
-        
+        filtered.setValues(obj.X[l: obj.Z.size - l], env, bplt=False)
+
         if bplt:
-                fig, ax = plt.subplots()
-                ax.axis('equal')
-                ax.plot(obj.X, obj.Z, filtered.X, filtered.Z)
-                plt.show()
\ No newline at end of file
+            fig, ax = plt.subplots()
+            ax.axis('equal')
+            ax.plot(obj.X, obj.Z, filtered.X, filtered.Z)
+            plt.show()
+
+        return filtered
@@ -335,7 +335,7 @@ class SurfaceCutter(Cutter, ABC):
 
 class HistCutter(Cutter, ABC):
     @staticmethod
-    def cut(obj, bins=None, finalize=True):
+    def cut(obj, bins=None, sketch=None, finalize=True):
         """
         Cuts the surface on the Z axis keeping only the
         points with an height included in the selection
@@ -347,6 +347,8 @@ class HistCutter(Cutter, ABC):
         bins : int
             The number of bins in the histogram
             if None the program calculates the optimal value
+        sketch : funct.HeightSketch
+            The precomputed sketch of the heights, if None the exact histogram of obj.Z is used
         finalize: bool
             If set to False the cut will not alter the profile,
             the method will only return the extents chosen by the user
@@ -362,7 +364,10 @@ class HistCutter(Cutter, ABC):
             b = int(np.sqrt(obj.Z.size))
             print(f'Using {b} bins in hist')
 
-        hist, edges = np.histogram(obj.Z[np.isfinite(obj.Z)], bins=b)
+        if sketch is None:
+            hist, edges = np.histogram(obj.Z[np.isfinite(obj.Z)], bins=b)
+        else:  # interpolated from the fine bins of the sketch
+            hist, edges = sketch.histogram(b)
         fig = plt.figure()
         ax_ht = fig.add_subplot(111)
         ax_ht.hist(edges[:-1], bins=edges, weights=hist / np.size(obj.Z) * 100, color='red')
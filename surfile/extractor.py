@@ -3,7 +3,8 @@
 - Creates a profile from a surface provides:
     - SimpleExtractor: profile parallel to x or y direction
     - ComplexExtractor: profile can be any (even pieceWise defined)
-    - SphereExtractor: profile starting from the maximum point of the surface
+    - SphereExtractor: profile starting from the maximum point of the surface,
+                       radial profiles at all angles
     
 Notes
 -----
@@ -342,6 +343,48 @@ class ComplexExtractor(Extractor, ABC):
         return prf, selector.verts
 
 
+def _sphereStartPoint(obj: surface.Surface, startP):
+    """
+    Protected method
+    Finds the start point of the radial profiles on a sphere topography
+
+    Parameters
+    ----------
+    obj: surface.Surface
+        The surface object on wich the profiles are extracted
+    startP : str
+        Method used to find the start point, see SphereExtractor.sphereProfile()
+
+    Returns
+    -------
+    (xind, yind): (int, int)
+        The row and column indices of the start point
+    """
+    if startP == 'max':
+        raveled = np.nanargmax(obj.Z)
+        xind, yind = np.unravel_index(raveled, obj.Z.shape)
+    elif startP == 'fit':
+        from surfile import geometry
+
+        r, C = geometry.Sphere.formFit(obj, finalize=False, bplt=False)
+        xind = np.argmin(np.abs(obj.y - C[1][0]))
+        yind = np.argmin(np.abs(obj.x - C[0][0]))
+    elif startP == 'center':
+        xind = int(len(obj.y) / 2)
+        yind = int(len(obj.x) / 2)
+    elif startP == 'local':
+        maxima = (obj.Z == ndimage.maximum_filter(obj.Z, 5))
+        mid = np.asarray(obj.Z.shape) / 2
+        maxinds = np.argwhere(maxima)  # find all maxima indices
+        center_max = maxinds[np.argmin(np.linalg.norm(maxinds - mid, axis=1))]
+
+        xind = center_max[0]
+        yind = center_max[1]
+    else:
+        raise Exception(f'{startP} is not a valid start method')
+    return int(xind), int(yind)
+
+
 class SphereExtractor(Extractor, ABC):
     @staticmethod
     def sphereProfile(obj: surface.Surface, startP, bplt=False):
@@ -366,34 +409,8 @@ class SphereExtractor(Extractor, ABC):
         profile: prof.Profile()
             The extracted profile
         """
-        # TODO : check if xind and yind are inverted
         prf = profile.Profile()
-        if startP == 'max':
-            raveled = np.nanargmax(obj.Z)
-            unraveled = np.unravel_index(raveled, obj.Z.shape)
-            xind = unraveled[0]
-            yind = unraveled[1]
-        elif startP == 'fit':
-            from surfile.geometry import sphere
-
-            r, C = sphere.remove(obj, bplt=False)
-            yc = C[0][0]
-            xc = C[1][0]
-            xind = np.argwhere(obj.x > xc)[0][0]
-            yind = np.argwhere(obj.y > yc)[0][0]
-        elif startP == 'center':
-            xind = int(len(obj.x) / 2)
-            yind = int(len(obj.y) / 2)
-        elif startP == 'local':
-            maxima = (obj.Z == ndimage.filters.maximum_filter(obj.Z, 5))
-            mid = np.asarray(obj.Z.shape) / 2
-            maxinds = np.argwhere(maxima)  # find all maxima indices
-            center_max = maxinds[np.argmin(np.linalg.norm(maxinds - mid, axis=1))]
-
-            xind = center_max[0]
-            yind = center_max[1]
-        else:
-            raise Exception(f'{startP} is not a valid start method')
+        xind, yind = _sphereStartPoint(obj, startP)  # row and column of the start point
 
         if bplt:
             fig, ax = plt.subplots()
@@ -410,3 +427,64 @@ class SphereExtractor(Extractor, ABC):
         prf.setValues(obj.x[yind:-1], obj.Z[xind][yind:-1], bplt=bplt)
 
         return prf
+
+    @staticmethod
+    def radialProfiles(obj: surface.Surface, angles, startP='local', order=1, bplt=False):
+        """
+        Samples the topography along rays starting from the start point,
+        all the angles are extracted in a single vectorized call without
+        rotating the topography
+
+        Parameters
+        ----------
+        obj: surface.Surface
+            The surface object on wich the profiles are extracted
+        angles : np.array
+            The angles of the rays in degrees, the ray at angle a corresponds to
+            the profile extracted by sphereProfile() after obj.rotate(a)
+        startP : str
+            Method used to find the start (x, y) point on the topography, see sphereProfile()
+        order : int
+            The order of the spline interpolation (0 nearest, as in surface.Surface.rotate)
+        bplt: bool
+            If True plots the topography and the rays
+
+        Returns
+        ----------
+        X : np.array
+            (samples,) the radial distance from the start point
+        Z : np.ndarray
+            (angles, samples) the heights along the rays, NaN outside the topography
+
+        Notes
+        -----
+        The rays are sampled with the pixel step through ndimage.map_coordinates,
+        the pixels are assumed to be square.
+        """
+        xind, yind = _sphereStartPoint(obj, startP)
+        theta = np.deg2rad(np.asarray(angles, dtype=float))
+
+        n = int(np.ceil(np.hypot(*obj.Z.shape)))
+        t = np.arange(n)
+        rows = xind + np.sin(theta)[:, None] * t
+        cols = yind + np.cos(theta)[:, None] * t
+
+        Z = ndimage.map_coordinates(obj.Z, [rows, cols], order=order, mode='constant', cval=np.nan)
+        last = np.nonzero(np.isfinite(Z).any(axis=0))[0]
+        n = last[-1] + 1 if last.size > 0 else 1
+        X = t[:n] * np.abs(obj.x[1] - obj.x[0])
+
+        if bplt:
+            fig, ax = plt.subplots()
+            ax.pcolormesh(obj.X, obj.Y, obj.Z, cmap=cm.viridis)
+            ax.plot(np.interp(cols[:, [0, n - 1]].T, np.arange(obj.x.size), obj.x),
+                    np.interp(rows[:, [0, n - 1]].T, np.arange(obj.y.size), obj.y), color='k', alpha=0.3)
+            funct.persFig(
+                [ax],
+                gridcol='grey',
+                xlab='x [um]',
+                ylab='y [um]'
+            )
+            plt.show()
+
+        return X, Z[:, :n]
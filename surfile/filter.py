@@ -5,6 +5,8 @@
     - gaussian surface
     - spline profile
     - gaussian robust profile
+    - morphological profile (disk and flat elements)
+    - morphological surface (ball and flat disk elements)
 
 @author: Andrea Giura, Dorothee Hueser
 """
@@ -14,6 +16,7 @@ from matplotlib import cm
 from scipy import ndimage, sparse, special, signal
 import numpy as np
 import copy
+from concurrent.futures import ThreadPoolExecutor
 
 from surfile import profile, surface, funct
 
@@ -49,6 +52,185 @@ import matplotlib.pyplot as plt
 # Part 89 - Areal Scale space technique
 
 
+def _runMax(z, w, axis=-1):
+    """
+    Running maximum on windows of w samples (w odd) centred on each sample,
+    van Herk / Gil-Werman algorithm: 3 comparisons per sample whatever the window.
+    The samples outside the array (and the NaNs) are ignored
+
+    Parameters
+    ----------
+    z : np.ndarray
+        The values, the maximum is computed along axis
+    w : int
+        The window length in samples
+
+    Returns
+    -------
+    out : np.ndarray
+        The running maximum, same shape of z
+    """
+    z = np.moveaxis(np.where(np.isnan(z), -np.inf, z), axis, -1)
+    n, h = z.shape[-1], w // 2
+    nb = -(-(n + 2 * h) // w)  # number of blocks of w samples
+
+    zp = np.full(z.shape[:-1] + (nb * w,), -np.inf)
+    zp[..., h:h + n] = z
+    blk = zp.reshape(z.shape[:-1] + (nb, w))
+    pre = np.maximum.accumulate(blk, axis=-1).reshape(zp.shape)  # from the block start
+    suf = np.maximum.accumulate(blk[..., ::-1], axis=-1)[..., ::-1].reshape(zp.shape)  # to the block end
+
+    out = np.maximum(suf[..., :n], pre[..., w - 1:w - 1 + n])
+    return np.moveaxis(out, -1, axis)
+
+
+def _discDilateRows(x, Z, r):
+    """
+    Dilation of each row of Z by the upper semicircle of radius r
+
+    $D(x_i) = \\max_j z_j + \\sqrt{r^2 - (x_i - x_j)^2}, \\; |x_i - x_j| \\le r$
+
+    Parameters
+    ----------
+    x : np.array
+        (n,) the abscissae shared by the rows, increasing
+    Z : np.ndarray
+        (rows, n) the values, NaNs are ignored
+    r : float
+        The radius of the disk
+
+    Returns
+    -------
+    D : np.ndarray
+        (rows, n) the dilation (disk centre convention), -inf where no point is within r
+
+    Notes
+    -----
+    The semicircle is concave, so the matrix $z_j + \\sqrt{r^2 - (x_i - x_j)^2}$ is totally
+    monotone: the index of the maximum of each abscissa is not decreasing with the abscissa.
+    The maxima are found by divide and conquer (the middle abscissa of each interval bounds
+    the search of the two halves), all the intervals of a level are processed together:
+    $O(n \\log n)$ operations whatever the radius. The rows are placed one after the other
+    with a gap larger than 2r and processed in a single pass.
+    """
+    Z = np.atleast_2d(Z)
+    rows, n = Z.shape
+    gap = x[-1] - x[0] + 2 * r + 1
+    X = (x[None, :] + gap * np.arange(rows)[:, None]).ravel()  # only used to find the windows
+    xl = np.tile(x, rows)  # the distances are computed with the row abscissae
+
+    valid = np.isfinite(Z).ravel()
+    Xc, xc, zc = X[valid], xl[valid], Z.ravel()[valid]
+    m, c = X.size, Xc.size
+    D = np.full(m, -np.inf)
+    if c == 0: return D.reshape(Z.shape)
+    L = np.searchsorted(Xc, X - r, side='left')  # window of the valid points of each abscissa
+    R = np.searchsorted(Xc, X + r, side='right') - 1
+
+    # intervals of abscissae [rl, rh] with the interval of candidate points [cl, ch]
+    rl, rh, cl, ch = np.array([0]), np.array([m - 1]), np.array([0]), np.array([c - 1])
+    while rl.size:
+        mid = (rl + rh) // 2
+        lo, hi = np.maximum(cl, L[mid]), np.minimum(ch, R[mid])
+        ln = np.maximum(hi - lo + 1, 0)
+        ne = ln > 0
+        opt = np.clip(L[mid], cl, ch)  # no point within r: L separates the two halves
+        if np.any(ne):
+            ln = ln[ne]
+            off = np.r_[0, np.cumsum(ln)[:-1]]
+            seg = np.repeat(np.arange(ln.size), ln)
+            col = np.arange(seg.size) - off[seg] + lo[ne][seg]
+            val = zc[col] + np.sqrt(np.maximum(r ** 2 - (xl[mid[ne]][seg] - xc[col]) ** 2, 0))
+            mx = np.maximum.reduceat(val, off)
+            first = np.minimum.reduceat(np.where(val == mx[seg], np.arange(seg.size), seg.size), off)
+            D[mid[ne]] = mx
+            opt[ne] = col[first]
+
+        left, right = rl <= mid - 1, mid + 1 <= rh
+        rl, rh, cl, ch = (np.r_[rl[left], mid[right] + 1], np.r_[mid[left] - 1, rh[right]],
+                          np.r_[cl[left], opt[right]], np.r_[opt[left], ch[right]])
+    return D.reshape(Z.shape)
+
+
+def _discDilateShift(dx, Z, r):
+    """
+    Dilation of each row of Z by the upper semicircle of radius r sampled every dx,
+    one shifted maximum for each sample of the semicircle, see _discDilateRows()
+    """
+    Zi = np.where(np.isnan(Z), -np.inf, Z)
+    out = Zi + r
+    for t in range(1, min(int(r // dx), Z.shape[1] - 1) + 1):
+        b = np.sqrt(r ** 2 - (t * dx) ** 2)
+        np.maximum(out[:, t:], Zi[:, :-t] + b, out=out[:, t:])
+        np.maximum(out[:, :-t], Zi[:, t:] + b, out=out[:, :-t])
+    return out
+
+
+def _discDilate(x, Z, r):
+    """
+    Dilation of a profile (or of each row of Z) by the upper semicircle of radius r,
+    see _discDilateRows(). Uniformly sampled rows with a short window use the
+    shifted maxima, cheaper up to about 100 samples in the window
+    """
+    Z = np.asarray(Z)
+    Z2 = np.atleast_2d(Z)
+    n = Z2.shape[1]
+    dx = np.diff(x)
+    w = int(np.ceil(r / np.mean(dx))) + 1 if n > 1 else 0
+    if n > 1 and w <= 100 and np.allclose(dx, dx[0]):
+        return _discDilateShift(dx[0], Z2, r).reshape(Z.shape)
+    return _discDilateRows(x, Z2, r).reshape(Z.shape)
+
+
+def _shiftMax(out, D, s):
+    """out = max(out, D shifted of +-s rows), in place"""
+    if s == 0:
+        np.maximum(out, D, out=out)
+    elif s < out.shape[0]:
+        np.maximum(out[s:], D[:-s], out=out[s:])
+        np.maximum(out[:-s], D[s:], out=out[:-s])
+
+
+def _ballDilate(x, dy, Z, r):
+    """
+    Dilation of the map Z by the upper half ball of radius r (ball centre convention),
+    NaNs are ignored. The ball is decomposed in the semicircles of radius
+    $\\sqrt{r^2 - s^2}$ of each row offset s, applied along the rows
+    """
+    out = np.full(Z.shape, -np.inf)
+    for s in range(int(r // dy) + 1):
+        rho = np.sqrt(r ** 2 - (s * dy) ** 2)
+        _shiftMax(out, _discDilate(x, Z, rho), s)
+    return out
+
+
+def _flatDilate(dx, dy, Z, r):
+    """
+    Dilation of the map Z by the flat disk of radius r, NaNs are ignored.
+    The disk is decomposed in the segments of each row offset
+    """
+    out = np.full(Z.shape, -np.inf)
+    for s in range(int(r // dy) + 1):
+        half = int(np.sqrt(r ** 2 - (s * dy) ** 2) // dx)
+        _shiftMax(out, _runMax(Z, 2 * half + 1, axis=1), s)
+    return out
+
+
+def _tiledRows(f, Z, halo, tile=256, workers=None):
+    """
+    Applies f to tiles of rows of Z (with halo rows on both sides) on a thread pool,
+    f must only depend on the rows within halo
+    """
+    H = Z.shape[0]
+
+    def run(i):
+        a, b = max(i - halo, 0), min(i + tile + halo, H)
+        return f(Z[a:b])[i - a: i - a + min(tile, H - i)]
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        return np.concatenate(list(ex.map(run, range(0, H, tile))), axis=0)
+
+
 class Filter:
     cutoff: float
 
@@ -296,6 +478,92 @@ class ProfileRegression(Filter):
         if bplt:
             Filter.plotEnvelope(obj.X0, obj.Z0, envelope)    
 
+class ProfileMorphological(Filter):
+    def __init__(self, radius, op='closing', element='disk'):
+        self.radius = radius
+        self.op = op
+        self.element = element
+
+    def applyFilter(self, obj: profile.Profile, bplt=False):
+        self.filter(obj, self.radius, self.op, self.element, bplt=bplt)
+
+    @staticmethod
+    def morph(x, z, radius, op='closing', element='disk'):
+        """
+        Morphological operation on the profile values ISO 16610-41
+
+        Parameters
+        ----------
+        x : np.array
+            The x values of the profile
+        z : np.array
+            The z values of the profile, NaNs are ignored
+        radius : float
+            The radius of the disk or the half length of the flat segment
+        op : str
+            'dilation', 'erosion', 'closing' or 'opening'
+        element : str
+            'disk' or 'flat' structuring element
+
+        Returns
+        -------
+        envelope : np.array
+            The result of the operation, NaN where z is NaN
+
+        Notes
+        -----
+        The disk is the semicircle $\\sqrt{r^2 - t^2} - r$ (a flat profile is not shifted),
+        the disk dilation is the upper envelope of the semicircles centred on the points and
+        is computed in O(n log n) whatever the radius, the flat element uses the
+        van Herk / Gil-Werman algorithm.
+        Disk dilation of 1e5 points (dx = 1): 0.07 s for r = 250, 1000 or 2500 against
+        0.3, 1.2 and 2.3 s of the sliding window maximum (TipCorrection.naive()).
+        """
+        if element == 'disk':
+            def dil(v): return _discDilate(x, v, radius) - radius
+        elif element == 'flat':
+            w = 2 * int(radius // np.mean(np.diff(x))) + 1
+            def dil(v): return _runMax(v, w)
+        else: raise Exception(f'{element} is not a valid structuring element')
+
+        def ero(v): return -dil(-v)
+        ops = {'dilation': [dil], 'erosion': [ero], 'closing': [dil, ero], 'opening': [ero, dil]}
+        if op not in ops: raise Exception(f'{op} is not a valid operation')
+
+        nan = np.isnan(z)
+        envelope = z
+        for f in ops[op]:
+            envelope = np.where(nan, np.nan, f(envelope))
+        return envelope
+
+    @staticmethod
+    def filter(obj: profile.Profile, radius, op='closing', element='disk', bplt=False):
+        """
+        Applies to a profile object a morphological filter ISO 16610-41,
+        the envelope is removed from the profile.
+
+        Parameters
+        ----------
+        obj : profile.Profile
+            The profile object on wich the filter is applied
+        radius : float
+            The radius of the disk or the half length of the flat segment
+        op : str
+            'dilation', 'erosion', 'closing' or 'opening'
+        element : str
+            'disk' or 'flat' structuring element
+        bplt: bool
+            Plots the envelope of the filter if true
+        """
+        envelope = ProfileMorphological.morph(obj.X, obj.Z, radius, op, element)
+        filtered = obj.Z - envelope
+
+        if bplt:
+            Filter.plotEnvelope(obj.X, obj.Z, envelope)
+
+        obj.Z = filtered
+
+
 class SurfaceGaussian(Filter):
     def __init__(self, cutoff):
         self.cutoff = cutoff
@@ -338,3 +606,93 @@ class SurfaceGaussian(Filter):
         # TODO: very hard to see if this works correctly from the topographies
         if bplt:
             Filter.plot3DEnvelope(obj.X0, obj.Y0, obj.Z0, envelope)
+
+
+class SurfaceMorphological(Filter):
+    def __init__(self, radius, op='closing', element='ball'):
+        self.radius = radius
+        self.op = op
+        self.element = element
+
+    def applyFilter(self, obj: surface.Surface, bplt=False):
+        self.filter(obj, self.radius, self.op, self.element, bplt=bplt)
+
+    @staticmethod
+    def morph(x, y, Z, radius, op='closing', element='ball', tile=256, workers=None):
+        """
+        Morphological operation on the surface values ISO 16610-81
+
+        Parameters
+        ----------
+        x, y : np.array
+            The axes of the surface (uniform sampling)
+        Z : np.ndarray
+            The z values of the surface, NaNs are ignored
+        radius : float
+            The radius of the ball or of the flat disk
+        op : str
+            'dilation', 'erosion', 'closing' or 'opening'
+        element : str
+            'ball' or 'flat' (disk) structuring element
+        tile : int
+            Number of rows processed by each thread
+        workers : int
+            Number of threads, if None the executor default is used
+
+        Returns
+        -------
+        envelope : np.ndarray
+            The result of the operation, NaN where Z is NaN
+
+        Notes
+        -----
+        The ball is $\\sqrt{r^2 - t^2 - s^2} - r$ (a flat surface is not shifted).
+        Both elements are decomposed in their rows: each row offset is a 1D operation along
+        the rows of the map, the semicircle envelope for the ball, the van Herk / Gil-Werman
+        running maximum for the flat disk. The rows are processed in tiles on a thread pool.
+        """
+        dx, dy = np.abs(x[1] - x[0]), np.abs(y[1] - y[0])
+        halo = int(radius // dy)
+        if element == 'ball':
+            def dil1(v): return _ballDilate(x, dy, v, radius) - radius
+        elif element == 'flat':
+            def dil1(v): return _flatDilate(dx, dy, v, radius)
+        else: raise Exception(f'{element} is not a valid structuring element')
+
+        def dil(v): return _tiledRows(dil1, v, halo, tile, workers)
+        def ero(v): return -dil(-v)
+        ops = {'dilation': [dil], 'erosion': [ero], 'closing': [dil, ero], 'opening': [ero, dil]}
+        if op not in ops: raise Exception(f'{op} is not a valid operation')
+
+        nan = np.isnan(Z)
+        envelope = Z
+        for f in ops[op]:
+            envelope = np.where(nan, np.nan, f(envelope))
+        return envelope
+
+    @staticmethod
+    def filter(obj: surface.Surface, radius, op='closing', element='ball', bplt=False):
+        """
+        Applies to a surface object a morphological filter ISO 16610-81,
+        the envelope is removed from the surface.
+
+        Parameters
+        ----------
+        obj : surface.Surface
+            The surface object on wich the filter is applied
+        radius : float
+            The radius of the ball or of the flat disk
+        op : str
+            'dilation', 'erosion', 'closing' or 'opening'
+        element : str
+            'ball' or 'flat' (disk) structuring element
+        bplt: bool
+            Plots the envelope of the filter if true
+        """
+        envelope = SurfaceMorphological.morph(obj.x, obj.y, obj.Z, radius, op, element)
+        filtered = obj.Z - envelope
+
+        if bplt:
+            Filter.plot3DEnvelope(obj.X, obj.Y, obj.Z, envelope)
+
+        obj.Z = filtered
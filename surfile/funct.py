@@ -12,8 +12,11 @@ import os
 import matplotlib.pyplot as plt
 import csv
 import json
+import dataclasses
 
 import numpy as np
+from scipy import ndimage, sparse
+from scipy.sparse.linalg import spsolve
 
 
 class Bcol:
@@ -76,6 +79,350 @@ def nan_helper(y):
     return np.isnan(y), lambda z: z.nonzero()[0]
 
 
+def inpaintNaN(Z, maxSize=None):
+    """
+    Fills the NaNs of an array with the solution of the Laplace equation
+    (harmonic inpainting), the valid points around each NaN region are the boundary
+    conditions and the array borders have zero normal derivative
+
+    Parameters
+    ----------
+    Z : np.ndarray
+        The array (1D profile or 2D map) with NaNs
+    maxSize : int
+        The NaN regions (ndimage.label) with more than maxSize points are not filled,
+        if None all the regions are filled
+
+    Returns
+    -------
+    Z : np.ndarray
+        The filled copy of the array
+
+    Notes
+    -----
+    The sparse system has one unknown for each point to be filled and the stencil
+    involves only the nearest neighbours: the cost does not depend on the number of
+    valid points. In 1D the result is the linear interpolation of the gap.
+    """
+    Z = np.array(Z, dtype=float)
+    nans = np.isnan(Z)
+    if not np.any(nans): return Z
+    if np.all(nans): raise Exception('The array has no valid points')
+
+    if maxSize is not None:
+        lab, _ = ndimage.label(nans)
+        size = np.bincount(lab.ravel())
+        size[0] = 0
+        nans = size[lab] <= maxSize
+        nans &= lab > 0
+
+    idx = np.flatnonzero(nans)
+    m = idx.size
+    if m == 0: return Z
+    unk = np.full(Z.size, -1)
+    unk[idx] = np.arange(m)
+    coords = np.unravel_index(idx, Z.shape)
+    z = Z.reshape(-1)
+
+    # deg * z_p - sum of the neighbours = 0, the valid neighbours go to the right side
+    deg, b = np.zeros(m), np.zeros(m)
+    rows, cols = [], []
+    for ax in range(Z.ndim):
+        for step in (-1, 1):
+            c = coords[ax] + step
+            ok = np.flatnonzero((c >= 0) & (c < Z.shape[ax]))
+            nb = list(coords)
+            nb[ax] = c
+            q = np.ravel_multi_index(tuple(a[ok] for a in nb), Z.shape)
+            deg[ok] += 1
+            j = unk[q]
+            rows.append(ok[j >= 0])
+            cols.append(j[j >= 0])
+            np.add.at(b, ok[j < 0], z[q[j < 0]])
+
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    A = sparse.csr_matrix((np.r_[deg, -np.ones(rows.size)], (np.r_[np.arange(m), rows], np.r_[np.arange(m), cols])),
+                          shape=(m, m))
+    z[idx] = spsolve(A, b)
+    return Z
+
+
+class HeightSketch:
+    """
+    Mergeable streaming sketch of a height distribution, combines a fine
+    fixed-bin histogram with a t-digest style set of centroids.
+    The sketch is built chunk by chunk, so it can be computed on memmapped or
+    tiled topographies, merged across files and queried for any bin layout
+    without rescanning the data.
+
+    Example
+    -------
+    >>> sk = funct.HeightSketch.fromArray(sur.Z)
+    >>> sk.merge(funct.HeightSketch.fromArray(sur2.Z))
+    >>> hist, edges = sk.histogram(sk.binsFD())
+    >>> q1, q3 = sk.quantile([0.25, 0.75])
+    """
+    def __init__(self, nbins=2 ** 14, delta=200):
+        """
+        Parameters
+        ----------
+        nbins : int
+            Number of bins of the fine histogram
+        delta : float
+            Compression of the digest, the number of centroids is about delta / 2
+        """
+        self.nbins = nbins
+        self.delta = delta
+
+        # the bins lie on the global grid of width 2 ** e, the first one has index i0
+        self.counts = np.zeros(nbins, dtype=np.int64)
+        self.e = None
+        self.i0 = 0
+
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def width(self):
+        return 2.0 ** self.e
+
+    @property
+    def lo(self):
+        return self.i0 * self.width
+
+    def _grid(self, zmin, zmax, e):
+        # coarsest needed grid: the bin width is doubled until the range fits in the bins
+        while np.floor(zmax / 2.0 ** e) - np.floor(zmin / 2.0 ** e) >= self.nbins: e += 1
+        return e, int(np.floor(zmin / 2.0 ** e))
+
+    def _regrid(self, e, i0):
+        # moves the counts on a coarser (or shifted) grid, bins are merged in dyadic groups
+        j = np.nonzero(self.counts)[0]
+        if j.size > 0:
+            k = ((self.i0 + j) >> (e - self.e)) - i0
+            self.counts = np.bincount(k, weights=self.counts[j], minlength=self.nbins).astype(np.int64)
+        self.e, self.i0 = e, i0
+
+    def _cover(self, zmin, zmax):
+        zmin, zmax = min(self.min, zmin), max(self.max, zmax)
+        if self.e is None:
+            ext = zmax - zmin if zmax > zmin else max(abs(zmax), 1.0) * 2.0 ** -30
+            self.e = int(np.ceil(np.log2(ext / self.nbins)))
+            self.e, self.i0 = self._grid(zmin, zmax, self.e)
+            return
+        w = self.width
+        if np.floor(zmin / w) < self.i0 or np.floor(zmax / w) >= self.i0 + self.nbins:
+            self._regrid(*self._grid(zmin, zmax, self.e))
+
+    def _compress(self, means, weights):
+        # assigns the sorted centroids to the unit intervals of the k1 scale function
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        cum = np.cumsum(weights)
+        q = (cum - weights / 2) / cum[-1]
+        k = np.floor(self.delta / (2 * np.pi) * np.arcsin(2 * q - 1)).astype(int)
+        _, idx = np.unique(k, return_inverse=True)
+        w = np.bincount(idx, weights=weights)
+        self.means = np.bincount(idx, weights=means * weights) / w
+        self.weights = w
+
+    def update(self, z):
+        """
+        Adds a chunk of heights to the sketch, NaNs are ignored
+
+        Parameters
+        ----------
+        z : np.ndarray
+            The heights
+
+        Returns
+        -------
+        self : HeightSketch
+        """
+        z = np.asarray(z, dtype=float).ravel()
+        z = z[np.isfinite(z)]
+        if z.size == 0: return self
+
+        zmin, zmax = z.min(), z.max()
+        self._cover(zmin, zmax)
+        idx = np.clip(((z - self.lo) / self.width).astype(np.int64), 0, self.nbins - 1)
+        self.counts += np.bincount(idx, minlength=self.nbins)
+
+        self._compress(np.r_[self.means, z], np.r_[self.weights, np.ones(z.size)])
+
+        self.count += z.size
+        self.min, self.max = min(self.min, zmin), max(self.max, zmax)
+        return self
+
+    @staticmethod
+    def fromArray(z, rows=256, nbins=2 ** 14, delta=200):
+        """
+        Builds the sketch of an array scanning it in blocks of rows,
+        memmapped arrays are never loaded entirely in memory
+
+        Parameters
+        ----------
+        z : np.ndarray
+            The heights (a topography or a profile)
+        rows : int
+            The number of rows processed at each step
+        nbins : int
+            Number of bins of the fine histogram
+        delta : float
+            Compression of the digest
+
+        Returns
+        -------
+        sketch : HeightSketch
+        """
+        sk = HeightSketch(nbins=nbins, delta=delta)
+        z = np.atleast_2d(z)
+        for i in range(0, z.shape[0], rows):
+            sk.update(z[i:i + rows])
+        return sk
+
+    def merge(self, other):
+        """
+        Merges another sketch into this one
+
+        Parameters
+        ----------
+        other : HeightSketch
+            The sketch to be merged, the number of bins of this sketch is kept
+            (other can have a different number of bins)
+
+        Returns
+        -------
+        self : HeightSketch
+        """
+        if other.count == 0: return self
+
+        # grid of this sketch (self.nbins bins) covering both ranges, never finer than the two grids
+        if self.count == 0:
+            e, i0 = self._grid(other.min, other.max, other.e)
+        else:
+            e, i0 = self._grid(min(self.min, other.min), max(self.max, other.max), max(self.e, other.e))
+        self._regrid(e, i0)
+
+        # the counts of other are moved on the same grid, other can have a different number of bins
+        j = np.nonzero(other.counts)[0]
+        k = ((other.i0 + j) >> (e - other.e)) - i0
+        self.counts += np.bincount(k, weights=other.counts[j], minlength=self.nbins).astype(np.int64)
+
+        self._compress(np.r_[self.means, other.means], np.r_[self.weights, other.weights])
+        self.count += other.count
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        return self
+
+    def cdf(self, z):
+        """
+        Evaluates the cumulative counts of the fine histogram
+
+        Parameters
+        ----------
+        z : np.ndarray
+            The heights
+
+        Returns
+        -------
+        cum : np.ndarray
+            Number of samples below z, linearly interpolated inside the bins
+        """
+        edges = self.lo + self.width * np.arange(self.nbins + 1)
+        cum = np.r_[0, np.cumsum(self.counts)]
+        return np.interp(z, edges, cum)
+
+    def quantile(self, q, method='hist'):
+        """
+        Estimates the quantiles of the heights
+
+        Parameters
+        ----------
+        q : float or np.ndarray
+            The quantiles in [0, 1]
+        method : str
+            'hist' inverts the fine histogram (error below one fine bin width),
+            'digest' uses the centroids, the accuracy does not depend on the
+            range of the data (use with outliers that stretch the histogram)
+
+        Returns
+        -------
+        z : float or np.ndarray
+            The heights at the quantiles
+        """
+        if self.count == 0: return np.full(np.shape(q), np.nan)
+        q = np.asarray(q, dtype=float)
+        if method == 'digest':
+            cum = np.cumsum(self.weights) - self.weights / 2
+            pos = np.r_[0, cum, self.count]
+            val = np.r_[self.min, self.means, self.max]
+            return np.interp(q * self.count, pos, val)
+        elif method == 'hist':
+            edges = self.lo + self.width * np.arange(self.nbins + 1)
+            cum = np.r_[0, np.cumsum(self.counts)]
+            z = np.interp(q * self.count, cum, edges)
+            return np.clip(z, self.min, self.max)
+        raise Exception(f'{method} is not a valid quantile method')
+
+    def iqr(self):
+        """
+        Returns
+        -------
+        iqr : float
+            The interquartile range of the heights
+        """
+        q1, q3 = self.quantile([0.25, 0.75])
+        return q3 - q1
+
+    def binsFD(self):
+        """
+        Returns
+        -------
+        bins : int
+            The number of bins according to the Freedman-Diaconis rule
+        """
+        bw = 2 * self.iqr() / (self.count ** (1 / 3))
+        if not bw > 0: return max(int(np.sqrt(self.count)), 1)
+        return max(int(np.ceil((self.max - self.min) / bw)), 1)
+
+    def histogram(self, bins=10, range=None):
+        """
+        Histogram of the heights with an arbitrary bin layout, the counts
+        are obtained from the fine histogram without rescanning the data
+
+        Parameters
+        ----------
+        bins : int or np.array
+            The number of bins or the bin edges (as np.histogram)
+        range : (float, float)
+            The range of the bins, defaults to (min, max) of the heights
+
+        Returns
+        -------
+        hist : np.array
+            The counts in each bin
+        edges : np.array
+            The bin edges
+        """
+        if np.ndim(bins) == 0:
+            lo, hi = (self.min, self.max) if range is None else range
+            if hi <= lo: lo, hi = lo - 0.5, hi + 0.5
+            edges = np.linspace(lo, hi, int(bins) + 1)
+        else:
+            edges = np.asarray(bins, dtype=float)
+
+        if self.count == 0: return np.zeros(edges.size - 1, dtype=np.int64), edges
+
+        cum = np.rint(self.cdf(edges)).astype(np.int64)
+        cum[edges <= self.min] = 0
+        cum[edges >= self.max] = self.count  # the last bin is closed as in np.histogram
+        return np.diff(cum), edges
+
+
 def options(csvPath=None, save=None, bplt=False, chrono=False):
     """
     Decorator that implements global configurations
@@ -83,7 +430,8 @@ def options(csvPath=None, save=None, bplt=False, chrono=False):
     Parameters
     ----------
     csvPath: str
-        If not none saves the return parameters of the decorated function to a csv
+        If not none saves the return parameters of the decorated function to a csv,
+        dataclass results are appended as a row with the field names as header
     save: str
         If not none saves the figures in the path
     bplt: bool
@@ -107,7 +455,15 @@ def options(csvPath=None, save=None, bplt=False, chrono=False):
             # exec the function
             ret = func(*args, **kwargs)
 
-            if csvPath is not None:  # save the return parameters
+            if csvPath is not None and dataclasses.is_dataclass(ret):  # structured results, one row per call
+                row = dataclasses.asdict(ret)
+                header = not os.path.isfile(f"{csvPath}.csv")
+                with open(f"{csvPath}.csv", 'a', newline='') as csvfile:
+                    writer = csv.DictWriter(csvfile, fieldnames=list(row), dialect='excel')
+                    if header: writer.writeheader()
+                    writer.writerow(row)
+
+            elif csvPath is not None:  # save the return parameters
                 try:
                     for i, xy in enumerate(ret):
                         np.savetxt(f"{csvPath}{func.__name__}_{rcs.currentImage}_{str(i)}.csv",
@@ -24,6 +24,7 @@ features present in the image borders.
 """
 
 import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 from matplotlib import cm
 from scipy import integrate, optimize
@@ -57,18 +58,152 @@ def _polyval2d(x, y, coeffs):
     -------
     z : numpy.ndarray
         (shape1) polynomial coefficients evaluated at (y,x).
+
+    Notes
+    -----
+    Nested Horner scheme: $z = \\sum_j y^j \\sum_i c_{j,i} x^i$, no powers are computed
+    and only two temporaries of the size of the data are used.
     """
-    s = x.shape
     coeffs = np.array(coeffs)
-    ny, nx = coeffs.shape
-    z = np.zeros(s)
-    for c, (j, i) in zip(coeffs.ravel(), itertools.product(range(ny), range(nx))):
-        if c == 0:
-            continue
-        z += c * (x ** i) * (y ** j)
+    z = np.zeros(np.broadcast(x, y).shape)
+    for row in coeffs[::-1]:  # horner in y
+        zx = np.zeros_like(z)
+        for c in row[::-1]:  # horner in x
+            zx *= x
+            zx += c
+        z *= y
+        z += zx
     return z
 
 
+def _polyTerms(kx, ky, full):
+    """
+    Returns the list of (j, i) exponents (y, x) used by the 2D polynomial
+    and if the full matrix is used
+    """
+    nx, ny = kx + 1, ky + 1
+    full |= kx != ky  # if they are different -> full matrix
+    loop = list(itertools.product(range(ny), range(nx)))
+    if not full:  # calculate only upper left part of matrix
+        loop = [(j, i) for (j, i) in loop if i <= (ky - j)]
+    return loop, full
+
+
+def _normCoords(v):
+    """Affine map (offset, scale) of the range of v to [-1, 1]"""
+    lo, hi = np.nanmin(v), np.nanmax(v)
+    return (hi + lo) / 2, ((hi - lo) / 2) or 1
+
+
+def _legNormalEq(x, y, z, keep, loop, nx, ny, rows=256):
+    """
+    Accumulates the normal equations of the 2D Legendre fit in tiles of rows
+
+    Parameters
+    ----------
+    x, y, z : np.ndarray
+        The normalized coordinates (in [-1, 1]) and the heights, 2D or 1D
+    keep : np.ndarray
+        Mask of the points used in the fit
+    loop : list
+        The (j, i) terms of the fit, see _polyTerms()
+    nx, ny : int
+        Number of coefficients in x and y
+    rows : int
+        Number of rows of each tile
+
+    Returns
+    -------
+    N, b : np.ndarray, np.ndarray
+        A^T A (terms, terms) and A^T z (terms,)
+    """
+    x, y, z, keep = np.atleast_2d(x), np.atleast_2d(y), np.atleast_2d(z), np.atleast_2d(keep)
+    jj, ii = np.array(loop).T
+    N = np.zeros((len(loop), len(loop)))
+    b = np.zeros(len(loop))
+    for r in range(0, z.shape[0], rows):
+        k = keep[r:r + rows]
+        Lx = np.polynomial.legendre.legvander(x[r:r + rows][k], nx - 1)
+        Ly = np.polynomial.legendre.legvander(y[r:r + rows][k], ny - 1)
+        A = Ly[:, jj] * Lx[:, ii]  # tile of the design matrix
+        N += A.T @ A
+        b += A.T @ z[r:r + rows][k]
+    return N, b
+
+
+def _gridAxes(X, Y):
+    """
+    Returns the x and y axes if X, Y are a rectangular grid (as built
+    by np.meshgrid), otherwise None
+    """
+    if X.ndim != 2 or X.shape != Y.shape: return None
+    if np.all(X == X[0]) and np.all(Y == Y[:, [0]]):
+        return X[0], Y[:, 0]
+    return None
+
+
+def _legNormalEqGrid(x, y, z, keep, loop, nx, ny):
+    """
+    Normal equations of the 2D Legendre fit on a grid, see _legNormalEq()
+
+    Parameters
+    ----------
+    x, y : np.array
+        The normalized axes of the grid
+    z : np.ndarray
+        (y.size, x.size) the heights
+    keep : np.ndarray
+        Mask of the points used in the fit
+
+    Returns
+    -------
+    N, b : np.ndarray, np.ndarray
+        A^T A (terms, terms) and A^T z (terms,), None if the mask is
+        not separable (not made of complete rows and columns)
+
+    Notes
+    -----
+    On a grid the design matrix is $L_y \\otimes L_x$ so $A^T A = G_y \\otimes G_x$
+    with $G = L^T L$ and $A^T z = L_y^T Z L_x$: only 1D Vandermonde matrices are built.
+    """
+    rk, ck = np.any(keep, axis=1), np.any(keep, axis=0)
+    if np.count_nonzero(keep) != np.count_nonzero(rk) * np.count_nonzero(ck): return None
+    Lx = np.polynomial.legendre.legvander(x[ck], nx - 1)
+    Ly = np.polynomial.legendre.legvander(y[rk], ny - 1)
+
+    jj, ii = np.array(loop).T
+    Gx, Gy = Lx.T @ Lx, Ly.T @ Ly
+    N = Gy[np.ix_(jj, jj)] * Gx[np.ix_(ii, ii)]
+    b = (Ly.T @ z[np.ix_(rk, ck)] @ Lx)[jj, ii]
+    return N, b
+
+
+def _legMat(n):
+    """(n, n) matrix, the columns are the power coefficients of the Legendre polynomials"""
+    return np.array([np.pad(np.polynomial.legendre.leg2poly(np.eye(n)[i]), (0, n - i - 1)) for i in range(n)]).T
+
+
+def _affMat(n, o, s):
+    """(n, n) matrix, the columns are the power coefficients in x of ((x - o) / s)^i"""
+    return np.array([np.pad(np.polynomial.polynomial.polypow([-o / s, 1 / s], i), (0, n - i - 1))
+                     for i in range(n)]).T
+
+
+def _leg2poly2d(C):
+    """Converts the 2D Legendre coefficients C (ny, nx) to power coefficients"""
+    ny, nx = C.shape
+    return _legMat(ny) @ C @ _legMat(nx).T
+
+
+def _unnorm2d(P, x0, sx, y0, sy):
+    """
+    Converts the power coefficients P (ny, nx) in the normalized coordinates
+    u = (x - x0) / sx, v = (y - y0) / sy to the power coefficients in x, y
+    """
+    ny, nx = P.shape
+    return _affMat(ny, y0, sy) @ P @ _affMat(nx, x0, sx).T
+
+
 class FormEstimator:
     """
     Base class for form fitting operations contains the methods 
@@ -339,7 +474,7 @@ class ProfilePolynomial(FormEstimator):
         elif bound is True:
             bound = np.mean(z)
             ind = np.argwhere(comp(z, bound)).ravel()
-            coeff = np.polyfit(x[ind], x[ind], degree)
+            coeff = np.polyfit(x[ind], z[ind], degree)
         else:
             ind = np.argwhere(comp(z, bound)).ravel()
             coeff = np.polyfit(x[ind], z[ind], degree)
@@ -350,6 +485,96 @@ class ProfilePolynomial(FormEstimator):
         obj.Z = FormEstimator.removeForm(obj.X, obj.Z, coeff)
         return coeff
 
+    @staticmethod
+    def batchFit(x, Z, degree, mask=None):
+        """
+        Polynomial fit of a stack of profiles sampled on the same x
+
+        Parameters
+        ----------
+        x : np.array
+            (samples,) the x values shared by the profiles
+        Z : np.ndarray
+            (profiles, samples) the z values, NaNs are not used in the fit
+        degree : int
+            polynomial degree
+        mask : np.ndarray, optional
+            (profiles, samples) boolean mask of the points used in the fit
+            (e.g. comp(Z, bound)), if None all the valid points are used
+
+        Returns
+        -------
+        coeff : np.ndarray
+            (profiles, degree + 1) the coefficients of each profile, highest
+            power first as in np.polyfit, NaN if the profile has too few points
+        resid : np.ndarray
+            (profiles, samples) the profiles with the form removed
+
+        Notes
+        -----
+        The fit is done in a Legendre basis on x normalized to [-1, 1].
+        The complete profiles share a single pseudo-inverse of the Vandermonde matrix,
+        the profiles with missing points are solved together with a batched solve of
+        their (degree + 1, degree + 1) normal equations.
+        """
+        Z = np.atleast_2d(Z)
+        keep = np.isfinite(Z) if mask is None else np.isfinite(Z) & mask
+        x0, sx = _normCoords(x)
+        V = np.polynomial.legendre.legvander((x - x0) / sx, degree)
+        n = degree + 1
+
+        C = np.full((Z.shape[0], n), np.nan)
+        full = np.all(keep, axis=1)
+        if np.any(full):  # shared pseudo-inverse
+            C[full] = Z[full] @ np.linalg.pinv(V).T
+
+        part = ~full & (np.count_nonzero(keep, axis=1) >= n)
+        if np.any(part):  # weighted normal equations of all the profiles in one product
+            W = keep[part].astype(float)
+            N = (W @ (V[:, :, None] * V[:, None, :]).reshape(-1, n * n)).reshape(-1, n, n)
+            b = np.where(keep[part], Z[part], 0) @ V
+            C[part] = np.linalg.solve(N, b[..., None])[..., 0]
+
+        resid = Z - C @ V.T
+        coeff = (_affMat(n, x0, sx) @ _legMat(n) @ C.T).T[:, ::-1]  # power basis of x, highest first
+        return coeff, resid
+
+    @staticmethod
+    def levelRows(obj: surface.Surface, degree=1, comp=lambda a, b: a < b, bound=None, bplt=False):
+        """
+        Removes the polynomial form from each row of the surface
+
+        Parameters
+        ----------
+        obj : surface.Surface
+            The surface object on wich the form is removed
+        degree : int
+            polynomial degree
+        comp : funct / lambda
+            comparison method between bound and surface
+        bound : float
+            -if not set the fit uses all points,
+            -if set the fit uses all points below the value,
+            -if set to True the fit uses only the values below the average value of each row
+        bplt : bool
+            If True plots the leveled surface
+
+        Returns
+        -------
+        coeff : np.ndarray
+            (rows, degree + 1) the polynomial coefficients of each row
+        """
+        mask = None
+        if bound is True:
+            bound = np.nanmean(obj.Z, axis=1, keepdims=True)
+        if bound is not None:
+            with np.errstate(invalid='ignore'):
+                mask = comp(obj.Z, bound)
+
+        coeff, obj.Z = ProfilePolynomial.batchFit(obj.x, obj.Z, degree, mask=mask)
+        if bplt: obj.pltC()
+        return coeff
+
 
 class Circle(FormEstimator):
     """
@@ -655,6 +880,12 @@ class SurfacePolynomial(FormEstimator):
         [\\vdots,  \\ddots,  \\textcolor{red}{\\vdots}]
         [m_{ky,0},  \\textcolor{red}{\cdots},  \\textcolor{red}{m_{kx,ky}}]
         ]$.
+
+        The fit is computed in a Legendre basis on the coordinates normalized to [-1, 1]:
+        the normal equations are accumulated in tiles of rows so the memory used
+        is O(terms^2), the returned coefficients are converted to the power basis.
+        When the points are a grid with complete rows and columns the problem is separable
+        and only 1D Vandermonde matrices are used, otherwise the general tiled solver is used.
         """
         if cutter is True:
             _, (x, y, z) = cutr.SurfaceCutter.cut(obj, finalize=False)
@@ -663,48 +894,43 @@ class SurfacePolynomial(FormEstimator):
         else:
             x, y, z = obj.X, obj.Y, obj.Z
 
-        x, y, z,  = x.ravel(), y.ravel(), z.ravel()
-
         if bound is True:
             bound = np.nanmean(obj.Z)  # set the bound to the mean point
 
         nx, ny = kx + 1, ky + 1
-        full |= kx != ky  # if they are different -> full matrix
-        loop = list(itertools.product(range(ny), range(nx)))
-
-        if not full:  # calculate only upper left part of matrix
-            loop2 = []
-            for (j, i) in loop:
-                if i <= (ky - j):
-                    loop2.append((j, i))
-            loop = loop2
-        a = np.zeros((x.size, len(loop)))
-        for k, (j, i) in enumerate(loop):
-            a[:, k] = (x ** i) * (y ** j)
-
-        # remove nan values
-        indexes = ~np.isnan(z)
-        z = z[indexes]
-        a = a[indexes]
+        loop, full = _polyTerms(kx, ky, full)
 
+        keep = np.isfinite(z)  # nan values are not used
         if bound is not None:  # remove z limited values in comp direction
-            keep = comp(z, bound)
-            z = z[keep]
-            a = a[keep]
-
-        sol, _, _, _ = np.linalg.lstsq(a, z, rcond=None)
-
-        if full:
-            coeffs = sol.reshape((ny, nx))
-        else:
-            coeffs = np.zeros((ny, nx))
-            for c, (j, i) in zip(sol, loop):
-                coeffs[j, i] = c
+            keep[keep] = comp(z[keep], bound)
+
+        # fit in the Legendre basis on the coordinates normalized on the surface
+        (x0, sx), (y0, sy) = _normCoords(obj.X), _normCoords(obj.Y)
+        grid = _gridAxes(x, y)
+        Nb = None
+        if grid is not None:  # separable fast path (no mask or complete rows / columns)
+            Nb = _legNormalEqGrid((grid[0] - x0) / sx, (grid[1] - y0) / sy, z, keep, loop, nx, ny)
+        if Nb is None:
+            Nb = _legNormalEq((x - x0) / sx, (y - y0) / sy, z, keep, loop, nx, ny)
+        sol, _, _, _ = np.linalg.lstsq(*Nb, rcond=None)
+
+        C = np.zeros((ny, nx))
+        for c, (j, i) in zip(sol, loop):
+            C[j, i] = c
+        Cn = _leg2poly2d(C)  # power basis on the normalized coordinates
+        coeffs = _unnorm2d(Cn, x0, sx, y0, sy)
 
         if bplt:
             FormEstimator.plot3DForm(obj.X, obj.Y, obj.Z, coeffs)
 
-        obj.Z = FormEstimator.remove3DForm(obj.X, obj.Y, obj.Z, coeffs)
+        # the form is evaluated on the normalized coordinates to avoid the round-off of large powers
+        grid = _gridAxes(obj.X, obj.Y)
+        if grid is not None:  # separable evaluation Vy C Vx^T
+            Vx = np.polynomial.polynomial.polyvander((grid[0] - x0) / sx, kx)
+            Vy = np.polynomial.polynomial.polyvander((grid[1] - y0) / sy, ky)
+            obj.Z = obj.Z - Vy @ Cn @ Vx.T
+        else:
+            obj.Z = obj.Z - _polyval2d((obj.X - x0) / sx, (obj.Y - y0) / sy, Cn)
         return coeffs
 
 
@@ -789,13 +1015,88 @@ class Surface3Points(FormEstimator):
         plt.show()
 
 
+def _sphereNormalEq(X, Y, Z, ref, inlier=None, rows=256):
+    """
+    Accumulates the 4x4 normal equations of the algebraic sphere fit
+    in blocks of rows, the design matrix is never formed
+
+    Parameters
+    ----------
+    X, Y, Z : np.ndarray
+        The coordinates of the points (2D maps or 1D arrays), NaNs are skipped
+    ref : np.array
+        (3,) reference point subtracted from the coordinates (conditioning)
+    inlier : function
+        If not None, inlier(x, y, z) returns the mask of the points to be used
+    rows : int
+        Number of rows processed at each step
+
+    Returns
+    -------
+    C : np.array
+        (4,) solution [xc, yc, zc, r^2 - xc^2 - yc^2 - zc^2] in the reference frame
+    n : int
+        Number of points used
+    """
+    X, Y, Z = np.atleast_2d(X), np.atleast_2d(Y), np.atleast_2d(Z)
+    N = np.zeros((4, 4))
+    b = np.zeros(4)
+    n = 0
+    for i in range(0, Z.shape[0], rows):
+        z = Z[i:i + rows]
+        m = np.isfinite(z)
+        x, y, z = X[i:i + rows][m] - ref[0], Y[i:i + rows][m] - ref[1], z[m] - ref[2]
+        if inlier is not None:
+            k = inlier(x, y, z)
+            x, y, z = x[k], y[k], z[k]
+        A = np.c_[2 * x, 2 * y, 2 * z, np.ones_like(x)]  # block of the design matrix
+        N += A.T @ A
+        b += A.T @ (x * x + y * y + z * z)
+        n += x.size
+    return np.linalg.solve(N, b), n
+
+
+def _sphereRansac(P, iters, threshold, rng):
+    """
+    RANSAC on the points P (N, 3): spheres through 4 random points, the one
+    with most points within threshold from its surface is returned.
+    If threshold is None the candidate with the least median residual is
+    chosen (LMedS) and the threshold is 3 times its robust standard deviation
+
+    Returns
+    -------
+    C : np.array
+        (4,) the best candidate [xc, yc, zc, r^2 - xc^2 - yc^2 - zc^2]
+    threshold : float
+        The inlier threshold
+    """
+    idx = rng.integers(0, P.shape[0], size=(iters, 4))
+    Q = P[idx]  # (iters, 4, 3)
+    A = np.concatenate([2 * Q, np.ones((iters, 4, 1))], axis=2)
+    f = np.sum(Q ** 2, axis=2)
+
+    ok = np.abs(np.linalg.det(A)) > 1e-12 * np.max(np.abs(A)) ** 4  # skip degenerate samples
+    if not np.any(ok): raise Exception('RANSAC did not find a valid sphere candidate')
+    C = np.linalg.solve(A[ok], f[ok][..., None])[..., 0]  # (k, 4)
+    r = np.sqrt(np.maximum(np.sum(C[:, :3] ** 2, axis=1) + C[:, 3], 0))
+
+    score = np.zeros(C.shape[0])
+    for j in range(0, C.shape[0], 32):  # limits the (candidates, points) temporary
+        e = np.abs(np.linalg.norm(P[None, :, :] - C[j:j + 32, None, :3], axis=2) - r[j:j + 32, None])
+        score[j:j + 32] = np.median(e, axis=1) if threshold is None else -np.count_nonzero(e < threshold, axis=1)
+    best = np.argmin(score)
+    if threshold is None: threshold = 3 * 1.4826 * score[best]
+    return C[best], threshold
+
+
 class Sphere(FormEstimator):
     """
     Class derived from FormEstimator for the removal of the
     least square sphere
     """
     @staticmethod
-    def formFit(obj: surface.Surface, finalize=True, radius=None, concavity=None, bplt=False):
+    def formFit(obj: surface.Surface, finalize=True, radius=None, concavity=None, method='lsq',
+                threshold=None, iters=500, subsample=20000, seed=None, bplt=False):
         """
         Calculates the least square sphere
 
@@ -812,6 +1113,20 @@ class Sphere(FormEstimator):
         concavity : str
             Can be either 'convex' or 'concave'
             If set to None the program will find the concavity of the sample
+        method : str
+            'lsq': least square sphere of all the points
+            'ransac': the sphere is found with RANSAC on a subsample of the points
+            and refined with the least square fit of its inliers
+        threshold : float
+            RANSAC only, maximum distance of the inliers from the sphere, if None the
+            candidate with the least median residual is used and the threshold is 3 times
+            its robust standard deviation
+        iters : int
+            RANSAC only, number of 4 point candidates
+        subsample : int
+            RANSAC only, maximum number of points used to score the candidates
+        seed : int
+            RANSAC only, seed of the random generator
         bplt : bool
             Plots the sphere fitted to the data points
 
@@ -826,29 +1141,34 @@ class Sphere(FormEstimator):
         
         Expanding the equation we get: $x^2+y^2+z^2=2xx_c+2yy_c+2zz_c+r^2-x_c^2-y_c^2-z_c^2$        
         We can solve for $x_c, y_c, z_c, r$
+
+        The 4x4 normal equations are accumulated in blocks of rows in coordinates
+        centred on the data, the full design matrix is never built.
         """
         if concavity not in [None, 'concave', 'convex']: raise Exception('Concavity is not valid')
-        #   Assemble the A matrix
-        spZ = obj.Z.flatten()
-        spX = obj.X.flatten()
-        spY = obj.Y.flatten()
-
-        nanind = ~np.isnan(spZ)
+        if method not in ['lsq', 'ransac']: raise Exception(f'{method} is not a valid method')
 
-        spZ = spZ[nanind]
-        spX = spX[nanind]
-        spY = spY[nanind]
+        # coordinates are referred to the centre of the data for conditioning
+        ref = np.array([np.mean(obj.X), np.mean(obj.Y), np.nanmean(obj.Z)])
 
-        A = np.zeros((len(spX), 4))
-        A[:, 0] = spX * 2
-        A[:, 1] = spY * 2
-        A[:, 2] = spZ * 2
-        A[:, 3] = 1
-
-        #   Assemble the f matrix
-        f = np.zeros((len(spX), 1))
-        f[:, 0] = (spX * spX) + (spY * spY) + (spZ * spZ)
-        C, _, _, _ = np.linalg.lstsq(A, f, rcond=None)
+        if method == 'lsq':
+            Cr, _ = _sphereNormalEq(obj.X, obj.Y, obj.Z, ref)
+        else:
+            rng = np.random.default_rng(seed)
+            valid = np.isfinite(obj.Z)
+            P = np.c_[obj.X[valid], obj.Y[valid], obj.Z[valid]] - ref
+            P = P[rng.choice(P.shape[0], min(subsample, P.shape[0]), replace=False)]
+            Cr, threshold = _sphereRansac(P, iters, threshold, rng)
+
+            # least square refinement on the inliers of the best candidate
+            for _ in range(2):
+                c, r = Cr[:3], np.sqrt(np.sum(Cr[:3] ** 2) + Cr[3])
+                inl = lambda x, y, z: np.abs(np.sqrt((x - c[0]) ** 2 + (y - c[1]) ** 2 + (z - c[2]) ** 2) - r) < threshold
+                Cr, _ = _sphereNormalEq(obj.X, obj.Y, obj.Z, ref, inlier=inl)
+
+        # back to the original coordinates, same layout of the lstsq solution
+        c = Cr[:3] + ref
+        C = np.r_[c, np.sum(Cr[:3] ** 2) + Cr[3] - np.sum(c ** 2)].reshape(4, 1)
 
         # radius = [radius]
         # solve for the radius
@@ -881,6 +1201,29 @@ class Sphere(FormEstimator):
 
         return radius, C
 
+    @staticmethod
+    def formFitStack(objs: list[surface.Surface], workers=None, **kwargs):
+        """
+        Fits the sphere on a list of surfaces in parallel
+
+        Parameters
+        ----------
+        objs : list[surface.Surface]
+            The surfaces on which the sphere fit is applied
+        workers : int
+            Number of threads, if None the executor default is used
+        **kwargs
+            Passed to Sphere.formFit(), bplt is always disabled
+
+        Returns
+        -------
+        res : list[(float, np.array)]
+            (radius, C) of each surface, see Sphere.formFit()
+        """
+        kwargs['bplt'] = False
+        with ThreadPoolExecutor(max_workers=workers) as ex:  # numpy releases the GIL in the reductions
+            return list(ex.map(lambda o: Sphere.formFit(o, **kwargs), objs))
+
 
 def _evalCyl(obj: surface.Surface, est_p, concavity):
     """
@@ -896,6 +1239,7 @@ def _evalCyl(obj: surface.Surface, est_p, concavity):
         P[2] = Zc, z coordinate of the cylinder centre
         P[3] = alpha_z, rotation angle (radian) about the z-axis
         P[4] = alpha_y, rotation angle (radian) about the y-axis
+        P[5] = Xc, x coordinate of the cylinder centre (0 if not present)
     concavity:
         Either 'concave' or 'convex'
 
@@ -907,25 +1251,131 @@ def _evalCyl(obj: surface.Surface, est_p, concavity):
     l = np.cos(est_p[3]) * np.cos(est_p[4])
     m = np.sin(est_p[3])
     n = np.cos(est_p[3]) * np.sin(est_p[4])
+    X = obj.X - (est_p[5] if len(est_p) > 5 else 0)
 
     A = 1 - n ** 2
-    B = -2 * n * (l * obj.X + m * (obj.Y - est_p[1]))
-    C = (1 - l ** 2) * obj.X ** 2 + \
+    B = -2 * n * (l * X + m * (obj.Y - est_p[1]))
+    C = (1 - l ** 2) * X ** 2 + \
         (1 - m ** 2) * (obj.Y - est_p[1]) ** 2 - \
-        2 * obj.X * l * m * (obj.Y - est_p[1]) - est_p[0] ** 2
+        2 * X * l * m * (obj.Y - est_p[1]) - est_p[0] ** 2
 
     delta = np.sqrt(B ** 2 - 4 * A * C) if concavity == 'convex' else -np.sqrt(B ** 2 - 4 * A * C)
 
     return (-B + delta) / (2 * A) + est_p[2]
 
 
+def _cylFrame(alphaZ, alphaY):
+    """
+    Orthonormal frame with the first axis along the cylinder axis direction
+    (alphaZ, alphaY), the columns are the axis and two perpendicular versors
+    """
+    d = np.array([np.cos(alphaZ) * np.cos(alphaY), np.sin(alphaZ), np.cos(alphaZ) * np.sin(alphaY)])
+    e2 = np.cross([0, 0, 1], d)
+    if np.linalg.norm(e2) < 1e-9: e2 = np.array([0., 1., 0.])  # vertical axis
+    e2 = e2 / np.linalg.norm(e2)
+    return np.c_[d, e2, np.cross(d, e2)]
+
+
+def _cylResid(q, L):
+    """
+    Radial residuals of the points L (3, N) expressed in the local frame,
+    q = [r, u, v, a, b]: the axis passes through (0, u, v) with direction (1, a, b)
+    """
+    g = np.array([1, q[3], q[4]])
+    d = g / np.linalg.norm(g)
+    w = L - np.array([[0], [q[1]], [q[2]]])
+    e = w - (d @ w) * d[:, None]  # component perpendicular to the axis
+    return np.sqrt(np.einsum('ij,ij->j', e, e)) - q[0]
+
+
+def _cylJac(q, L):
+    """Analytic jacobian (5, N) of _cylResid() with respect to q"""
+    g = np.array([1, q[3], q[4]])
+    ng = np.linalg.norm(g)
+    d = g / ng
+    w = L - np.array([[0], [q[1]], [q[2]]])
+    t = d @ w
+    e = w - t * d[:, None]
+    dist = np.sqrt(np.einsum('ij,ij->j', e, e))
+    n2, n3 = e[1] / dist, e[2] / dist  # components of the radial versor along the local y and z
+    return np.array([-np.ones_like(dist), -n2, -n3, -t * n2 / ng, -t * n3 / ng])
+
+
+def _cylBaseMask(z, radius, concavity):
+    """
+    Points at the base of the cylinder, more than 9/10 of the radius
+    below the top (convex) or above the bottom (concave)
+    """
+    if concavity == 'convex':
+        return z < np.nanmax(z) - 9 / 10 * radius
+    elif concavity == 'concave':
+        return z > np.nanmin(z) + 9 / 10 * radius
+    raise Exception('Concavity is not valid')
+
+
+def _cylResiduals(P, est_p):
+    """
+    Radial residuals of the points P (3, N) from the cylinder est_p,
+    see Cylinder.formFit() for the parameters
+    """
+    d = np.array([np.cos(est_p[3]) * np.cos(est_p[4]), np.sin(est_p[3]), np.cos(est_p[3]) * np.sin(est_p[4])])
+    w = P - np.array([[est_p[5] if len(est_p) > 5 else 0], [est_p[1]], [est_p[2]]])
+    t = d @ w
+    return np.sqrt(np.maximum(np.einsum('ij,ij->j', w, w) - t ** 2, 0)) - est_p[0]
+
+
+def _fitCylinderPoints(P, radius, alphaZ=0, alphaY=0, concavity='convex', subsample=20000):
+    """
+    Least square cylinder of the points P (3, N), see Cylinder.formFit()
+
+    Returns
+    -------
+    est_p : np.array
+        The cylinder parameters [r, Yc, Zc, alpha_z, alpha_y, Xc]
+    """
+    # local frame: first axis along the initial axis direction, origin below (above) the top of the data
+    R0 = _cylFrame(alphaZ, alphaY)
+    C0 = np.mean(P, axis=1)
+    C0[2] = np.max(P[2]) - radius if concavity == 'convex' else np.min(P[2]) + radius
+    L = R0.T @ (P - C0[:, None])
+
+    q = np.array([radius, 0, 0, 0, 0])
+    if subsample is not None and P.shape[1] > 2 * subsample:  # coarse fit on evenly spaced points
+        k = int(np.ceil(P.shape[1] / subsample))
+        q = optimize.leastsq(_cylResid, q, args=(L[:, ::k],), Dfun=_cylJac, col_deriv=True)[0]
+    q = optimize.leastsq(_cylResid, q, args=(L,), Dfun=_cylJac, col_deriv=True)[0]
+
+    # back to the global frame, the centre is the axis point closest to the data centroid
+    g = np.array([1, q[3], q[4]])
+    d = R0 @ (g / np.linalg.norm(g))
+    d = d if d[0] >= 0 else -d
+    Cg = C0 + R0 @ np.array([0, q[1], q[2]])
+    Cg = Cg + ((np.mean(P, axis=1) - Cg) @ d) * d
+    return np.array([np.abs(q[0]), Cg[1], Cg[2],
+                     np.arcsin(np.clip(d[1], -1, 1)), np.arctan2(d[2], d[0]), Cg[0]])
+
+
+def _plotCyl(X, Y, Z, z_cyl):
+    """Plots the topography and the fitted cylinder"""
+    fig = plt.figure()
+    ax = fig.add_subplot(111, projection='3d')
+    ax.plot_surface(X, Y, Z, cmap=cm.Reds, alpha=0.8)
+
+    ax.plot_surface(X, Y, z_cyl, cmap=cm.rainbow, alpha=0.3)
+    ax.set_box_aspect((np.ptp(X), np.ptp(Y), np.ptp(z_cyl[~np.isnan(z_cyl)])))
+
+    funct.persFig([ax], 'x[um]', 'y[um]', 'z[um]')
+    plt.show()
+
+
 class Cylinder(FormEstimator):
     """
     Class derived from FormEstimator for the calculation of the
     least square cylinder
     """
     @staticmethod
-    def formFit(obj: surface.Surface, radius, alphaZ=0, alphaY=0, concavity='convex', base=False, finalize=True, bplt=False):
+    def formFit(obj: surface.Surface, radius, alphaZ=0, alphaY=0, concavity='convex', base=False, finalize=True,
+                subsample=20000, bplt=False):
         """
         This is a fitting for a horizontal along x cylinder fitting
         uses the following parameters to find the best cylinder fit
@@ -943,10 +1393,14 @@ class Cylinder(FormEstimator):
         concavity : str
             Can be either 'convex' or 'concave'
         base : bool
-            If true removes the points at the base of the cylinder
+            If true the points at the base of the cylinder are not used
+            (and removed from the surface if finalize)
         finalize : bool
             If set to False the fit will not alter the surface,
             the method will only return the center and the radius
+        subsample : int
+            Approximate number of points of the coarse fit, the result is then
+            refined on all the points. If None only the full fit is done
         bplt : bool
             Plots the sphere fitted to the data points
 
@@ -957,8 +1411,9 @@ class Cylinder(FormEstimator):
             p[1] = Yc, y coordinate of the cylinder centre\n
             P[2] = Zc, z coordinate of the cylinder centre\n
             P[3] = alpha_z, rotation angle (radian) about the z-axis\n
-            P[4] = alpha_y, rotation angle (radian) about the y-axis
-            
+            P[4] = alpha_y, rotation angle (radian) about the y-axis\n
+            P[5] = Xc, x coordinate of the cylinder centre
+
         Notes
         -----
         The cylinder fit is done according to the general cylider equation with 5
@@ -967,56 +1422,28 @@ class Cylinder(FormEstimator):
         Where $x,y,z_{cyl}$ are the coordinates of the cylinder points, $l, m, n$ 
         are the three components of the versor that represent the cylinder axis direction,
         $x_c, y_c, z_c$ are the coordinate of the centre and $R$ is the radius of the circular base.
-        """
-        # TODO : try masking the points instead of removing
-        if base:  # remove base points
-            if concavity == 'convex':
-                th = np.nanmax(obj.Z) - 9 / 10 * radius
-                obj.Z[obj.Z < th] = np.nan
-            elif concavity == 'concave':
-                th = np.nanmin(obj.Z) + 9 / 10 * radius
-                obj.Z[obj.Z > th] = np.nan
-            else:
-                raise Exception('Concavity is not valid')
-
-        X = obj.X.flatten()
-        Y = obj.Y.flatten()
-        Z = obj.Z.flatten()
-
-        nanind = ~np.isnan(Z)
 
-        X = X[nanind]
-        Y = Y[nanind]
-        Z = Z[nanind]
-
-        def fitfunc(p, x, y, z):
-            l = np.cos(p[3]) * np.cos(p[4])
-            m = np.sin(p[3])
-            n = np.cos(p[3]) * np.sin(p[4])
-
-            return x ** 2 + (y - p[1]) ** 2 + (z - p[2]) ** 2 - (l * x + m * (y - p[1]) + n * (z - p[2])) ** 2
-
-        errfunc = lambda p, x, y, z: fitfunc(p, x, y, z) - p[0] ** 2  # error function
-
-        p_init = np.array([radius, 0, 0, alphaZ, alphaY])
-        est_p, success = optimize.leastsq(errfunc, p_init, args=(X, Y, Z))
+        The fit minimizes the radial (geometric) residuals with an analytic jacobian, first on
+        evenly spaced points and then on all the points.
+        The axis is parametrized in a frame aligned with the initial direction (alphaZ, alphaY):
+        it passes through $(0, u, v)$ with direction $(1, a, b)$, so no parameter becomes
+        singular when the axis is parallel to y. The returned centre is the point of the
+        axis closest to the centroid of the data.
+        """
+        valid = np.isfinite(obj.Z)
+        if base:  # mask the base points
+            valid[valid] = ~_cylBaseMask(obj.Z[valid], radius, concavity)
+        P = np.array([obj.X[valid], obj.Y[valid], obj.Z[valid]])
 
+        est_p = _fitCylinderPoints(P, radius, alphaZ=alphaZ, alphaY=alphaY, concavity=concavity, subsample=subsample)
         # print(f'Cylinder fit: {est_p}')
 
         z_cyl = _evalCyl(obj, est_p, concavity)
 
         if bplt:
-            fig = plt.figure()
-            ax = fig.add_subplot(111, projection='3d')
-            ax.plot_surface(obj.X, obj.Y, obj.Z, cmap=cm.Reds, alpha=0.8)
-
-            ax.plot_surface(obj.X, obj.Y, z_cyl, cmap=cm.rainbow, alpha=0.3)
-            ax.set_box_aspect((np.ptp(obj.X), np.ptp(obj.Y), np.ptp(z_cyl[~np.isnan(z_cyl)])))
-
-            funct.persFig([ax], 'x[um]', 'y[um]', 'z[um]')
-            plt.show()
+            _plotCyl(obj.X, obj.Y, np.where(valid, obj.Z, np.nan), z_cyl)
 
         if finalize:
-            obj.Z = obj.Z - z_cyl
+            obj.Z = np.where(valid, obj.Z - z_cyl, np.nan)
 
         return est_p
@@ -702,18 +702,39 @@ def read_NMMgaoliang(content):
 
 #
 def identifybadborderlines(zval2d, ny):
-    istart = 0
-    in_valid_pts = np.where(np.isnan(zval2d[istart]))[0]
-    num_cut = ny // 3
-    while len(in_valid_pts) > num_cut:
-        istart += 1
-        in_valid_pts = np.where(np.isnan(zval2d[istart]))[0]
-    iend = ny - 1
-    in_valid_pts = np.where(np.isnan(zval2d[iend]))[0]
-    while len(in_valid_pts) > num_cut:
-        iend -= 1
-        in_valid_pts = np.where(np.isnan(zval2d[iend]))[0]
-    return istart, iend
+    # first and last line with at most ny // 3 invalid points
+    i_ok = np.nonzero(np.count_nonzero(np.isnan(zval2d), axis=1) <= ny // 3)[0]
+    if len(i_ok) == 0:
+        raise Exception('all the lines have too many invalid points')
+    return int(i_ok[0]), int(i_ok[-1])
+
+
+def csaps_fill_lines(zlines, knots, maxnans, smoothparam):
+    """
+    Fills in place the NaNs of the lines (rows of zlines) with at most maxnans
+    invalid points with the smoothing spline of the valid points.
+    The lines with the same invalid points (e.g. bad columns of the sensor)
+    are fitted with a single csaps call.
+    Returns the indexes of the lines with too many invalid points.
+    """
+    nanmask = np.isnan(zlines)
+    n_nans = np.count_nonzero(nanmask, axis=1)
+    i_fill = np.nonzero((n_nans > 0) & (n_nans <= maxnans))[0]
+    if len(i_fill) > 0:
+        patterns, i_group = np.unique(nanmask[i_fill], axis=0, return_inverse=True)
+        i_group = i_group.reshape(-1)
+        order = np.argsort(i_group, kind='stable')
+        bounds = np.r_[0, np.cumsum(np.bincount(i_group))]
+        for k in range(len(patterns)):
+            rows = i_fill[order[bounds[k]:bounds[k + 1]]]
+            i_nans = patterns[k]
+            if len(rows) == 1:  # single line, same call of the line by line fill
+                zlines[rows[0], i_nans] = csaps(knots[~i_nans], zlines[rows[0], ~i_nans], knots[i_nans],
+                                                smooth=smoothparam)
+            else:
+                z_fill = csaps(knots[~i_nans], zlines[np.ix_(rows, ~i_nans)], knots[i_nans], smooth=smoothparam)
+                zlines[np.ix_(rows, i_nans)] = z_fill
+    return np.nonzero(n_nans > maxnans)[0]
 
 
 def interpol_csaps(zmatrix, wmatrix, dx, dy, smoothparam):
@@ -728,27 +749,10 @@ def interpol_csaps(zmatrix, wmatrix, dx, dy, smoothparam):
     print('nx', nx, ' - ', iend_x - istart_x)
     x_knots = np.arange(0, nx) * dx
     y_knots = np.arange(0, ny) * dy
-    itotalline = []
-    for iy in range(0, ny):
-        i_nans = np.where(np.isnan(z_xdir[iy]))[0]
-        if (len(i_nans) > 0):
-            if (len(i_nans) <= ny // 3):
-                i_valid = np.where(np.isnan(z_xdir[iy]) == False)[0]
-                z_fill = csaps(x_knots[i_valid], z_xdir[iy][i_valid], \
-                               x_knots[i_nans], smooth=smoothparam)
-                z_xdir[iy][i_nans] = z_fill
-            else:
-                itotalline.append(iy)
+    itotalline = list(csaps_fill_lines(z_xdir, x_knots, ny // 3, smoothparam))
 
     z_ydir = z_xdir.T
-    for ix in range(0, nx):
-        i_nans = np.where(np.isnan(z_ydir[ix]))[0]
-        if (len(i_nans) > 0):
-            if (len(i_nans) <= ny // 3):
-                i_valid = np.where(np.isnan(z_ydir[ix]) == False)[0]
-                z_fill = csaps(y_knots[i_valid], z_ydir[ix][i_valid], \
-                               y_knots[i_nans], smooth=smoothparam)
-                z_ydir[ix][i_nans] = z_fill
+    csaps_fill_lines(z_ydir, y_knots, ny // 3, smoothparam)
     zfinal = z_ydir.T
 
     if pltflag:
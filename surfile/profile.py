@@ -231,9 +231,19 @@ class Profile:
         self.X0, self.Z0 = copy.deepcopy(self.X), copy.deepcopy(self.Z)
         if bplt: self.pltPrf()
         
-    def fillNM(self, bplt=False):
-        nans, f = funct.nan_helper(self.Z)
-        self.Z[nans]= np.interp(f(nans), f(~nans), self.Z[~nans])
+    def fillNM(self, bplt=False, maxSize=None):
+        """
+        Fills the profile non measured points with the linear interpolation
+        of the gaps, see funct.inpaintNaN()
+
+        Parameters
+        ----------
+        bplt : bool
+            Plots the filled profile
+        maxSize : int
+            The gaps with more than maxSize points are not filled
+        """
+        self.Z = funct.inpaintNaN(self.Z, maxSize)
         
         if bplt: self.pltCompare()
 
@@ -1,20 +1,321 @@
 """
 'surfile.stitcher'
 - implementation of surface stitching methods
+- global stitching of N x M tile mosaics
 
 @author: Andrea Giura
 """
 import copy
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
 from matplotlib import patches, cm
 
 from surfile import surface, funct
-from scipy import optimize, signal, ndimage
+from scipy import ndimage, fft
 
 import matplotlib.pyplot as plt
 import numpy as np
 
-import open3d as o3d
+try:
+    import open3d as o3d
+except ImportError:
+    o3d = None
+    print(funct.Bcol.WARNING + 'open3d not found (needed by SurfaceStitcher.stitchFGR): use' + funct.Bcol.ENDC)
+    print('pip install open3d')
+
+
+def _maskedNCC(fixed, moving, fixedMask=None, movingMask=None, overlapRatio=0.3, mode='full'):
+    """
+    Masked zero-normalized cross correlation computed in the frequency domain
+
+    Parameters
+    ----------
+    fixed : np.ndarray
+        The reference image
+    moving : np.ndarray
+        The image (or template) correlated with the reference
+    fixedMask, movingMask : np.ndarray
+        The valid pixels of the images, if None the finite values are used
+    overlapRatio : float
+        The displacements with less than overlapRatio of the maximum number of
+        overlapping valid pixels are set to 0
+    mode : str
+        'full' all the displacements, 'valid' only the ones with moving inside fixed
+
+    Returns
+    -------
+    ncc : np.ndarray
+        The normalized correlation in [-1, 1], ncc[i, j] is the correlation of the
+        moving image displaced of (i - moving.shape[0] + 1, j - moving.shape[1] + 1)
+        pixels ('full' mode) as in signal.correlate2d
+
+    Notes
+    -----
+    D. Padfield, "Masked Object Registration in the Fourier Domain", IEEE TIP (2012):
+    the mean and the energy of both images are computed on the overlapping valid pixels
+    of each displacement with 6 correlations, all done with real FFTs.
+    """
+    fixedMask = np.isfinite(fixed) if fixedMask is None else fixedMask & np.isfinite(fixed)
+    movingMask = np.isfinite(moving) if movingMask is None else movingMask & np.isfinite(moving)
+    f = np.where(fixedMask, fixed, 0)
+    m = np.where(movingMask, moving, 0)[::-1, ::-1]  # correlation as convolution with the flipped image
+    mf, mm = fixedMask.astype(float), movingMask[::-1, ::-1].astype(float)
+
+    shape = [a + b - 1 for a, b in zip(f.shape, m.shape)]
+    fshape = [fft.next_fast_len(n, real=True) for n in shape]
+    F = lambda a: fft.rfft2(a, fshape)
+    conv = lambda A, B: fft.irfft2(A * B, fshape)[:shape[0], :shape[1]]
+
+    Ff, Ff2, Fmf = F(f), F(f * f), F(mf)
+    Fm, Fm2, Fmm = F(m), F(m * m), F(mm)
+
+    n = np.maximum(np.round(conv(Fmf, Fmm)), np.finfo(float).eps)  # overlapping valid pixels
+    sf, sm = conv(Ff, Fmm), conv(Fmf, Fm)
+    num = conv(Ff, Fm) - sf * sm / n
+    den = np.maximum(conv(Ff2, Fmm) - sf ** 2 / n, 0) * np.maximum(conv(Fmf, Fm2) - sm ** 2 / n, 0)
+    den = np.sqrt(den)
+
+    tol = 1000 * np.finfo(float).eps * np.max(np.abs(den))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ncc = np.where(den > tol, num / den, 0)
+    ncc = np.clip(ncc, -1, 1)
+    ncc[n < overlapRatio * np.max(n)] = 0
+
+    if mode == 'valid':
+        ncc = ncc[m.shape[0] - 1: f.shape[0], m.shape[1] - 1: f.shape[1]]
+    return ncc
+
+
+def _subpixelPeak(cc, iy, ix):
+    """
+    Sub-pixel position of the peak of cc in (iy, ix) by fitting a parabola
+    to the 3 values around the peak along each axis
+
+    Returns
+    -------
+    (y, x) : (float, float)
+        The refined peak position
+    """
+    def vertex(a, b, c):
+        d = a - 2 * b + c
+        return 0.5 * (a - c) / d if d < 0 else 0
+
+    dy = vertex(cc[iy - 1, ix], cc[iy, ix], cc[iy + 1, ix]) if 0 < iy < cc.shape[0] - 1 else 0
+    dx = vertex(cc[iy, ix - 1], cc[iy, ix], cc[iy, ix + 1]) if 0 < ix < cc.shape[1] - 1 else 0
+    return iy + dy, ix + dx
+
+
+def _overlapPatches(lZone, rZone, a, b):
+    """
+    Overlapping patches of lZone and rZone when rZone is displaced of (a, b) pixels,
+    returns the patches and the patch origins (x, y) in both zones
+    """
+    ny, nx = lZone.shape
+    if a >= 0:
+        laa, raa, lab, rab = a, nx, 0, nx - a
+    else:
+        laa, raa, lab, rab = 0, nx + a, -a, nx
+
+    if b >= 0:
+        lba, rba, lbb, rbb = b, ny, 0, ny - b
+    else:
+        lba, rba, lbb, rbb = 0, ny + b, -b, ny
+
+    return lZone[lba: rba, laa: raa], rZone[lbb: rbb, lab: rab], (laa, lba), (lab, lbb)
+
+
+def _overlapCost(lZone, rZone, a, b, cost='l2'):
+    """
+    Cost of the displacement (a, b) of rZone over lZone, NaNs are not used
+
+    cost : str
+        'l2' the rms of the difference on the overlapping points,
+        'ssd' the mean square difference weighted with a gaussian centred on the overlap
+    """
+    alpha, beta, _, _ = _overlapPatches(lZone, rZone, a, b)
+    d2 = (alpha - beta) ** 2
+    valid = np.isfinite(d2)
+    if not np.any(valid): return np.inf
+    if cost == 'l2':
+        return np.sqrt(np.mean(d2[valid]))
+    elif cost == 'ssd':
+        gy, gx = [np.exp(-0.5 * ((np.arange(n) - (n - 1) / 2) / (n / 4)) ** 2) for n in d2.shape]
+        w = np.where(valid, np.outer(gy, gx), 0)
+        return np.sum(np.where(valid, d2, 0) * w) / np.sum(w)
+    raise Exception(f'{cost} is not a valid cost')
+
+
+def _downsample2(Z):
+    """Halves the resolution with the mean of 2x2 blocks, NaNs are not used"""
+    ny, nx = Z.shape[0] // 2 * 2, Z.shape[1] // 2 * 2
+    blk = Z[:ny, :nx].reshape(ny // 2, 2, nx // 2, 2)
+    cnt = np.sum(np.isfinite(blk), axis=(1, 3))
+    tot = np.nansum(blk, axis=(1, 3))
+    return np.where(cnt > 0, tot / np.maximum(cnt, 1), np.nan)
+
+
+def _pyramidSearch(lZone, rZone, scan, cost='l2', levels=None, callback=None):
+    """
+    Integer displacement in [-scan, scan) that minimizes the cost between the zones,
+    coarse to fine: the full search is done on the coarsest level of the pyramid
+    and the optimum is refined of +-2 pixels on each finer level (it is kept when
+    none of the refined displacements has overlapping valid points)
+
+    Parameters
+    ----------
+    levels : int
+        Number of halvings of the resolution, if None the coarsest level searches
+        about +-4 pixels, 0 is the exhaustive search
+    callback : function
+        If not None called with (a, b) at each full resolution evaluation
+
+    Returns
+    -------
+    (a, b) : (int, int)
+        The best displacement
+    nfev : int
+        Number of cost evaluations
+    """
+    if levels is None:
+        levels = max(int(np.floor(np.log2(max(scan, 1) / 4))), 0)
+    pyr = [(lZone, rZone)]
+    for _ in range(levels):
+        pyr.append((_downsample2(pyr[-1][0]), _downsample2(pyr[-1][1])))
+
+    nfev = 0
+
+    def search(lev, cands):
+        nonlocal nfev
+        best, bestC = None, np.inf
+        for a, b in cands:
+            if not (-scan <= a * 2 ** lev < scan and -scan <= b * 2 ** lev < scan): continue
+            if lev == 0 and callback is not None: callback(a, b)
+            c = _overlapCost(*pyr[lev], a, b, cost)
+            nfev += 1
+            if c < bestC: best, bestC = (a, b), c
+        return best
+
+    s = -(-scan // 2 ** levels)
+    best = search(levels, [(a, b) for b in range(-s, s + 1) for a in range(-s, s + 1)])
+    if best is None: raise Exception('Pyramid search failed: no displacement has overlapping valid points')
+    for lev in range(levels - 1, -1, -1):
+        a0, b0 = 2 * best[0], 2 * best[1]
+        best = search(lev, [(a0 + a, b0 + b) for b in range(-2, 3) for a in range(-2, 3)]) or (a0, b0)
+    return best, nfev
+
+
+def _upsampledDFT(data, size, upsample, offset):
+    """
+    Inverse DFT of data evaluated on a size x size grid with spacing 1 / upsample
+    starting at offset (in upsampled pixels), with 2 matrix products
+    """
+    for n, off in zip(data.shape[::-1], offset[::-1]):
+        kernel = np.exp(-2j * np.pi * (np.arange(size) - off)[:, None] * fft.fftfreq(n, upsample))
+        data = np.tensordot(kernel, data, axes=(1, -1))
+    return data
+
+
+def _phaseCorrelation(ref, mov, upsample=20, window=True):
+    """
+    Sub-pixel translation between 2 images with the phase correlation
+
+    Parameters
+    ----------
+    ref : np.ndarray
+        The reference image
+    mov : np.ndarray
+        The displaced image, same shape of ref
+    upsample : int
+        The precision of the result is 1 / upsample pixels
+    window : bool
+        If true a Hann window is applied to the images to reduce the border effects
+
+    Returns
+    -------
+    (dy, dx) : (float, float)
+        The displacement of mov with respect to ref, mov(y, x) = ref(y - dy, x - dx)
+    confidence : float
+        The height of the phase correlation peak, 1 for a pure translation, close to 0
+        if the images are not correlated
+
+    Examples
+    --------
+    >>> Z = ndimage.gaussian_filter(np.random.default_rng(0).normal(size=(700, 700)), 2.5)
+    >>> ky, kx = fft.fftfreq(700)[:, None], fft.fftfreq(700)
+    >>> mov = np.real(fft.ifft2(fft.fft2(Z) * np.exp(-2j * np.pi * (ky * 3.3 + kx * -5.7))))
+    >>> (dy, dx), conf = _phaseCorrelation(Z[100:400, 100:500], mov[100:400, 100:500], upsample=100)
+    >>> bool(abs(dy - 3.3) < 0.01 and abs(dx + 5.7) < 0.01)
+    True
+
+    Notes
+    -----
+    M. Guizar-Sicairos, S. T. Thurman, J. R. Fienup, "Efficient subpixel image registration
+    algorithms", Opt. Lett. 33 (2008): the integer peak of the phase correlation of the whole
+    images is refined on a 1.5 x 1.5 pixels region upsampled with a matrix multiply DFT.
+    The refinement uses only the common overlap of the images at the integer displacement:
+    windowing the whole images would bias the sub-pixel peak towards 0.
+    The normalization of the cross power spectrum is regularized so the frequencies
+    without energy do not bias the peak. The mean plane of the images is removed
+    and NaNs are replaced by 0.
+    """
+    def prep(a):
+        valid = np.isfinite(a)
+        yy, xx = np.nonzero(valid)
+        G = np.c_[np.ones(xx.size), xx, yy]
+        c = np.linalg.lstsq(G, a[valid], rcond=None)[0]  # the mean plane is removed
+        a = np.where(valid, a - (c[0] + c[1] * np.arange(a.shape[1]) + c[2] * np.arange(a.shape[0])[:, None]), 0)
+        if window: a = a * np.outer(np.hanning(a.shape[0]), np.hanning(a.shape[1]))
+        return fft.fft2(a)
+
+    def crossPower(a, b):
+        R = prep(a).conj() * prep(b)
+        return R / (np.abs(R) + 1e-3 * np.max(np.abs(R)))  # phase, regularized where the spectrum has no energy
+
+    R = crossPower(ref, mov)
+    shape = np.array(R.shape)
+    peak = np.array(np.unravel_index(np.argmax(np.real(fft.ifft2(R))), R.shape))
+    peak[peak > shape // 2] -= shape[peak > shape // 2]
+    conf = np.max(np.real(fft.ifft2(R))) * R.size / np.sum(np.abs(R))
+
+    # common overlap at the integer displacement, the residual displacement is within 1 pixel
+    a, b = _overlapPatches(ref, mov, -peak[1], -peak[0])[:2]
+    if min(a.shape) < 8: return tuple(peak.astype(float)), conf
+    R = crossPower(a, b)
+
+    size = int(np.ceil(upsample * 1.5))
+    centre = np.fix(size / 2)
+    cc = np.real(_upsampledDFT(R.conj(), size, upsample, np.array([centre, centre])).conj())
+    up = np.array(np.unravel_index(np.argmax(cc), cc.shape)) - centre
+    dy, dx = peak + up / upsample
+    return (dy, dx), conf
+
+
+def _refineShift(ref, mov, iters=5):
+    """
+    Sub-pixel displacement of mov over ref when they are aligned within about 1 pixel,
+    Gauss-Newton (Lucas-Kanade) minimization of the square difference with a plane
+
+    Returns
+    -------
+    (dy, dx) : (float, float)
+        The displacement, mov(y, x) = ref(y - dy, x - dx)
+    """
+    valid = ndimage.binary_erosion(np.isfinite(ref) & np.isfinite(mov), iterations=3, border_value=0)
+    if np.count_nonzero(valid) < 10: return 0., 0.
+    r = np.where(np.isfinite(ref), ref, np.nanmean(ref))
+    yy, xx = np.nonzero(valid)
+    d = np.zeros(2)
+    for _ in range(iters):
+        warped = ndimage.shift(r, d, order=3, mode='nearest')  # ref(y - dy, x - dx)
+        gy, gx = np.gradient(warped)
+        J = np.c_[-gy[valid], -gx[valid], np.ones(yy.size), xx, yy]
+        step = np.linalg.lstsq(J, mov[valid] - warped[valid], rcond=None)[0]
+        d += step[:2]
+        if np.max(np.abs(step[:2])) < 1e-4: break
+    return d[0], d[1]
 
 
 def _composeFigure(left, right, T, R=None, support=None, sp=20):
@@ -66,9 +367,155 @@ def _composeFigure(left, right, T, R=None, support=None, sp=20):
     plt.show()
 
 
+def _edgeMask(P, sur, edge, stitchPrc):
+    """
+    Mask of the points P (N, 3) in tile coordinates that are inside the overlapping zone
+    of the tile at the given edge
+
+    Parameters
+    ----------
+    P : np.ndarray
+        (N, 3) points of the tile
+    sur : surface.Surface
+        The tile
+    edge : str
+        'right', 'left', 'bottom' (towards larger y) or 'top' (towards smaller y)
+    stitchPrc : int
+        The percentage of the image overlapping
+    """
+    ny, nx = sur.Z.shape
+    if edge == 'right': return P[:, 0] >= sur.x[1 + int(nx * (1 - stitchPrc / 100))]
+    if edge == 'left': return P[:, 0] < sur.x[int(nx * (stitchPrc / 100))]
+    if edge == 'bottom': return P[:, 1] >= sur.y[1 + int(ny * (1 - stitchPrc / 100))]
+    if edge == 'top': return P[:, 1] < sur.y[int(ny * (stitchPrc / 100))]
+    raise Exception(f'{edge} is not a valid edge')
+
+
+def _fgrScales(surs, stitchPrc):
+    """
+    Default voxel size and heights scale factor of the FGR registration: the heights are
+    scaled in [-L / 2, L / 2] and the voxel is 2% of L, L the size of the overlapping zone
+    """
+    t = surs[0]
+    L = max(np.ptp(t.x) * stitchPrc / 100, np.ptp(t.y))
+    zmax = max(np.nanmax(np.abs(s.Z)) for s in surs)
+    return 0.02 * L, L / (2 * zmax)
+
+
+class FeatureCache:
+    """
+    Cache of the point clouds, downsampled clouds and FPFH descriptors of whole tiles:
+    each tile is processed once and every pair selects the points of its overlapping zones.
+    The voxel size and the heights scale are the same for all the tiles of the cache.
+
+    Examples
+    --------
+    >>> cache = FeatureCache([s1, s2, s3])
+    >>> T1 = SurfaceStitcher.stitchFGR(s1, s2, cache=cache)
+    >>> T2 = SurfaceStitcher.stitchFGR(s2, s3, cache=cache)  # the features of s2 are reused
+    >>> cache.hits, cache.misses
+    (1, 3)
+    """
+    def __init__(self, surs, stitchPrc=20, voxel=None, zscale=None):
+        """
+        Parameters
+        ----------
+        surs : list[surface.Surface]
+            All the tiles that will be registered, used for the default scales
+        stitchPrc : int
+            the percentage of the image overlapping
+        voxel : float
+            The voxel size of the downsampling, if None 2% of the overlapping zone size
+        zscale : float
+            The heights are multiplied by zscale, if None the heights are scaled
+            in [-L / 2, L / 2] with L the overlapping zone size
+        """
+        _voxel, _zscale = _fgrScales(surs, stitchPrc)
+        self.stitchPrc = stitchPrc
+        self.voxel = _voxel if voxel is None else voxel
+        self.zscale = _zscale if zscale is None else zscale
+        self.hits, self.misses = 0, 0
+        self._features = {}
+
+    def _compute(self, sur):
+        """Point cloud (NaNs not used), downsampled cloud with normals and FPFH of the tile"""
+        valid = np.isfinite(sur.Z)
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(np.c_[sur.X[valid], sur.Y[valid], sur.Z[valid] * self.zscale])
+        down = pcd.voxel_down_sample(self.voxel)
+        down.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=2 * self.voxel, max_nn=30))
+        fpfh = o3d.pipelines.registration.compute_fpfh_feature(
+            down, o3d.geometry.KDTreeSearchParamHybrid(radius=5 * self.voxel, max_nn=100))
+        return pcd, down, fpfh
+
+    def features(self, sur):
+        """
+        Returns
+        -------
+        pcd : o3d.geometry.PointCloud
+            The point cloud of the tile, the heights multiplied by zscale
+        down : o3d.geometry.PointCloud
+            The downsampled point cloud with the normals
+        fpfh : o3d.pipelines.registration.Feature
+            The FPFH descriptors of the downsampled points
+        """
+        key = id(sur)
+        if key in self._features:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._features[key] = (sur, *self._compute(sur))  # sur is kept alive so that its id is not reused
+        return self._features[key][1:]
+
+    def zone(self, sur, edge):
+        """
+        The features of the overlapping zone at edge (see _edgeMask()), selected from
+        the features of the whole tile
+
+        Returns
+        -------
+        pcd, down, fpfh
+            As in FeatureCache.features()
+        """
+        pcd, down, fpfh = self.features(sur)
+        i = np.flatnonzero(_edgeMask(np.asarray(pcd.points), sur, edge, self.stitchPrc))
+        j = np.flatnonzero(_edgeMask(np.asarray(down.points), sur, edge, self.stitchPrc))
+        f = o3d.pipelines.registration.Feature()
+        f.data = np.asarray(fpfh.data)[:, j]
+        return pcd.select_by_index(i), down.select_by_index(j), f
+
+
+def _registerFGR(sura, surb, direction, icp, cache):
+    """
+    FGR (and ICP) registration of the overlapping zones of sura and surb,
+    surb is on the right of sura (direction 'x') or below it (direction 'y')
+
+    Returns
+    -------
+    T : np.ndarray
+        (4, 4) transform from the coordinates of sura to the ones of surb
+    """
+    if direction not in ['x', 'y']: raise Exception(f'{direction} is not a valid direction')
+    ea, eb = ('right', 'left') if direction == 'x' else ('bottom', 'top')
+    src, src_down, src_fpfh = cache.zone(sura, ea)
+    tgt, tgt_down, tgt_fpfh = cache.zone(surb, eb)
+
+    T = o3d.pipelines.registration.registration_fgr_based_on_feature_matching(
+        src_down, tgt_down, src_fpfh, tgt_fpfh,
+        o3d.pipelines.registration.FastGlobalRegistrationOption(maximum_correspondence_distance=1.5 * cache.voxel)
+    ).transformation
+    if icp:  # refine on the full clouds
+        T = o3d.pipelines.registration.registration_icp(
+            src, tgt, cache.voxel / 4, init=T,
+            estimation_method=o3d.pipelines.registration.TransformationEstimationPointToPoint(True)).transformation
+
+    S = np.diag([1, 1, cache.zscale, 1])  # back to the original heights
+    return np.linalg.inv(S) @ np.asarray(T) @ S
+
+
 class SurfaceStitcher:
     @staticmethod
-    def stitchMinimizeNorm(surl, surr, stitchPrc=20, pixelScan=40, bplt=False):
+    def stitchMinimizeNorm(surl, surr, stitchPrc=20, pixelScan=40, cost='l2', levels=None, bplt=False):
         """
         Given 2 surfaces finds the best allignement
         by minimizing the norm2 of the difference
@@ -84,29 +531,38 @@ class SurfaceStitcher:
         pixelScan: int
             the number of pixel the method tryes to displace the images
             an higher number results in longer excution time
+        cost : str
+            'l2' the rms of the difference of the overlapping points
+            'ssd' the mean square difference weighted with a gaussian centred on the overlap
+        levels : int
+            Number of levels of the resolution pyramid, if None it is chosen from pixelScan,
+            0 evaluates all the displacements
         bplt : bool
-            If true plots the stitching process, limits the radius scan to 5 pixels
+            If true plots the stitching process, limits the radius scan to 20 pixels
+            and evaluates all the displacements.
             Use this only to see graphically and very slowly what this function does.
 
         Returns
         -------
-        surface.Surface
-            The stitched image
+        bestTranslation : list
+            The [x, y] displacement in pixels of the right image over the left one
+
+        Notes
+        -----
+        The search is coarse to fine: all the displacements are evaluated on the overlaps
+        downsampled to the coarsest level, then the optimum is refined on each finer level.
         """
         # Given starting displacement (0, 0) in x and y
         # move surr % of stitching.py over the other % surl
         # and minimize surr(x - a; y - b) - surl(x, y)
 
-        # We need a function that given a, b moves surr
-        # and subtracts surr moved from surl
-
         # find the interested zones to be stitched
         lZone = surl.Z[:, 1 + int(surl.Z.shape[1] * (1 - stitchPrc / 100)):]
-        rZone = surl.Z[:, :int(surl.Z.shape[1] * (stitchPrc / 100))]
-        # rZone = np.roll(lZone, 30, axis=1)  # used for testing
-
-        ny, nx = lZone.shape
+        rZone = surr.Z[:, :int(surr.Z.shape[1] * (stitchPrc / 100))]
+        ny, nx = min(lZone.shape[0], rZone.shape[0]), min(lZone.shape[1], rZone.shape[1])
+        lZone, rZone = lZone[:ny, :nx], rZone[:ny, :nx]
 
+        callback = None
         if bplt:
             fig, (ax, bx, cx) = plt.subplots(nrows=1, ncols=3)
             plot_data = ax.imshow(lZone)
@@ -121,52 +577,28 @@ class SurfaceStitcher:
 
             plt.show(block=False)
 
-        def move(disp):
-            a, b = disp[0], disp[1]
-            print(a, b)
-            if a >= 0:
-                laa, raa, lab, rab = a, nx, 0, nx - a
-            else:
-                a = -a
-                laa, raa, lab, rab = 0, nx - a, a, nx
-
-            if b >= 0:
-                lba, rba, lbb, rbb = b, ny, 0, ny - b
-            else:
-                b = -b
-                lba, rba, lbb, rbb = 0, ny - b, b, ny
-
-            alpha_patch = lZone[lba: rba, laa: raa]
-            beta_patch = rZone[lbb: rbb, lab: rab]
-
-            diff = alpha_patch - beta_patch
-
-            if bplt:
-                plot_data.set_data(diff)
+            def callback(a, b):
+                alpha, beta, (laa, lba), (lab, lbb) = _overlapPatches(lZone, rZone, a, b)
+                plot_data.set_data(alpha - beta)
 
                 rectb.set_xy((laa, lba))
-                rectb.set_width(raa - laa)
-                rectb.set_height(rba - lba)
-                bx.add_patch(rectb)
+                rectb.set_width(alpha.shape[1])
+                rectb.set_height(alpha.shape[0])
                 rectc.set_xy((lab, lbb))
-                rectc.set_width(rab - lab)
-                rectc.set_height(rbb - lbb)
+                rectc.set_width(beta.shape[1])
+                rectc.set_height(beta.shape[0])
 
                 fig.canvas.draw()
                 plt.pause(0.05)
 
-            return np.linalg.norm(diff)  # maybe an ssd (sum of square difference with a gaussian kernel is better)
-
         # a and b are ints since they rapresent pixel translations
         nPixelMaxDisp = pixelScan if not bplt else 20
-        bestTranslation = optimize.brute(
-            move,
-            ranges=((slice(-nPixelMaxDisp, nPixelMaxDisp, 1),) * 2),
-            disp=True,
-            finish=None
-        )
+        best, nfev = _pyramidSearch(lZone, rZone, nPixelMaxDisp, cost=cost,
+                                    levels=0 if bplt else levels, callback=callback)
 
-        print(bestTranslation)
+        bestTranslation = list(best)
+        print(f'{bestTranslation=} {nfev=}')
+        return bestTranslation
 
     @staticmethod
     def stitchCorrelation(surl, surr, stitchPrc=20, samplingPrc=50, correlateDer=True, bplt=False):
@@ -190,6 +622,16 @@ class SurfaceStitcher:
             in order to compare the slope of the sample instead of the height
         bplt : bool
             If true plots the stitched image
+
+        Returns
+        -------
+        bestMeanTranslation : list
+            The sub-pixel [x, y] translation between the images
+
+        Notes
+        -----
+        The correlation is the masked zero-normalized cross correlation computed
+        with FFTs, the peaks are refined to sub-pixel precision with parabolic fits.
         """
         # find the interested zones to be stitched
         # TODO: what if the lZone and rZone have different sizes ?? (often they dont)
@@ -208,29 +650,28 @@ class SurfaceStitcher:
         sampleR = rZone[center_x - size_x // 2: center_x + size_x // 2,
                   center_y - size_y // 2: center_y + size_y // 2]
 
-        # correlate the patch with the first image to find its position
-        nrmze = lambda a: a / np.linalg.norm(a)
-        ccL = signal.correlate2d(nrmze(lZone), nrmze(sampleR), mode='valid')
-        ccR = signal.correlate2d(nrmze(rZone), nrmze(sampleL), mode='valid')
+        # correlate the patch with the first image to find its position (masked NCC, NaNs excluded)
+        ccL = _maskedNCC(lZone, sampleR, mode='valid')
+        ccR = _maskedNCC(rZone, sampleL, mode='valid')
 
         ML = np.argmax(ccL)
-        yML, xML = np.unravel_index(ML, ccL.shape)
+        yML, xML = _subpixelPeak(ccL, *np.unravel_index(ML, ccL.shape))
         print(f'{ML=} {xML=} {yML=}')
 
         MR = np.argmax(ccR)
-        yMR, xMR = np.unravel_index(MR, ccR.shape)
+        yMR, xMR = _subpixelPeak(ccR, *np.unravel_index(MR, ccR.shape))
         print(f'{MR=} {xMR=} {yMR=}')
 
         bestLTranslation = [ccL.shape[1] // 2 - xML, ccL.shape[0] // 2 - yML]
         bestRTranslation = [ccR.shape[1] // 2 - xMR, ccR.shape[0] // 2 - yMR]
 
-        meanTranslation = [(bestLTranslation[i] - bestRTranslation[i]) // 2 for i in [0, 1]]
+        meanTranslation = [(bestLTranslation[i] - bestRTranslation[i]) / 2 for i in [0, 1]]
         print(f'{bestLTranslation=}\n{bestRTranslation=}\n{meanTranslation=}')
 
         flippedccR = np.flip(ccR)
         cross_cc = ccL * flippedccR
         M = np.argmax(cross_cc)
-        yM, xM = np.unravel_index(M, cross_cc.shape)
+        yM, xM = _subpixelPeak(cross_cc, *np.unravel_index(M, cross_cc.shape))
         bestMeanTranslation = [cross_cc.shape[1] // 2 - xM, cross_cc.shape[0] // 2 - yM]
         print(f'\n\n{M=} {xM=} {yM=}')
         print(f'{bestMeanTranslation=}')
@@ -260,11 +701,52 @@ class SurfaceStitcher:
             plt.show()
 
             _composeFigure(surl.Z, surr.Z,
-                           T=[bestMeanTranslation[0], bestMeanTranslation[1], 'best'],
+                           T=[round(bestMeanTranslation[0]), round(bestMeanTranslation[1]), 'best'],
                            sp=stitchPrc)
 
+        return bestMeanTranslation
+
     @staticmethod
-    def stitchFGR(surl, surr, stitchPrc=20):
+    def stitchPhase(surl, surr, stitchPrc=20, upsample=20, bplt=False):
+        """
+        Finds the best allignment between surl and surr
+        with the phase correlation of the overlapping zones
+
+        Parameters
+        ----------
+        surl : surface.Surface
+            The left image to be stitched
+        surr : surface.Surface
+            The right image to be stitched
+        stitchPrc : int
+            the percentage of the image overlapping
+        upsample : int
+            The precision of the translation is 1 / upsample pixels
+        bplt : bool
+            If true plots the stitched image
+
+        Returns
+        -------
+        translation : list
+            The sub-pixel [x, y] translation of the right zone with respect to the left one
+        confidence : float
+            The height of the phase correlation peak (1 perfect match, ~0 no match)
+        """
+        lZone = surl.Z[:, 1 + int(surl.Z.shape[1] * (1 - stitchPrc / 100)):]
+        rZone = surr.Z[:, :int(surr.Z.shape[1] * (stitchPrc / 100))]
+        ny, nx = min(lZone.shape[0], rZone.shape[0]), min(lZone.shape[1], rZone.shape[1])
+
+        (dy, dx), conf = _phaseCorrelation(lZone[:ny, :nx], rZone[:ny, :nx], upsample=upsample)
+        print(f'translation=[{dx:.3f}, {dy:.3f}] {conf=:.3f}')
+
+        if bplt:
+            _composeFigure(surl.Z, surr.Z, T=[round(dx), round(dy), 'best'], sp=stitchPrc)
+
+        return [dx, dy], conf
+
+    @staticmethod
+    def stitchFGR(surl, surr, stitchPrc=20, direction='x', voxel=None, zscale=None, icp=True, cache=None,
+                  bplt=False):
         """
         Finds the best allignment between surl and surr
         by first registering approximatively the 2 images
@@ -282,136 +764,88 @@ class SurfaceStitcher:
         surl : surface.Surface
             The left image to be stitched
         surr : surface.Surface
-            The right image to be stitched
+            The right image to be stitched (the bottom one if direction is 'y')
         stitchPrc : int
             the percentage of the image overlapping
+        direction : str
+            'x' surr is on the right of surl, 'y' surr is below surl
+        voxel : float
+            The voxel size of the downsampling, if None 2% of the overlapping zone size
+        zscale : float
+            The heights are multiplied by zscale for the registration, if None the heights
+            are scaled in [-L / 2, L / 2] with L the overlapping zone size
+        icp : bool
+            If true the FGR result is refined with ICP
+        cache : FeatureCache
+            The cache of the tile features, pass the same cache when a tile is in several pairs;
+            if given, stitchPrc, voxel and zscale are the ones of the cache
+        bplt : bool
+            If true shows the registered clouds and the composed images (blocking)
+
+        Returns
+        -------
+        T : np.ndarray
+            (4, 4) transform of the points [x, y, z, 1] of surl in the coordinates of surr
         """
-        # find the interested zones to be stitched
-        lZone = copy.deepcopy(surl.Z[:, 1 + int(surl.Z.shape[1] * (1 - stitchPrc / 100)):])
-        rZone = copy.deepcopy(surr.Z[:, :int(surr.Z.shape[1] * (stitchPrc / 100))])
+        if o3d is None: raise Exception('open3d is needed by stitchFGR: pip install open3d')
+        cache = FeatureCache([surl, surr], stitchPrc, voxel, zscale) if cache is None else cache
 
-        # scale parameter for noramalization
-        scale = 1
+        T = _registerFGR(surl, surr, direction, icp, cache)
 
-        scalez = np.max((lZone, rZone)) * 2 * scale  # re-range [-scale * 0.5, scale * 0.5]
-        lZone /= scalez
-        rZone /= scalez
+        if bplt:
+            src, tgt = cache.zone(surl, 'right' if direction == 'x' else 'bottom')[0], \
+                cache.zone(surr, 'left' if direction == 'x' else 'top')[0]
+            src_temp, tgt_temp = copy.deepcopy(src), copy.deepcopy(tgt)
+            src_temp.paint_uniform_color(np.array([139, 242, 80]) / 255)
+            tgt_temp.paint_uniform_color(np.array([209, 91, 245]) / 255)
+            S = np.diag([1, 1, cache.zscale, 1])
+            src_temp.transform(S @ T @ np.linalg.inv(S))
+            o3d.visualization.draw_geometries([src_temp, tgt_temp])
+
+            if direction == 'x':  # displacement of the left zone origin from the nominal overlap in pixels
+                x0 = surl.x[1 + int(surl.Z.shape[1] * (1 - cache.stitchPrc / 100))]
+                o = T @ np.array([x0, surl.y[0], 0, 1])
+                dx = (o[0] - surr.x[0]) / (surr.x[1] - surr.x[0])
+                dy = (o[1] - surr.y[0]) / (surr.y[1] - surr.y[0])
+                _composeFigure(surl.Z, surr.Z, T=[int(round(dx)), int(round(dy)), 'best'], sp=cache.stitchPrc)
+
+        return T
 
-        # scale xy max dimention
-        if lZone.shape[1] > lZone.shape[0]:
-            scaley = lZone.shape[0] * scale / lZone.shape[1]
-            scalefactor = lZone.shape[1]
+    @staticmethod
+    def stitchFGRPairs(pairs, stitchPrc=20, voxel=None, zscale=None, icp=True, workers=None):
+        """
+        FGR (and ICP) registration of many pairs of tiles, see SurfaceStitcher.stitchFGR():
+        the features of each tile are computed once and the pairs are registered concurrently
 
-            X = np.linspace(0, scale, lZone.shape[1])
-            Y = np.linspace(0, scaley, lZone.shape[0])
-        else:
-            scalex = lZone.shape[1] * scale / lZone.shape[0]
-            scalefactor = lZone.shape[0]
-
-            X = np.linspace(0, scalex, lZone.shape[1])
-            Y = np.linspace(0, scale, lZone.shape[0])
-        mesh_x, mesh_y = np.meshgrid(X, Y)
-
-        def toPC(zone):
-            xyz = np.zeros((np.size(mesh_x), 3))
-            xyz[:, 0] = np.reshape(mesh_x, -1)
-            xyz[:, 1] = np.reshape(mesh_y, -1)
-            xyz[:, 2] = np.reshape(zone, -1)
-
-            # Pass xyz to Open3D.o3d.geometry.PointCloud and visualize
-            pcd = o3d.geometry.PointCloud()
-            pcd.points = o3d.utility.Vector3dVector(xyz)
-
-            return pcd
-
-        pcd_l = toPC(lZone)
-        pcd_r = toPC(rZone)
-
-        o3d.visualization.draw_geometries([pcd_l])
-        o3d.visualization.draw_geometries([pcd_r])
-
-        def draw_registration_result(source, target, transformation):
-            source_temp = copy.deepcopy(source)
-            target_temp = copy.deepcopy(target)
-            source_temp.paint_uniform_color(np.array([139, 242, 80]) / 255)
-            target_temp.paint_uniform_color(np.array([209, 91, 245]) / 255)
-            source_temp.transform(transformation)
-            o3d.visualization.draw_geometries([source_temp, target_temp])
-
-        def preprocess_point_cloud(pcd, voxel_size):
-            print(":: Downsample with a voxel size %.3f." % voxel_size)
-            pcd_down = pcd.voxel_down_sample(voxel_size)
-
-            radius_normal = voxel_size * 2
-            print(":: Estimate normal with search radius %.3f." % radius_normal)
-            pcd_down.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=radius_normal, max_nn=30))
-
-            radius_feature = voxel_size * 5
-            print(":: Compute FPFH feature with search radius %.3f." % radius_feature)
-            pcd_fpfh = o3d.pipelines.registration.compute_fpfh_feature(
-                pcd_down,
-                o3d.geometry.KDTreeSearchParamHybrid(radius=radius_feature, max_nn=100)
-            )
-            return pcd_down, pcd_fpfh
-
-        def prepare_dataset(voxel_size):
-            source = pcd_l
-            target = pcd_r
-
-            source_down, source_fpfh = preprocess_point_cloud(source, voxel_size)
-            target_down, target_fpfh = preprocess_point_cloud(target, voxel_size)
-            return source, target, source_down, target_down, source_fpfh, target_fpfh
-
-        def execute_global_registration(source_down, target_down, source_fpfh,
-                                        target_fpfh, voxel_size):
-            distance_threshold = voxel_size * 1.5
-            print(":: FGR registration on downsampled point clouds.")
-            print(":: downsampling voxel size is %.3f," % voxel_size)
-            print(":: distance threshold %.3f." % distance_threshold)
-            result = o3d.pipelines.registration.registration_fgr_based_on_feature_matching(
-                source_down, target_down, source_fpfh, target_fpfh,
-                o3d.pipelines.registration.FastGlobalRegistrationOption(
-                    maximum_correspondence_distance=distance_threshold)
-            )
-            return result
-
-        voxel_size = 0.02 * scale
-        source, target, source_down, target_down, source_fpfh, target_fpfh = prepare_dataset(voxel_size)
-
-        result_fgr = execute_global_registration(source_down, target_down,
-                                                 source_fpfh, target_fpfh,
-                                                 voxel_size)
-        print(result_fgr)
-        print("Transformation is:")
-        print(result_fgr.transformation)
-        draw_registration_result(source_down, target_down, result_fgr.transformation)
-
-        print("Refine with point-to-point ICP")
-        # actually FGR should not need this step
-        distance_threshold = 0.005 * scale
-        reg_p2p = o3d.pipelines.registration.registration_icp(
-            source, target, distance_threshold,
-            init=result_fgr.transformation,
-            estimation_method=o3d.pipelines.registration.TransformationEstimationPointToPoint(True))
-        print(reg_p2p)
-        print("Transformation is:")
-        print(reg_p2p.transformation)
-        draw_registration_result(source, target, reg_p2p.transformation)
-
-        # Transformation matrix in the form:
-        # [[ 1 , -si, +be, xt],
-        #  [+si,  1 , -al, yt],
-        #  [-be, +al,  1 , zt],
-        #  [ 0 ,  0 ,  0 ,  1]]
-
-        xtransl = int(reg_p2p.transformation[0, 3] * scalefactor)
-        ytransl = int(reg_p2p.transformation[1, 3] * scalefactor)
-        ztransl = reg_p2p.transformation[2, 3] * scalez
-        _composeFigure(surl.Z, surr.Z,
-                       T=[xtransl, ytransl, 'best'],
-                       # R=reg_p2p.transformation[0:3, 0:3],  # this doesn't seem right
-                       # support=(surl.X, surl.Y),
-                       sp=stitchPrc)
+        Parameters
+        ----------
+        pairs : list[tuple]
+            The pairs (sura, surb) with surb on the right of sura, or (sura, surb, direction)
+            with direction 'x' (surb on the right) or 'y' (surb below sura)
+        stitchPrc : int
+            the percentage of the image overlapping
+        voxel : float
+            The voxel size of the downsampling, the same for all the pairs
+        zscale : float
+            The heights scale factor, the same for all the pairs
+        icp : bool
+            If true the FGR results are refined with ICP
+        workers : int
+            Number of threads, if None the executor default is used
+
+        Returns
+        -------
+        T : list[np.ndarray]
+            The (4, 4) transform of each pair
+        """
+        if o3d is None: raise Exception('open3d is needed by stitchFGRPairs: pip install open3d')
+        pairs = [p if len(p) == 3 else (p[0], p[1], 'x') for p in pairs]
+        surs = list({id(s): s for p in pairs for s in p[:2]}.values())
+        cache = FeatureCache(surs, stitchPrc, voxel, zscale)
+
+        with ThreadPoolExecutor(max_workers=workers) as ex:  # each tile once, then the pairs
+            list(ex.map(cache.features, surs))
+            return list(ex.map(lambda p: _registerFGR(p[0], p[1], p[2], icp, cache), pairs))
 
     # @staticmethod
     # def stitchSSDminimize(surl, surr, stitchPrc=20, bplt=False):
@@ -472,3 +906,401 @@ class SurfaceStitcher:
     #
     #     print(match_list)
     #     return np.array(match_list)
+
+
+@dataclass
+class MosaicLink:
+    """Registration of two neighbouring tiles of a mosaic"""
+    a: tuple  # (row, col) of the reference tile
+    b: tuple  # (row, col) of the displaced tile
+    offset: np.array  # measured position of b minus position of a [x, y] in pixels
+    conf: float  # phase correlation peak height
+    plane: np.array  # plane fitted to b - a on the overlap [c, gx, gy] in mosaic pixels
+
+
+def _registerLink(tiles, a, b, ovx, ovy, nominal, upsample):
+    """
+    Registers the tile b on its left (a) or upper (a) neighbour,
+    see MosaicStitcher.register()
+    """
+    A, B = tiles[a[0]][a[1]].Z, tiles[b[0]][b[1]].Z
+    ny, nx = A.shape
+    if a[0] == b[0]:  # horizontal pair, right zone of a and left zone of b
+        c0, r0 = nx - ovx, 0
+        ref, mov = A[:, c0:], B[:, :ovx]
+    else:  # vertical pair, lower zone of a and upper zone of b
+        c0, r0 = 0, ny - ovy
+        ref, mov = A[r0:, :], B[:ovy, :]
+
+    (dy, dx), conf = _phaseCorrelation(ref, mov, upsample=upsample)
+    # the residual displacement of the overlapping parts is refined without window effects
+    alpha, beta, _, _ = _overlapPatches(ref, mov, -int(round(dx)), -int(round(dy)))
+    ry, rx = _refineShift(alpha, beta)
+    dx, dy = round(dx) + rx, round(dy) + ry
+    offset = np.array([c0 - dx, r0 - dy])
+
+    # height difference b - a on the overlap, as a plane in mosaic pixels
+    alpha, beta, (ox, oy), _ = _overlapPatches(ref, mov, -int(round(dx)), -int(round(dy)))
+    gy, gx = np.mgrid[0:alpha.shape[0], 0:alpha.shape[1]]
+    gx = gx + ox + c0 + nominal[a][0]
+    gy = gy + oy + r0 + nominal[a][1]
+    d = beta - alpha
+    valid = np.isfinite(d)
+    plane = np.zeros(3)
+    if np.count_nonzero(valid) > 3:
+        G = np.c_[np.ones(np.count_nonzero(valid)), gx[valid], gy[valid]]
+        plane = np.linalg.lstsq(G, d[valid], rcond=None)[0]
+    return MosaicLink(a, b, offset, conf, plane)
+
+
+def _solveLinks(links, shape, values, prior, w, anchor=1e-6):
+    """
+    Weighted least squares of the tile values v with v_b - v_a = value of each link,
+    the tiles are weakly tied (weight anchor) to the prior values
+
+    Returns
+    -------
+    v : np.ndarray
+        (n tiles, ...) the values of the tiles
+    """
+    n = shape[0] * shape[1]
+    if not links: return np.reshape(prior, (n, -1)).astype(float)
+    idx = lambda t: t[0] * shape[1] + t[1]
+    A = np.zeros((len(links) + n, n))
+    for k, l in enumerate(links):
+        A[k, idx(l.b)], A[k, idx(l.a)] = 1, -1
+    A[len(links):] = np.eye(n)
+    sw = np.sqrt(np.r_[w, np.full(n, anchor)])
+    rhs = np.concatenate([np.reshape(values, (len(links), -1)), np.reshape(prior, (n, -1))])
+    return np.linalg.lstsq(A * sw[:, None], rhs * sw[:, None], rcond=None)[0]
+
+
+class MosaicCompositor:
+    """
+    Composes tiles in a canvas one at a time: the weighted sum of the heights and the
+    sum of the weights are accumulated, only the current tile is kept in memory
+    when the canvas is a memory map
+
+    Examples
+    --------
+    >>> comp = MosaicCompositor((2000, 5000), path='mosaic.npy')
+    >>> for Z, (x0, y0) in tiles: comp.add(Z, x0, y0, blend='feather')
+    >>> Z = comp.finalize()
+    """
+    def __init__(self, shape, path=None, out=None, dtype=np.float64):
+        """
+        Parameters
+        ----------
+        shape : (int, int)
+            The canvas shape
+        path : str
+            If not None the canvas is the .npy file memory map (np.lib.format.open_memmap),
+            the weights are kept in a temporary .npy file next to it
+        out : np.ndarray
+            Preallocated canvas, used if path is None; if it is a memory map the
+            weights are kept in a temporary .npy file next to its file
+        dtype : np.dtype
+            The type of the canvas
+        """
+        self.shape = tuple(shape)
+        self.path = path
+        self._wpath = None
+        if path is not None:
+            self.Z = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=self.shape)
+        else:
+            self.Z = np.empty(self.shape, dtype=dtype) if out is None else out
+            if self.Z.shape != self.shape: raise Exception(f'The canvas shape must be {self.shape}')
+
+        if isinstance(self.Z, np.memmap):  # the weights must not be in memory either
+            fd, self._wpath = tempfile.mkstemp(suffix='_weights.npy',
+                                               dir=os.path.dirname(os.path.abspath(self.Z.filename or '')) or None)
+            os.close(fd)
+            self.W = np.lib.format.open_memmap(self._wpath, mode='w+', dtype=np.float32, shape=self.shape)
+        else:
+            self.W = np.zeros(self.shape, dtype=np.float32)
+        self.Z[:] = 0
+
+    @staticmethod
+    def weights(Z, blend='feather', width=None):
+        """
+        Blending weights of a tile, 0 on the NaNs
+
+        Parameters
+        ----------
+        Z : np.ndarray
+            The tile
+        blend : str
+            'mean' all the valid points have weight 1,
+            'linear' the weight decreases linearly towards the tile borders,
+            'feather' the weight is the distance from the nearest border or NaN
+        width : float
+            If not None the 'feather' and 'linear' weights are saturated at width pixels
+
+        Returns
+        -------
+        w : np.ndarray
+            The weights
+        """
+        valid = np.isfinite(Z)
+        if blend == 'mean':
+            w = np.ones(Z.shape)
+        elif blend == 'linear':
+            wy, wx = [np.minimum(np.arange(1, n + 1), np.arange(n, 0, -1)).astype(float) for n in Z.shape]
+            if width is not None: wy, wx = np.minimum(wy, width), np.minimum(wx, width)
+            w = np.outer(wy, wx)
+        elif blend == 'feather':
+            w = ndimage.distance_transform_edt(np.pad(valid, 1))[1:-1, 1:-1]
+            if width is not None: w = np.minimum(w, width)
+        else: raise Exception(f'{blend} is not a valid blending')
+        return np.where(valid, w, 0)
+
+    def add(self, Z, x0, y0, blend='feather', width=None):
+        """
+        Adds a tile to the canvas
+
+        Parameters
+        ----------
+        Z : np.ndarray
+            The tile, NaNs are not used
+        x0, y0 : int
+            The canvas position of the first point of the tile
+        blend : str
+            'mean', 'linear' or 'feather', see MosaicCompositor.weights()
+        width : float
+            Saturation of the weights, see MosaicCompositor.weights()
+        """
+        w = self.weights(Z, blend, width).astype(self.W.dtype)  # same rounding in the sum and in the weights
+        # the part of the tile inside the canvas
+        ty, tx = max(-y0, 0), max(-x0, 0)
+        cy, cx = max(y0, 0), max(x0, 0)
+        ny = min(Z.shape[0] - ty, self.shape[0] - cy)
+        nx = min(Z.shape[1] - tx, self.shape[1] - cx)
+        if ny <= 0 or nx <= 0: return
+        tile, win = (slice(ty, ty + ny), slice(tx, tx + nx)), (slice(cy, cy + ny), slice(cx, cx + nx))
+
+        self.Z[win] += np.where(w[tile] > 0, Z[tile], 0) * w[tile]
+        self.W[win] += w[tile]
+
+    def finalize(self, chunk=1024):
+        """
+        Normalizes the canvas with the weights, in blocks of rows
+
+        Returns
+        -------
+        Z : np.ndarray
+            The composed canvas (the memory map if path is set), NaN where no tile is present
+        """
+        for r in range(0, self.shape[0], chunk):
+            w = np.asarray(self.W[r: r + chunk])
+            self.Z[r: r + chunk] = np.where(w > 0, self.Z[r: r + chunk] / np.where(w > 0, w, 1), np.nan)
+
+        if self._wpath is not None:  # the weights are not needed anymore
+            self.Z.flush()
+            del self.W  # closes the memory map before removing its file
+            os.remove(self._wpath)
+            self._wpath = None
+        return self.Z
+
+    def __del__(self):
+        if getattr(self, '_wpath', None) is not None:  # finalize was not called
+            del self.W
+            os.remove(self._wpath)
+
+
+class MosaicStitcher:
+    """
+    Stitching of a N x M grid of tiles with equal size and sampling
+    measured with a nominal overlap in x and in y
+    """
+    @staticmethod
+    def register(tiles, overlapPrc=(20, 20), upsample=20, workers=None):
+        """
+        Registers all the neighbouring tiles of the mosaic
+
+        Parameters
+        ----------
+        tiles : list[list[surface.Surface]]
+            The tiles, tiles[i][j] is the tile in row i and column j
+        overlapPrc : (int, int)
+            The nominal overlap percentage in x and in y
+        upsample : int
+            The precision of the registration is 1 / upsample pixels
+        workers : int
+            Number of threads, if None the executor default is used
+
+        Returns
+        -------
+        links : list[MosaicLink]
+            The registration of each pair of neighbouring tiles
+        nominal : dict
+            The nominal position [x, y] in pixels of each tile
+        """
+        rows, cols = len(tiles), len(tiles[0])
+        ny, nx = tiles[0][0].Z.shape
+        ovx, ovy = int(nx * overlapPrc[0] / 100), int(ny * overlapPrc[1] / 100)
+        nominal = {(i, j): np.array([j * (nx - ovx), i * (ny - ovy)], dtype=float)
+                   for i in range(rows) for j in range(cols)}
+
+        pairs = [((i, j), (i, j + 1)) for i in range(rows) for j in range(cols - 1)]
+        pairs += [((i, j), (i + 1, j)) for i in range(rows - 1) for j in range(cols)]
+        with ThreadPoolExecutor(max_workers=workers) as ex:  # the FFTs release the GIL
+            links = list(ex.map(lambda p: _registerLink(tiles, *p, ovx, ovy, nominal, upsample), pairs))
+        return links, nominal
+
+    @staticmethod
+    def solve(links, shape, nominal, minConf=0.05, leveling=None):
+        """
+        Global least square positions (and height corrections) of the tiles
+
+        Parameters
+        ----------
+        links : list[MosaicLink]
+            The pairwise registrations, see MosaicStitcher.register()
+        shape : (int, int)
+            Number of rows and columns of the mosaic
+        nominal : dict
+            The nominal positions of the tiles
+        minConf : float
+            The links with a lower confidence are not used, the tiles left without links
+            keep their nominal position
+        leveling : str
+            None no height correction, 'piston' an offset for each tile,
+            'tilt' an offset and a tilt for each tile
+
+        Returns
+        -------
+        positions : dict
+            The position [x, y] in pixels of each tile
+        corrections : dict
+            The plane [c, gx, gy] (mosaic pixels) subtracted from each tile
+
+        Notes
+        -----
+        Each link gives $p_b - p_a = o_{ab}$, the system is solved in the least square sense
+        weighting the links with their confidence, the tiles are weakly tied to the nominal grid
+        (this also fixes the free translation of the whole mosaic).
+        """
+        if leveling not in [None, 'piston', 'tilt']: raise Exception(f'{leveling} is not a valid leveling')
+        keys = [(i, j) for i in range(shape[0]) for j in range(shape[1])]
+        links = [l for l in links if l.conf >= minConf]
+        w = np.array([l.conf for l in links])
+
+        pos = _solveLinks(links, shape, [l.offset for l in links], [nominal[k] for k in keys], w)
+        corr = np.zeros((len(keys), 3))
+        if leveling is not None:
+            planes = np.array([l.plane for l in links]).reshape(-1, 3)
+            if leveling == 'piston': planes[:, 1:] = 0
+            corr = _solveLinks(links, shape, planes, np.zeros((len(keys), 3)), w)
+        return dict(zip(keys, pos)), dict(zip(keys, corr))
+
+    @staticmethod
+    def stitch(tiles, overlapPrc=(20, 20), upsample=20, minConf=0.05, leveling=None, workers=None,
+               out=None, path=None, blend='mean', width=None, bplt=False):
+        """
+        Stitches a mosaic of tiles in a single surface
+
+        Parameters
+        ----------
+        tiles : list[list[surface.Surface]]
+            The tiles, tiles[i][j] is the tile in row i and column j
+        overlapPrc : (int, int)
+            The nominal overlap percentage in x and in y
+        upsample : int
+            The precision of the registration is 1 / upsample pixels
+        minConf : float
+            The pairwise registrations with a lower confidence are not used
+        leveling : str
+            None, 'piston' or 'tilt', see MosaicStitcher.solve()
+        workers : int
+            Number of threads used for the registrations
+        out : np.ndarray
+            Preallocated (or memory mapped) canvas, if None it is created;
+            use MosaicStitcher.canvasShape() to get its shape
+        path : str
+            If not None the canvas is written in this .npy file (memory map)
+        blend : str
+            'mean', 'linear' or 'feather', see MosaicCompositor.weights()
+        width : float
+            Saturation of the blending weights in pixels
+        bplt : bool
+            If true plots the stitched surface
+
+        Returns
+        -------
+        sur : surface.Surface
+            The stitched surface, NaN where no tile is present
+
+        Notes
+        -----
+        If the canvas is a memory map (path is set or out is a np.memmap) sur.Z and
+        sur.Z0 are the memory map itself and X, Y are read-only broadcast views,
+        no canvas sized array is kept in memory; the methods of surface.Surface that
+        modify Z in place also modify the file.
+        """
+        shape = (len(tiles), len(tiles[0]))
+        links, nominal = MosaicStitcher.register(tiles, overlapPrc, upsample, workers)
+        positions, corrections = MosaicStitcher.solve(links, shape, nominal, minConf, leveling)
+        Z = MosaicStitcher.blend(tiles, positions, corrections, out=out, path=path, blend=blend, width=width)
+
+        t = tiles[0][0]
+        sur = surface.Surface()
+        if isinstance(Z, np.memmap):  # no copies of the canvas, the coordinates are broadcast views
+            ny, nx = Z.shape
+            sur.rangeX, sur.rangeY = nx * (t.x[1] - t.x[0]), ny * (t.y[1] - t.y[0])
+            sur.x, sur.y = np.linspace(0, sur.rangeX, num=nx), np.linspace(0, sur.rangeY, num=ny)
+            sur.X, sur.Y = np.broadcast_to(sur.x, Z.shape), np.broadcast_to(sur.y[:, None], Z.shape)
+            sur.X0, sur.Y0, sur.Z0, sur.Z = sur.X, sur.Y, Z, Z
+            if bplt: sur.pltC()
+        else:
+            sur.setValues(t.x[1] - t.x[0], t.y[1] - t.y[0], Z, bplt=bplt)
+        return sur
+
+    @staticmethod
+    def canvasShape(tiles, positions):
+        """The (rows, cols) of the canvas containing all the tiles at positions"""
+        ny, nx = tiles[0][0].Z.shape
+        P = np.round(np.array(list(positions.values())))
+        P -= P.min(axis=0)
+        return int(P[:, 1].max()) + ny, int(P[:, 0].max()) + nx
+
+    @staticmethod
+    def blend(tiles, positions, corrections=None, out=None, path=None, blend='mean', width=None):
+        """
+        Writes the tiles in the canvas tile by tile
+
+        Parameters
+        ----------
+        tiles : list[list[surface.Surface]]
+            The tiles
+        positions : dict
+            The position [x, y] in pixels of each tile, rounded to the nearest pixel
+        corrections : dict
+            The plane [c, gx, gy] subtracted from each tile, None for no correction
+        out : np.ndarray
+            Preallocated (or memory mapped) canvas, if None it is created
+        path : str
+            If not None the canvas is written in this .npy file (memory map)
+        blend : str
+            'mean', 'linear' or 'feather', see MosaicCompositor.weights()
+        width : float
+            Saturation of the blending weights in pixels
+
+        Returns
+        -------
+        out : np.ndarray
+            The canvas
+        """
+        shape = MosaicStitcher.canvasShape(tiles, positions)
+        comp = MosaicCompositor(shape, path=path, out=out)
+
+        P0 = np.round(np.array(list(positions.values()))).min(axis=0)
+        for (i, j), p in positions.items():
+            Z = tiles[i][j].Z
+            x0, y0 = (np.round(p) - P0).astype(int)
+            if corrections is not None:
+                c, gx, gy = corrections[(i, j)]
+                yy, xx = np.mgrid[0:Z.shape[0], 0:Z.shape[1]]
+                Z = Z - (c + gx * (xx + p[0]) + gy * (yy + p[1]))
+            comp.add(Z, x0, y0, blend=blend, width=width)
+
+        return comp.finalize()
@@ -20,12 +20,54 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import cm
 import os
-from scipy import interpolate, ndimage, special
+from scipy import interpolate, ndimage, special, sparse
 
 from surfile import profile, measfile_io, funct
 from surfile.funct import options, rcs
 
 
+def _interpMatrix(x, xi, method='cubic'):
+    """
+    Sparse matrix W (len(xi), len(x)) of the 1D interpolation from the regular grid x
+    to the points xi: zi = W @ z
+
+    Parameters
+    ----------
+    x : np.array
+        The regular grid
+    xi : np.array
+        The new points, the ones outside the range of x are linearly extrapolated
+        from the first (last) 2 points
+    method : str
+        'linear' or 'cubic' (Keys cubic convolution, a = -0.5)
+    """
+    n = len(x)
+    t = (xi - x[0]) / (x[1] - x[0])
+    i0 = np.clip(np.floor(t).astype(int), 0, n - 2)
+    f = t - i0  # outside [0, 1] only for the points outside the grid
+
+    if method == 'linear':
+        taps, w = np.array([0, 1]), np.c_[1 - f, f]
+    elif method == 'cubic':
+        taps = np.array([-1, 0, 1, 2])
+        d = np.abs(f[:, None] - taps)  # distances from the 4 nearest points
+        w = np.where(d <= 1, 1.5 * d ** 3 - 2.5 * d ** 2 + 1, -0.5 * d ** 3 + 2.5 * d ** 2 - 4 * d + 2)
+        ext = (f < 0) | (f > 1)
+        w[ext] = np.c_[np.zeros(ext.sum()), 1 - f[ext], f[ext], np.zeros(ext.sum())]
+    else: raise Exception(f'{method} is not a valid method')
+
+    cols = i0[:, None] + taps
+    rows = np.repeat(np.arange(len(xi)), len(taps))
+    # the points outside the grid are linearly extrapolated: z[-1] = 2 z[0] - z[1], z[n] = 2 z[n-1] - z[n-2]
+    out = np.where(cols < 0, 1, np.where(cols > n - 1, n - 2, -1))
+    cols = np.clip(cols, 0, n - 1)
+    e = out.ravel() >= 0
+    data = np.r_[np.where(out >= 0, 2, 1).ravel() * w.ravel(), -w.ravel()[e]]
+    rows, cols = np.r_[rows, rows[e]], np.r_[cols.ravel(), out.ravel()[e]]
+    keep = np.abs(data) > 1e-12  # the taps with zero weight (up to rounding) are not in the support
+    return sparse.csr_matrix((data[keep], (rows[keep], cols[keep])), shape=(len(xi), n))
+
+
 class Surface:
     """
     Class for handling surface data
@@ -198,9 +240,9 @@ class Surface:
         """
         self.Z = ndimage.rotate(self.Z0, angle, order=0, reshape=False, cval=np.nan)
 
-    def resample(self, newXsize, newYsize):
+    def resample(self, newXsize, newYsize, method='cubic', fill=False, rows=None):
         """
-        Resamples the topography and fills the non-measured points
+        Resamples the topography on a new regular grid from the first to the last point
 
         Parameters
         ----------
@@ -208,43 +250,63 @@ class Surface:
             Number of points desired on the x-axis
         newYsize: int
             Number of points desired on the y-axis
+        method : str
+            'linear' or 'cubic', the interpolation is separable (one sparse matrix per axis)
+        fill : bool
+            If true the non-measured points are filled before resampling (see fillNM()),
+            otherwise the new points that depend on a non-measured point are NaN
+        rows : int
+            If not None the new topography is computed in blocks of rows
             
         Notes
         -----
         <span style="color:orange">This function will be moved to a utility module in the future
         use with caution !!!</span>.
         """
-        xi = np.linspace(0, self.rangeX, newXsize)
-        yi = np.linspace(0, self.rangeY, newYsize)
-        Xi, Yi = np.meshgrid(xi, yi)
-
-        XY = np.vstack([self.X.reshape(np.size(self.X)),
-                        self.Y.reshape(np.size(self.Y))]).T
-
-        Zi = interpolate.griddata(XY, self.Z.reshape(np.size(self.Z)), (Xi, Yi), method='cubic')  # 'linear' 'cubic'
-        print(np.shape(self.Z), np.shape(Zi))
+        xi = np.linspace(self.x[0], self.x[-1], newXsize)
+        yi = np.linspace(self.y[0], self.y[-1], newYsize)
+        Wx = _interpMatrix(self.x, xi, method).T.tocsr()
+        Wy = _interpMatrix(self.y, yi, method)
+
+        Z = funct.inpaintNaN(self.Z) if fill else self.Z
+        nans = np.isnan(Z)
+        Z = np.where(nans, 0, Z)
+        rows = newYsize if rows is None else rows
+
+        Zi = np.empty((newYsize, newXsize))
+        for r in range(0, newYsize, rows):
+            Zi[r: r + rows] = (Wy[r: r + rows] @ Z) @ Wx
+            if np.any(nans):  # the points with a NaN in their support
+                bad = (abs(Wy[r: r + rows]) @ nans) @ abs(Wx)
+                Zi[r: r + rows][bad > 0] = np.nan
 
         self.x = xi
         self.y = yi
 
-        self.X = Xi
-        self.Y = Yi
+        self.X, self.Y = np.meshgrid(xi, yi)
         self.Z = Zi
 
-    def fillNM(self, method='cubic'):
+    def fillNM(self, method='laplace', maxSize=None):
         """
         Fills the surface non measured points
         
         Parameters
         ----------
         method : str
-            The interpolation method used
+            'laplace' local harmonic inpainting of each NaN region, see funct.inpaintNaN(),
+            'linear', 'nearest', 'cubic' global interpolation of all the valid points (griddata)
+        maxSize : int
+            With 'laplace' the NaN regions with more than maxSize points are not filled
             
         Notes
         -----
         <span style="color:orange">This function will be moved to a utility module in the future
         use with caution !!!</span>.
         """
+        if method == 'laplace':
+            self.Z = funct.inpaintNaN(self.Z, maxSize)
+            return
+
         z_ma = np.ma.masked_invalid(self.Z)
         self.Z = interpolate.griddata((self.X[~z_ma.mask], self.Y[~z_ma.mask]),
                                       z_ma[~z_ma.mask].ravel(),
@@ -3,6 +3,7 @@
 - analysis of roughness features for:
     - Profiles
     - Surfaces
+- areal texture parameters (ISO 25178-2)
 
 Example
 -------
@@ -11,12 +12,15 @@ Example
 >>> avg = psd.averageSpectra(bplt=False)
 >>> psd.angleIntegratedSpectra(dt_fct=0.8, bplt=True)
 >>> psd.polarSpectra(df_fct=0.8, bplt=True)
+>>> par = texture.SurfaceParameters.calc(sur)
+>>> par.Sq, par.Sal
 
 @author: Dorothee Hueser, Andrea Giura
 """
 
 from matplotlib import cm
 import numpy as np
+from scipy import fft, ndimage, integrate
 import scipy.stats as st
 import scipy.stats as st
 from dataclasses import dataclass
@@ -310,6 +314,89 @@ class Psd:
         return (self.fx[self.fx >= 0], PSDxmean[self.fx >= 0]), (self.fy[self.fy >= 0], PSDymean[self.fy >= 0])
 
 
+def _moments(z, shift=None, block=2 ** 16):
+    """
+    Fused statistics kernel, all the moments and the extrema of the last
+    axis of z are accumulated in a single pass over the data.
+    The array is processed in blocks of at most block elements to keep the
+    temporaries in cache, the non-measured points (NaN) are skipped.
+
+    Parameters
+    ----------
+    z : np.ndarray
+        Profile (n,) or stack of profiles (..., n)
+    shift : float or np.ndarray, optional
+        Reference value subtracted to each profile before the accumulation
+        (e.g. the mean line), by default None
+    block : int, optional
+        Maximum number of elements processed at once, by default 2**16
+
+    Returns
+    -------
+    cnt, s1, sa, s2, s3, s4 : np.ndarray
+        Number of valid points, sum of z, |z|, z^2, z^3 and z^4 for each profile
+    zmax, zmin : np.ndarray
+        Maximum and minimum of each profile (-inf, +inf for profiles without valid points)
+    """
+    z = np.asarray(z, dtype=float)
+    lead = z.shape[:-1]
+    n = z.shape[-1]
+    z = z.reshape(-1, n)
+    m = z.shape[0]
+    shift = np.zeros(m) if shift is None else np.broadcast_to(shift, lead).reshape(-1).astype(float)
+
+    cnt, s1, sa, s2, s3, s4 = np.zeros((6, m))
+    zmax = np.full(m, -np.inf)
+    zmin = np.full(m, np.inf)
+
+    cols = int(np.clip(block, 1, n))
+    rows = max(1, block // cols)
+    for r in range(0, m, rows):
+        rs = slice(r, r + rows)
+        for c in range(0, n, cols):
+            zb = z[rs, c: c + cols]
+            valid = np.isfinite(zb)
+            zb = np.where(valid, zb - shift[rs, None], 0)
+            z2 = zb * zb
+
+            cnt[rs] += np.count_nonzero(valid, axis=1)
+            s1[rs] += zb.sum(axis=1)
+            sa[rs] += np.abs(zb).sum(axis=1)
+            s2[rs] += z2.sum(axis=1)
+            s3[rs] += (z2 * zb).sum(axis=1)
+            s4[rs] += (z2 * z2).sum(axis=1)
+            np.maximum(zmax[rs], np.max(zb, axis=1, where=valid, initial=-np.inf), out=zmax[rs])
+            np.minimum(zmin[rs], np.min(zb, axis=1, where=valid, initial=np.inf), out=zmin[rs])
+
+    return tuple(a.reshape(lead) for a in (cnt, s1, sa, s2, s3, s4, zmax, zmin))
+
+
+def _roughness(z):
+    """
+    Roughness parameters of the last axis of z from the fused moments,
+    the sums are normalized by the number of samples (NaNs included)
+
+    Returns
+    -------
+    RA, RQ, RP, RV, RT, RZ, RSK, RKU: (np.ndarray, ...)
+        Calculated roughness parameters
+    """
+    n = np.shape(z)[-1]
+    cnt, _, sa, s2, s3, s4, zmax, zmin = _moments(z)
+    sa, s2, zmax, zmin = (np.where(cnt > 0, a, np.nan) for a in (sa, s2, zmax, zmin))  # profiles without valid points
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        RA = sa / n
+        RQ = np.sqrt(s2 / n)
+        RP = np.abs(zmax)
+        RV = np.abs(zmin)
+        RT = RP + RV
+        RZ = zmax - zmin
+        RSK = (s3 / n) / (RQ ** 3)
+        RKU = (s4 / n) / (RQ ** 4)
+    return RA, RQ, RP, RV, RT, RZ, RSK, RKU
+
+
 @dataclass
 class Roi:
     X: np.array
@@ -360,15 +447,353 @@ class Parameters:
             ax.plot(roi.X, roi.Z)
             plt.show()
 
-        RA = np.nansum(abs(roi.Z)) / np.size(roi.Z)
-        RQ = np.sqrt(np.nansum(abs(roi.Z ** 2)) / np.size(roi.Z))
-        RP = abs(np.nanmax(roi.Z))
-        RV = abs(np.nanmin(roi.Z))
-        RT = RP + RV
-        RZ = np.nanmax(roi.Z) - np.nanmin(roi.Z)
-        RSK = (np.nansum(roi.Z ** 3) / np.size(roi.Z)) / (RQ ** 3)
-        RKU = (np.nansum(roi.Z ** 4) / np.size(roi.Z)) / (RQ ** 4)
-        return RA, RQ, RP, RV, RT, RZ, RSK, RKU
+        return tuple(float(p) for p in _roughness(roi.Z))
+
+    @staticmethod
+    def calcStack(obj: surface.Surface, direction='x', border=1):
+        """
+        Calculates the roughness parameters of all the profiles of a
+        topography in a single vectorized call
+
+        Parameters
+        ----------
+        obj: surface.Surface
+            The surface, the form and the waviness should already be removed
+        direction: str
+            'x' the profiles are the rows of the topography, 'y' the columns
+        border: int
+            Number of samples not considered at both edges of each profile
+
+        Returns
+        -------
+        RA, RQ, RP, RV, RT, RZ, RSK, RKU: (np.array, ...)
+            Calculated roughness parameters, one value for each profile
+        """
+        if direction not in ['x', 'y']: raise Exception(f'{direction} is not a valid direction')
+
+        Z = obj.Z if direction == 'x' else obj.Z.T
+        return _roughness(Z[:, border: Z.shape[1] - border])
+
+
+@dataclass
+class ArealParams:
+    """Areal texture parameters ISO 25178-2, see SurfaceParameters.calc()"""
+    Sa: float
+    Sq: float
+    Ssk: float
+    Sku: float
+    Sp: float
+    Sv: float
+    Sz: float
+    Sdq: float
+    Sdr: float
+    Sal: float
+    Str: float
+
+
+def _acf(zc, valid):
+    """
+    NaN-aware areal autocorrelation function computed with the FFT.
+    The non measured points are set to 0 and every lag is normalized
+    by the number of valid point pairs contributing to it.
+
+    Parameters
+    ----------
+    zc : np.ndarray
+        The heights referred to the mean plane, NaNs set to 0
+    valid : np.ndarray
+        Boolean mask of the measured points
+
+    Returns
+    -------
+    acf : np.ndarray
+        The normalized acf (acf = 1 at zero lag) centred on the zero lag,
+        lags are limited to half the topography extension
+    """
+    ny, nx = zc.shape
+    shape = (fft.next_fast_len(2 * ny - 1), fft.next_fast_len(2 * nx - 1))  # zero padding, no wrap around
+
+    fz = fft.rfft2(zc, shape)
+    num = fft.irfft2(fz * np.conj(fz), shape)
+    fm = fft.rfft2(valid.astype(float), shape)
+    den = fft.irfft2(fm * np.conj(fm), shape)
+
+    hy, hx = ny // 2, nx // 2
+    num = np.roll(num, (hy, hx), axis=(0, 1))[:2 * hy + 1, :2 * hx + 1]
+    den = np.roll(den, (hy, hx), axis=(0, 1))[:2 * hy + 1, :2 * hx + 1]
+
+    acf = np.full(num.shape, np.nan)
+    np.divide(num, den, out=acf, where=den > 0.5)  # den counts the valid pairs (rounding noise below 0.5)
+    return acf / acf[hy, hx]
+
+
+class SurfaceParameters:
+    @staticmethod
+    def calc(obj: surface.Surface, rem: geometry.FormEstimator = None, fil: filter.Filter = None, s=0.2, bplt=False):
+        """
+        Calculates the areal texture parameters of a topography
+
+        Parameters
+        ----------
+        obj: surface.Surface
+            The surface on which the parameters are calculated
+        rem: geometry.FormEstimator
+            - if None, the form is not removed before the calculation
+        fil: filter.Filter
+            The filter that is applied before the calculations
+        s: float
+            The threshold of the autocorrelation function used for Sal and Str
+        bplt: bool
+            If true plots the autocorrelation function and the Sal, Str threshold
+
+        Returns
+        -------
+        params: ArealParams
+            Height (Sa, Sq, Ssk, Sku, Sp, Sv, Sz), hybrid (Sdq, Sdr [%])
+            and spatial (Sal, Str) parameters
+
+        Notes
+        -----
+        The heights are referred to the mean plane of the measured points,
+        the non-measured points (NaN) are excluded from all the parameters.
+
+        The slopes used for Sdq and Sdr are calculated with central differences.
+
+        The autocorrelation function $f_{ACF}(t_x, t_y)$ is calculated with the FFT on the
+        zero padded topography, each lag is normalized by the number of valid point pairs.
+        Sal is the shortest lag length at which $f_{ACF}$ decays to the value s, Str is
+        the ratio between Sal and the longest decay length (0 < Str <= 1).
+        When $f_{ACF}$ does not decay to s inside the calculated lags (half the
+        topography extension) in some direction, Str is NaN and a warning is printed
+        (Sal is NaN too if a shorter decay length could lie beyond the window).
+        """
+        if rem is not None:
+            rem.applyFit(obj)
+        if fil is not None:
+            fil.applyFilter(obj, bplt=bplt)
+
+        dx = np.mean(np.diff(obj.x))
+        dy = np.mean(np.diff(obj.y))
+
+        valid = np.isfinite(obj.Z)
+        n = np.count_nonzero(valid)
+        if n == 0: raise Exception(f'Areal parameters failed: {obj.name} has no measured points')
+        mean = np.nansum(obj.Z) / n
+        zc = np.where(valid, obj.Z - mean, 0)
+
+        # height parameters (fused moments of the rows reduced over the whole map)
+        _, _, sa, s2, s3, s4, zmax, zmin = _moments(obj.Z, shift=mean)
+        Sa = np.sum(sa) / n
+        Sq = np.sqrt(np.sum(s2) / n)
+        Ssk = np.sum(s3) / n / Sq ** 3
+        Sku = np.sum(s4) / n / Sq ** 4
+        Sp = np.max(zmax)
+        Sv = -np.min(zmin)
+        Sz = Sp + Sv
+
+        # hybrid parameters
+        gy, gx = np.gradient(np.where(valid, zc, np.nan), dy, dx)
+        g2 = gx * gx + gy * gy
+        Sdq = np.sqrt(np.nanmean(g2))
+        Sdr = np.nanmean(np.sqrt(1 + g2) - 1) * 100
+
+        # spatial parameters
+        acf = _acf(zc, valid)
+        hy, hx = np.asarray(acf.shape) // 2
+        lab, _ = ndimage.label(acf > s)
+        central = ndimage.binary_fill_holes(lab == lab[hy, hx])
+        border = ndimage.binary_dilation(central) & ~central
+
+        ty, tx = np.nonzero(border)
+        lags = np.hypot((tx - hx) * dx, (ty - hy) * dy)
+        # the central lobe cut by the window edge decays outside the calculated lags
+        ey, ex = np.nonzero(central & ~ndimage.binary_erosion(central, border_value=0))
+        edge = (ey == 0) | (ey == acf.shape[0] - 1) | (ex == 0) | (ex == acf.shape[1] - 1)
+        cut = np.hypot((ex[edge] - hx) * dx, (ey[edge] - hy) * dy)
+        if lags.size > 0:
+            Sal = np.min(lags)
+            Str = Sal / np.max(lags)
+        else:  # the acf never decays below s in the calculated lags
+            Sal, Str = np.nan, np.nan
+        if cut.size > 0 and lags.size > 0:
+            print(funct.Bcol.WARNING + f'{obj.name}: THE ACF DOES NOT DECAY TO {s} INSIDE THE LAGS WINDOW, '
+                                       f'Str IS UNDEFINED' + funct.Bcol.ENDC)
+            Str = np.nan  # the longest decay length is beyond the window
+            if Sal > np.min(cut):
+                Sal = np.nan  # a shorter decay may lie beyond the window
+
+        if bplt:
+            fig, ax = plt.subplots()
+            extent = [-hx * dx, hx * dx, -hy * dy, hy * dy]
+            ax.imshow(acf, extent=extent, origin='lower', cmap=cm.viridis)
+            ax.contour(acf, levels=[s], extent=extent, origin='lower', colors='r')
+            funct.persFig([ax], xlab=r'$t_x$ [um]', ylab=r'$t_y$ [um]')
+            ax.set_title(obj.name + ' ACF')
+            plt.show()
+
+        return ArealParams(Sa, Sq, Ssk, Sku, Sp, Sv, Sz, Sdq, Sdr, Sal, Str)
+
+
+def _rkParams(mr, h):
+    """
+    Rk family parameters from the material ratio curves
+
+    Parameters
+    ----------
+    mr : np.array
+        The material ratios [%] equally spaced from 0 to 100
+    h : np.ndarray
+        (m, npoints) heights of the m material ratio curves
+
+    Returns
+    -------
+    Rk, Rpk, Rvk, Mr1, Mr2: (np.array, ...)
+        Core depth, reduced peak and valley heights, material ratios [%]
+        of the core limits (ISO 13565-2)
+    """
+    dmr = mr[1] - mr[0]
+    w = int(round(40 / dmr))
+    rows = np.arange(h.shape[0])
+
+    # the equivalent straight line is the 40% secant with the least gradient
+    secant = h[:, :-w] - h[:, w:]
+    k = np.argmin(np.where(np.isnan(secant), np.inf, secant), axis=1)
+    d = secant[rows, k]
+    upper = h[rows, k] + d * mr[k] / 40
+    lower = upper - 2.5 * d
+    Rk = upper - lower
+
+    def crossing(level, above):
+        # the curves are monotonic: count the points above the level and interpolate
+        i = np.clip(np.count_nonzero(above, axis=1), 1, mr.size - 1)
+        h0, h1 = h[rows, i - 1], h[rows, i]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.clip(np.where(h0 != h1, (h0 - level) / (h0 - h1), 0), 0, 1)
+        return mr[i - 1] + t * dmr
+
+    Mr1 = crossing(upper, h > upper[:, None])
+    Mr2 = crossing(lower, h >= lower[:, None])
+
+    A1 = integrate.trapezoid(np.clip(h - upper[:, None], 0, None), dx=dmr, axis=1)
+    A2 = integrate.trapezoid(np.clip(lower[:, None] - h, 0, None), dx=dmr, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Rpk = np.where(Mr1 > 0, 2 * A1 / Mr1, 0)
+        Rvk = np.where(Mr2 < 100, 2 * A2 / (100 - Mr2), 0)
+    return Rk, Rpk, Rvk, Mr1, Mr2
+
+
+class MaterialRatio:
+    """
+    Abbott-Firestone (material ratio) curve and the parameters
+    of the Rk family (ISO 13565-2) for profiles and surfaces
+    """
+    @staticmethod
+    def curve(z, npoints=1001):
+        """
+        Calculates the material ratio curve of the heights
+
+        Parameters
+        ----------
+        z : np.ndarray
+            The heights (n,) or a stack of profiles (..., n), NaNs are ignored
+        npoints : int
+            Number of material ratio values between 0 and 100 %
+
+        Returns
+        -------
+        mr : np.array
+            The material ratios [%]
+        h : np.ndarray
+            (..., npoints) The heights at the material ratios mr
+
+        Notes
+        -----
+        The curve is built from a sorted copy of each profile, the height at
+        the material ratio mr is linearly interpolated between the order statistics.
+        """
+        z = np.asarray(z, dtype=float)
+        lead = z.shape[:-1]
+        z = np.sort(z.reshape(-1, z.shape[-1]), axis=1)  # NaNs are sorted at the end
+        cnt = np.count_nonzero(np.isfinite(z), axis=1)
+
+        mr = np.linspace(0, 100, npoints)
+        pos = (cnt[:, None] - 1) * (1 - mr / 100)  # index in ascending order
+        i0 = np.clip(np.floor(pos).astype(int), 0, None)
+        i1 = np.minimum(i0 + 1, np.maximum(cnt[:, None] - 1, 0))
+        t = pos - i0
+        h = (1 - t) * np.take_along_axis(z, i0, axis=1) + t * np.take_along_axis(z, i1, axis=1)
+        h[cnt == 0] = np.nan
+
+        return mr, h.reshape(lead + (npoints,))
+
+    @staticmethod
+    def calc(obj, npoints=1001, bplt=False):
+        """
+        Calculates the Rk (profile) or Sk (surface) family parameters
+
+        Parameters
+        ----------
+        obj : profile.Profile or surface.Surface
+            The profile or surface, the form should already be removed
+        npoints : int
+            Number of points of the material ratio curve
+        bplt : bool
+            Plots the material ratio curve and the core construction
+
+        Returns
+        -------
+        Rk, Rpk, Rvk, Mr1, Mr2 : (float, ...)
+            Core depth, reduced peak height, reduced valley depth and
+            the material ratios [%] at the core limits (Sk, Spk, Svk, Smr1, Smr2 for surfaces)
+
+        Notes
+        -----
+        The equivalent straight line is the secant of the material ratio curve
+        spanning 40 % of material ratio with the least gradient. The core depth is
+        the height difference of the line at 0 % and 100 %. The reduced peak (valley)
+        height is the height of the triangle with the same area of the peaks (valleys)
+        above (below) the core and base Mr1 (100 % - Mr2).
+        """
+        mr, h = MaterialRatio.curve(np.ravel(obj.Z), npoints=npoints)
+        Rk, Rpk, Rvk, Mr1, Mr2 = (float(p[0]) for p in _rkParams(mr, h[None, :]))
+
+        if bplt:
+            upper = h[int(round(Mr1 / (mr[1] - mr[0])))] if Mr1 < 100 else h[-1]
+            fig, ax = plt.subplots()
+            ax.plot(mr, h, color='teal')
+            ax.plot([0, 100], [upper, upper - Rk], 'r--')
+            ax.axvline(Mr1, color='grey')
+            ax.axvline(Mr2, color='grey')
+            funct.persFig([ax], gridcol='grey', xlab='material ratio [%]', ylab='z [um]')
+            ax.set_title(obj.name)
+            plt.show()
+
+        return Rk, Rpk, Rvk, Mr1, Mr2
+
+    @staticmethod
+    def calcStack(obj: surface.Surface, direction='x', npoints=1001):
+        """
+        Calculates the Rk family parameters of all the profiles of a
+        topography in a single vectorized call
+
+        Parameters
+        ----------
+        obj : surface.Surface
+            The surface, the form should already be removed
+        direction : str
+            'x' the profiles are the rows of the topography, 'y' the columns
+        npoints : int
+            Number of points of the material ratio curves
+
+        Returns
+        -------
+        Rk, Rpk, Rvk, Mr1, Mr2 : (np.array, ...)
+            The parameters of each profile, see MaterialRatio.calc()
+        """
+        if direction not in ['x', 'y']: raise Exception(f'{direction} is not a valid direction')
+
+        mr, h = MaterialRatio.curve(obj.Z if direction == 'x' else obj.Z.T, npoints=npoints)
+        return _rkParams(mr, h)
 
 
 def __makeFacesVectorized(shape):